@@ -0,0 +1,88 @@
+"""
+Compares the wire codec with plain pickle for the values most often sent back by the proxy server,
+to pick the cheapest encoding per type (see package_proxy._remote.codec.SerializerRegistry).
+
+    PYTHONPATH=src python benchmarks/bench_codec.py [--number N]
+
+Run it with every interpreter version meant to be on either side of the wire.
+"""
+from __future__ import annotations
+
+import argparse
+import io
+import pickle
+import sys
+import timeit
+
+from package_proxy._remote import wire  # registers the ProxyApi codecs
+from package_proxy._remote.codec import registry
+from package_proxy.api import ProxyApi
+
+SAMPLES = {
+    "None": None,
+    "bool": True,
+    "int": 42,
+    "bigint": 2 ** 80,
+    "float": 3.14,
+    "str": "method 2 here!",
+    "str-1k": "x" * 1024,
+    "bytes-64k": b"x" * 65536,
+    "tuple": (1, "a", 2.0),
+    "list-100-int": list(range(100)),
+    "list-100-str": [f"item{i}" for i in range(100)],
+    "dict-20": {f"key{i}": i for i in range(20)},
+    "set-50": set(range(50)),
+    "AttrWrapper-str": ProxyApi.AttrWrapper("method 2 here!"),
+    "Symbol": ProxyApi.Symbol("C.mod_C1", "C1_1"),
+    "response": (True, ProxyApi.AttrWrapper("method 2 here!"), ()),
+}
+
+
+def _pickle_value(obj, codec_types=frozenset(), by_ref=None):
+    buf = io.BytesIO()
+    wire.ServerPickler(buf, id, pickle.HIGHEST_PROTOCOL, by_ref, codec_types).dump(obj)
+    return buf.getvalue()
+
+
+def _codec(value):
+    return (lambda: registry.dumps(value, _pickle_value, _pickle_value),
+            lambda data: registry.loads(data, pickle.loads))
+
+
+def _pickle(protocol):
+    def encoding(value):
+        return lambda: pickle.dumps(value, protocol=protocol), pickle.loads
+    return encoding
+
+
+def _server_pickle(value):
+    # the encoding of responses before the codec, with the ServerPickler hook on every object
+    return lambda: _pickle_value(value), pickle.loads
+
+
+ENCODINGS = {
+    "codec": _codec,
+    "server": _server_pickle,
+    "pickle-4": _pickle(4),
+    f"pickle-{pickle.HIGHEST_PROTOCOL}": _pickle(pickle.HIGHEST_PROTOCOL),
+}
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000, help="runs per measurement")
+    args = parser.parse_args(argv)
+
+    print(f"python {sys.version.split()[0]}, {args.number} runs, times in microseconds")
+    print(f"{'type':<18}{'encoding':<12}{'bytes':>8}{'encode':>10}{'decode':>10}")
+    for name, value in SAMPLES.items():
+        for encoding_name, encoding in ENCODINGS.items():
+            dumps, loads = encoding(value)
+            data = dumps()
+            encode = min(timeit.repeat(dumps, number=args.number, repeat=3)) / args.number * 1e6
+            decode = min(timeit.repeat(lambda: loads(data), number=args.number, repeat=3)) / args.number * 1e6
+            print(f"{name:<18}{encoding_name:<12}{len(data):>8}{encode:>10.2f}{decode:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
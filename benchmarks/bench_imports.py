@@ -0,0 +1,83 @@
+"""
+Measures what tracking the imports of the target costs LocalApi (see ModuleImportTracker), on a
+generated package with thousands of submodules: importing it plainly, importing it tracked and
+moved under the remote prefix, and importing as many unrelated modules while the tracker is set up.
+
+    PYTHONPATH=src python benchmarks/bench_imports.py [--packages N] [--modules N]
+
+Every case runs in a fresh interpreter, the package is generated in a temporary directory.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+CASES = ("plain", "tracked", "unrelated")
+
+
+def _generate(root: str, name: str, packages: int, modules: int) -> None:
+    """A package of `packages` subpackages of `modules` modules each, all imported by its __init__"""
+    os.makedirs(os.path.join(root, name))
+    with open(os.path.join(root, name, "__init__.py"), "w") as init:
+        for p in range(packages):
+            init.write(f"from . import sub{p}\n")
+            os.makedirs(os.path.join(root, name, f"sub{p}"))
+            with open(os.path.join(root, name, f"sub{p}", "__init__.py"), "w") as sub_init:
+                for m in range(modules):
+                    sub_init.write(f"from . import mod{m}\n")
+                    with open(os.path.join(root, name, f"sub{p}", f"mod{m}.py"), "w") as module:
+                        module.write(f"VALUE = {m}\n\ndef function():\n    return VALUE\n")
+
+
+def _run(case: str) -> float:
+    """Runs a case in this interpreter, returning the time it took"""
+    from package_proxy._local.api import ModuleImportTracker
+    from package_proxy.client import ClientModuleFinder
+
+    tracker = ModuleImportTracker("bench_target")
+    finder = ClientModuleFinder("bench_target")
+    if case != "plain":
+        sys.meta_path.insert(0, finder)
+    started = time.perf_counter()
+    if case == "plain":
+        __import__("bench_target")
+    elif case == "tracked":
+        with tracker.tracking(finder):
+            __import__("bench_target")
+        assert "__remote__bench_target.sub0.mod0" in sys.modules
+    else:
+        __import__("bench_other")
+    return time.perf_counter() - started
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--packages", type=int, default=50, help="subpackages in the generated package")
+    parser.add_argument("--modules", type=int, default=100, help="modules per subpackage")
+    parser.add_argument("--case", choices=CASES, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print(_run(args.case))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ("bench_target", "bench_other"):
+            _generate(tmp, name, args.packages, args.modules)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([tmp, os.environ.get("PYTHONPATH", "")]))
+        # compiled once, so that every case reads the same bytecode
+        subprocess.run([sys.executable, "-m", "compileall", "-q", tmp], check=True)
+        print(f"{args.packages * args.modules} modules")
+        print(f"{'case':<12}{'time (ms)':>12}")
+        for case in CASES:
+            output = subprocess.run([sys.executable, __file__, "--case", case], env=env, check=True,
+                                    capture_output=True, text=True).stdout
+            print(f"{case:<12}{float(output) * 1e3:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
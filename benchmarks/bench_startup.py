@@ -0,0 +1,67 @@
+"""
+Measures what the .pth bootstrap adds to the startup of every interpreter, from `-X importtime`:
+the modules it imports and their import time, without a target, with PKG_PROXY_TARGET set, and
+once the target is first imported, which brings in the client.
+
+    PYTHONPATH=src python benchmarks/bench_startup.py [--repeat N]
+
+The bootstrap is installed in a temporary site directory, added with site.addsitedir as site does
+for site-packages. The modules imported by an interpreter without it are left out.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from package_proxy import PACKAGE_PROXY_TARGET
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# (name, target, code run once started)
+CASES = (
+    ("no target", None, ""),
+    ("target", "bench_absent", ""),
+    # what the first import of the target brings in, short of connecting
+    ("first import", "bench_absent", "import package_proxy.client"),
+)
+
+
+def _import_times(site_dir: str, target: str | None, code: str) -> dict[str, int]:
+    """The self import time in µs of every module imported by an interpreter starting with site_dir"""
+    env = dict(os.environ)
+    env.pop(PACKAGE_PROXY_TARGET, None)
+    if target is not None:
+        env[PACKAGE_PROXY_TARGET] = target
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             f"import site; site.addsitedir({site_dir!r}); {code}"],
+                            env=env, check=True, capture_output=True, text=True).stderr
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(self_us)
+    return times
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="interpreters started per case")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as empty, tempfile.TemporaryDirectory() as site_dir:
+        shutil.copy(os.path.join(ROOT, "package_proxy_bootstrap.pth"), site_dir)
+        baseline = set(_import_times(empty, None, ""))
+        print(f"{'case':<16}{'modules':>10}{'time (us)':>12}")
+        for name, target, code in CASES:
+            runs = [_import_times(site_dir, target, code) for _ in range(args.repeat)]
+            added = [{module: us for module, us in run.items() if module not in baseline} for run in runs]
+            print(f"{name:<16}{len(added[0]):>10}{statistics.median(sum(run.values()) for run in added):>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
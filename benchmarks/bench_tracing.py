@@ -0,0 +1,60 @@
+"""
+Measures what tracing sys.modules with an InspectDict (see PKG_PROXY_TRACE) adds to the import of a
+generated package with thousands of submodules, with tracing off, sampled and full.
+
+    PYTHONPATH=src python benchmarks/bench_tracing.py [--packages N] [--modules N] [--sample N]
+
+Every case runs in a fresh interpreter, the package is generated in a temporary directory.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_imports import _generate
+
+CASES = ("off", "sampled", "full")
+
+
+def _run(sample: int) -> float:
+    """Imports the package in this interpreter, returning the time it took"""
+    from package_proxy._local.logger import InspectDict
+
+    if sample:
+        sys.modules = InspectDict("sys.modules", sys.modules, sample=sample)
+    started = time.perf_counter()
+    __import__("bench_target")
+    return time.perf_counter() - started
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--packages", type=int, default=50, help="subpackages in the generated package")
+    parser.add_argument("--modules", type=int, default=100, help="modules per subpackage")
+    parser.add_argument("--sample", type=int, default=100, help="1 in how many accesses the sampled case traces")
+    parser.add_argument("--run", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run is not None:
+        print(_run(args.run))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _generate(tmp, "bench_target", args.packages, args.modules)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([tmp, os.environ.get("PYTHONPATH", "")]))
+        # compiled once, so that every case reads the same bytecode
+        subprocess.run([sys.executable, "-m", "compileall", "-q", tmp], check=True)
+        print(f"{args.packages * args.modules} modules")
+        print(f"{'case':<12}{'time (ms)':>12}")
+        for case, sample in zip(CASES, (0, args.sample, 1)):
+            output = subprocess.run([sys.executable, __file__, "--run", str(sample)], env=env, check=True,
+                                    capture_output=True, text=True).stdout
+            print(f"{case:<12}{float(output) * 1e3:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Compares the round trip latency of the socket and ring transports (see package_proxy._remote.ring),
+for small get_attr and call requests and for a large attribute value, against a server hosting
+the testbed package.
+
+    PYTHONPATH=src python benchmarks/bench_transport.py [--number N]
+
+The server runs in a subprocess, on a unix socket in a temporary directory.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+from package_proxy import PACKAGE_PROXY_ADDRESS, PACKAGE_PROXY_TRANSPORT
+from package_proxy._remote.api import RemoteApi
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TRANSPORTS = ("socket", "ring")
+
+
+def _start_server(address: str) -> subprocess.Popen:
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.join(ROOT, "testbed", "server"),
+                                                      os.path.join(ROOT, "src")]))
+    server = subprocess.Popen([sys.executable, "-m", "package_proxy", "--target", "C", "--address", address],
+                              env=env, stdout=subprocess.DEVNULL)
+    path = address[len("unix:"):]
+    deadline = time.monotonic() + 10
+    while not os.path.exists(path):
+        if server.poll() is not None or time.monotonic() > deadline:
+            server.kill()
+            raise RuntimeError("proxy server did not start")
+        time.sleep(0.05)
+    return server
+
+
+def _measure(api: RemoteApi, number: int) -> dict[str, float]:
+    module_id = api.get_module("C.mod_C1")
+    cls_id = api.get_attr(module_id, "C1_1").proxy_id
+    obj_id = api.create_object(cls_id)
+    api.set_attr(obj_id, "_large", b"x" * (1 << 20))
+    # (request, round trips relative to --number)
+    cases = {
+        "get_attr": (lambda: api.get_attr(obj_id, "_msg"), 1),
+        "call": (lambda: api.call(obj_id, "__sizeof__"), 1),
+        "get_attr-1MiB": (lambda: api.get_attr(obj_id, "_large"), 0.02),
+    }
+    results = {}
+    for name, (case, share) in cases.items():
+        runs = max(1, int(number * share))
+        results[name] = min(timeit.repeat(case, number=runs, repeat=3)) / runs * 1e6
+    return results
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=2000, help="round trips per measurement")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        address = f"unix:{os.path.join(tmp, 'proxy.sock')}"
+        server = _start_server(address)
+        try:
+            os.environ[PACKAGE_PROXY_ADDRESS] = address
+            results = {}
+            for transport in TRANSPORTS:
+                os.environ[PACKAGE_PROXY_TRANSPORT] = transport
+                api = RemoteApi("C")
+                try:
+                    results[transport] = _measure(api, args.number)
+                finally:
+                    api.close()
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"python {sys.version.split()[0]}, {args.number} round trips, times in microseconds")
+    print(f"{'request':<16}" + "".join(f"{transport:>10}" for transport in TRANSPORTS))
+    for name in results[TRANSPORTS[0]]:
+        print(f"{name:<16}" + "".join(f"{results[transport][name]:>10.1f}" for transport in TRANSPORTS))
+
+
+if __name__ == "__main__":
+    main()
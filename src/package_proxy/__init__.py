@@ -3,8 +3,30 @@ import os
 PACKAGE_PROXY_TARGET ="PKG_PROXY_TARGET"
 PACKAGE_PROXY_API ="PKG_PROXY_API"
 PACKAGE_PROXY_API_LOGLEVEL ="PKG_PROXY_API_LOGLEVEL"
+PACKAGE_PROXY_ADDRESS ="PKG_PROXY_ADDRESS"
+PACKAGE_PROXY_SCHEMA_CACHE ="PKG_PROXY_SCHEMA_CACHE"
+PACKAGE_PROXY_VALUE_CACHE ="PKG_PROXY_VALUE_CACHE"
+PACKAGE_PROXY_WRITE_BEHIND ="PKG_PROXY_WRITE_BEHIND"
+PACKAGE_PROXY_CONSTRUCTION ="PKG_PROXY_CONSTRUCTION"
+PACKAGE_PROXY_SHARED_MEMORY ="PKG_PROXY_SHARED_MEMORY"
+PACKAGE_PROXY_TRANSPORT ="PKG_PROXY_TRANSPORT"
+PACKAGE_PROXY_CALLS ="PKG_PROXY_CALLS"
+PACKAGE_PROXY_TIMEOUT ="PKG_PROXY_TIMEOUT"
+PACKAGE_PROXY_IMPORTS ="PKG_PROXY_IMPORTS"
+PACKAGE_PROXY_TRACE ="PKG_PROXY_TRACE"
 
-if os.environ.get(PACKAGE_PROXY_TARGET) is not None:
-    import package_proxy.client
+if os.environ.get(PACKAGE_PROXY_TARGET) is None:
+    # not a client, the server is only imported by python -m package_proxy
+    pass
+elif (os.environ.get(PACKAGE_PROXY_API) or "").startswith("package_proxy._local."):
+    # the target runs in this interpreter and is imported before any thread imports its proxies,
+    # see LocalApi
+    import sys
+    from .client import ClientModuleFinder
+    for finder in sys.meta_path:
+        if isinstance(finder, ClientModuleFinder):
+            finder.preload()
 else:
-    import package_proxy.server
\ No newline at end of file
+    # the client is imported along with the target package, see ClientFinderStub
+    from ._bootstrap import install
+    install(os.environ[PACKAGE_PROXY_TARGET])
\ No newline at end of file
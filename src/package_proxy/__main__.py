@@ -0,0 +1,3 @@
+from package_proxy.server import main
+
+main()
@@ -0,0 +1,28 @@
+"""
+Stands in for the ClientModuleFinder until the target package is first imported, so that starting
+an interpreter with PKG_PROXY_TARGET set imports nothing more than this module. Kept free of imports.
+"""
+import sys
+
+
+class ClientFinderStub:
+
+    def __init__(self, proxy_target):
+        self._proxy_target = proxy_target
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname != self._proxy_target and not fullname.startswith(self._proxy_target + "."):
+            return None
+        # importing the client installs the ClientModuleFinder in the stub's place
+        from package_proxy import client
+        for finder in sys.meta_path:
+            if isinstance(finder, client.ClientModuleFinder):
+                return finder.find_spec(fullname, path, target)
+        return None
+
+
+def install(proxy_target):
+    # once imported, the client has installed its own finder
+    if "package_proxy.client" in sys.modules or any(isinstance(f, ClientFinderStub) for f in sys.meta_path):
+        return
+    sys.meta_path.insert(0, ClientFinderStub(proxy_target))
@@ -1,49 +1,89 @@
 from __future__ import annotations
 
+import collections
+import contextlib
+import dataclasses
+import hashlib
 import importlib
+import importlib.metadata
 import logging
 import os
 import sys
 import threading
-from types import ModuleType
-from typing import Any
+import time
+from types import FunctionType, ModuleType
+from typing import Any, Callable, Iterable
 
 from package_proxy import api, PACKAGE_PROXY_API_LOGLEVEL
-from package_proxy.client import ClientModuleFinder
-from .logger import InspectDict
+from package_proxy.client import ClientModuleFinder, _ModuleProxy, proxy_reference
+from .logger import InspectDict, trace_sample
 from ..api import ProxyApi
 
-_IMPORT_LOCK = threading.Lock()
+_MUTATION_LOG_SIZE = 4096
+
+
+def fingerprint_package(package: ModuleType) -> str:
+    """
+    Identifies the code of an imported package by its version, when installed as a distribution,
+    and by the size and mtime of every file under it.
+    """
+    digest = hashlib.sha1()
+    try:
+        digest.update(importlib.metadata.version(package.__name__).encode())
+    except Exception:
+        pass
+    roots = list(getattr(package, "__path__", None) or [os.path.dirname(package.__file__)])
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = sorted(d for d in dirnames if d != "__pycache__")
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                digest.update(f"{os.path.relpath(path, root)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
 
 loglevel = os.environ.get(PACKAGE_PROXY_API_LOGLEVEL, "ERROR")
 level = getattr(logging, loglevel.upper(), logging.ERROR)
 logging.basicConfig(level=level)
 
-class ModuleImportTracker(importlib.abc.MetaPathFinder):
+class ModuleImportTracker:
+    """
+    Moves the modules of the target imported by a thread under the remote prefix once its import is
+    done. It learns them from the ClientModuleFinder bypassed for that thread, which is asked for
+    every module anyway, so the imports made outside of that cost nothing, and the modules imported
+    meanwhile by other threads, the proxies among them, are not mistaken for them.
+    """
 
     _REMOTE_PREFIX = "__remote__"
 
     def __init__(self, target_package_name: str):
-        super().__init__()
         self._target_package_name = target_package_name
-        self._tracked_imports = set()
 
-    def find_spec(self, module_name, path, target=None):
-        if not _IMPORT_LOCK.locked():
-            return None
-        if self.under_root_package(module_name):
-            self._tracked_imports.add(module_name)
-        return None
+    @contextlib.contextmanager
+    def tracking(self, client_finder: ClientModuleFinder):
+        """Imports by this thread in the block go past client_finder, and are then moved"""
+        with client_finder.bypassed() as found:
+            try:
+                yield
+            finally:
+                self.move_tracked_imports_in_sys_modules(found)
 
-    def move_tracked_imports_in_sys_modules(self) -> None:
+    def move_tracked_imports_in_sys_modules(self, tracked_imports: Iterable[str]) -> None:
         if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
-            log_msg = "Moving tracked imports : \n" +'\n'.join(self._tracked_imports)
+            log_msg = "Moving tracked imports : \n" +'\n'.join(tracked_imports)
             logging.debug(log_msg)
 
-        for name in self._tracked_imports:
-            module = sys.modules.pop(name)
+        for name in tracked_imports:
+            # missing when its import failed
+            module = sys.modules.get(name)
+            if module is None or isinstance(module, _ModuleProxy):
+                continue
+            del sys.modules[name]
             sys.modules[self.get_remote_name_for(name)] = module
-        self._tracked_imports.clear()
+
+    @property
+    def root_package_name(self) -> str:
+        return self._target_package_name
 
     def get_remote_name_for(self, module_name: str) -> str:
         return self._REMOTE_PREFIX + module_name
@@ -52,72 +92,384 @@ class ModuleImportTracker(importlib.abc.MetaPathFinder):
         return (module_name == self._target_package_name or
                 module_name.startswith(self._target_package_name + "."))
 
+@dataclasses.dataclass(eq=False)
+class Session:
+    """
+    A client of a LocalApi: the ids it holds, each with the latest request whose response handed it
+    out (see LocalApi.release), and how far it is in the mutation log
+    """
+    held: dict = dataclasses.field(default_factory=dict)
+    epoch: int = 0
+    last_seen: float = dataclasses.field(default_factory=time.monotonic)
+
+
+class _FailedOutcome:
+    def __init__(self, error: Exception) -> None:
+        self.error = error
+
+
 class LocalApi(api.ProxyApi):
+    """
+    ProxyApi running the target package in this interpreter, its modules kept in sys.modules under the
+    remote prefix, next to the proxies standing for them.
+
+    The proxies and the modules share their names, and so their import locks. A thread importing a
+    module of the target while another imports a proxy of one of its submodules would wait for the
+    lock that thread holds, while it waits for the module. So the root package is imported as soon
+    as the api is made, which package_proxy does as it is imported, before any proxy.
+    """
 
     def __init__(self, target_package: str):
-        sys.modules = InspectDict("sys.modules", sys.modules)
-        self._objects = InspectDict("server-dictionary")
+        # traced with PKG_PROXY_TRACE only, plain dictionaries cost nothing extra otherwise
+        self._objects: dict[Any, Any] = {}
+        sample = trace_sample()
+        if sample:
+            sys.modules = InspectDict("sys.modules", sys.modules, sample=sample)
+            self._objects = InspectDict("server-dictionary", sample=sample)
         self._mod_tracker = ModuleImportTracker(target_package)
+        self._client_finder: ClientModuleFinder | None = None
+        # one per module name, so that imports of different modules do not wait for each other
+        self._import_locks: collections.defaultdict[str, threading.Lock] = collections.defaultdict(threading.Lock)
+        self._import_locks_lock = threading.Lock()
         self._index = -1
+        self._free_ids: list[int] = []
+        self._ids_by_identity: dict[int, int] = {}
+        self._ref_counts: dict[int, int] = {}
+        # operations may run concurrently, each thread on behalf of its own session and request
+        self._default_session = Session()
+        self._current = threading.local()
+        # guards the object table and the mutation log
+        self._table_lock = threading.RLock()
+        self._fingerprint: str | None = None
+        self._epoch = 0
+        self._mutations: collections.deque[tuple[int, Any]] = collections.deque(maxlen=_MUTATION_LOG_SIZE)
+        self._mutation_listeners: list[Callable[[Iterable[Any] | None], None]] = []
+        self._install_mod_tracker()
 
+    def _install_mod_tracker(self) -> None:
         assert isinstance(sys.meta_path[0], ClientModuleFinder)
-        sys.meta_path.insert(1, self._mod_tracker)
+        self._client_finder = sys.meta_path[0]
+        self._load_module(self._mod_tracker.root_package_name)
 
-    def get_module(self, module_name) -> int:
+    def get_module(self, module_name, manifest=False) -> Any:
         assert self._mod_tracker.under_root_package(module_name)
+        module = self._load_module(module_name)
+        proxy_id = self._ref_id(module)
+        if manifest:
+            return proxy_id, self._manifest_of(module)
+        return proxy_id
+
+    def _load_module(self, module_name) -> ModuleType:
         remote_name = self._mod_tracker.get_remote_name_for(module_name)
         module = sys.modules.get(remote_name)
         if not module:
             module = self._import_module(module_name)
-        return self._add_object(module)
+        return module
+
+    def _manifest_of(self, module: ModuleType) -> ProxyApi.Manifest:
+        entries = {}
+        for name, attr in list(vars(module).items()):
+            if name.startswith("__"):
+                continue
+            if isinstance(attr, type):
+                entries[name] = ProxyApi.ManifestEntry("type", attr, self._ref_id(attr))
+            elif callable(attr):
+                entries[name] = ProxyApi.ManifestEntry("callable", attr)
+            elif isinstance(attr, ModuleType):
+                entries[name] = ProxyApi.ManifestEntry("constant", attr)
+            else:
+                entries[name] = ProxyApi.ManifestEntry("constant")
+        for name in ("__package__", "__path__"):
+            if getattr(module, name, None) is not None:
+                entries[name] = ProxyApi.ManifestEntry("constant", getattr(module, name))
+        return ProxyApi.Manifest(entries, getattr(module, "__all__", None))
 
     def get_attr(self, proxy_id, item) -> ProxyApi.AttrWrapper:
-        obj = self._objects[proxy_id]
+        obj = self._resolve(proxy_id)
+        return self._attr_sent(self._get_attr_of(obj, item), item, obj)
+
+    def _get_attr_of(self, obj, item) -> ProxyApi.AttrWrapper:
         if item == "__dict__":
             return ProxyApi.AttrWrapper(obj.__dict__)
         try:
             attr = getattr(obj, item)
             api_attr = ProxyApi.AttrWrapper(attr)
             if isinstance(attr, type):
-                proxy_id = self._add_object(attr)
-                api_attr.proxy_id = proxy_id
+                api_attr.proxy_id = self._ref_id(attr)
             return api_attr
         except AttributeError:
             raise
 
     def set_attr(self, proxy_id, key, value):
-        obj = self._objects[proxy_id]
-        return setattr(obj, key, value)
+        obj = self._resolve(proxy_id)
+        value = self._dereference(value)
+        try:
+            return setattr(obj, key, value)
+        finally:
+            self._mutated(proxy_id)
 
     def create_object(self, cls_id: int, *args: Any, **kwargs: Any) -> int:
-        cls = self._objects[cls_id]
-        new_obj = cls(*args, **kwargs)
+        cls = self._resolve(cls_id)
+        new_obj = cls(*self._dereference(args), **self._dereference(kwargs))
         return self._add_object(new_obj)
 
     def call(self, proxy_id: int, func_name: str, *args: Any, **kwargs: Any) -> Any:
-        obj = self._objects[proxy_id]
-        return getattr(obj, func_name)(*args, **kwargs)
+        obj = self._resolve(proxy_id)
+        args, kwargs = self._dereference(args), self._dereference(kwargs)
+        try:
+            return self._sent(getattr(obj, func_name)(*args, **kwargs), func_name, obj)
+        finally:
+            # calls may change anything, their arguments, or the receiver of a method of a class
+            self._mutated(None)
+
+    def batch(self, ops: list[ProxyApi.Op]) -> list[ProxyApi.Result]:
+        """
+        On top of the default batch, an op can target the outcome of an earlier op of the same batch
+        through a ProxyApi.Promise, so a chain like mod.C1_1().method1() is resolved entirely on this
+        side. Pipelined ops keep their outcome here and return an empty Result.
+        """
+        outcomes: list[Any] = []
+        results = []
+        for op in ops:
+            try:
+                outcome, value = self._run_op(op, outcomes)
+                results.append(ProxyApi.Result(None if op.pipelined else value))
+            except Exception as e:
+                outcome = _FailedOutcome(e)
+                results.append(ProxyApi.Result(error=e))
+            outcomes.append(outcome)
+        return results
+
+    def _run_op(self, op: ProxyApi.Op, outcomes: list[Any]) -> tuple[Any, Any]:
+        """Returns the server side outcome of the op, for promises, and the value to send back"""
+        if op.name == "get_module":
+            value = self.get_module(*op.args, **op.kwargs)
+            proxy_id = value[0] if isinstance(value, tuple) else value
+            return self._resolve(proxy_id), value
+        if op.name == "release":
+            return None, self.release(*op.args, **op.kwargs)
+
+        target_id, *args = op.args
+        if isinstance(target_id, ProxyApi.Promise):
+            target = outcomes[target_id.index]
+            if isinstance(target, _FailedOutcome):
+                raise target.error
+            # the object has no id the client could know it by
+            target_id = None
+        else:
+            target = self._resolve(target_id)
+        args, kwargs = self._dereference(args), self._dereference(op.kwargs)
+
+        if op.name == "get_attr":
+            api_attr = self._get_attr_of(target, *args)
+            outcome = api_attr.attr
+            return outcome, self._attr_sent(api_attr, *args, target)
+        if op.name == "set_attr":
+            try:
+                return None, setattr(target, *args)
+            finally:
+                self._mutated(target_id)
+        if op.name == "create_object":
+            new_obj = target(*args, **kwargs)
+            return new_obj, None if op.pipelined else self._add_object(new_obj)
+        if op.name == "call":
+            func_name, *args = args
+            try:
+                result = getattr(target, func_name)(*args, **kwargs)
+            finally:
+                self._mutated(None)
+            return result, self._sent(result, func_name, target)
+        raise ValueError(f"unsupported operation {op.name!r}")
+
+    def release(self, proxy_ids: Iterable[Any], seen: int | None = None) -> None:
+        """
+        `seen` is the request of the session up to which the client had decoded every response when
+        releasing. Ids handed out again by a later response are kept, the client releases them
+        again once it is done with that one too.
+        """
+        with self._table_lock:
+            held = self._session.held
+            for proxy_id in proxy_ids:
+                if proxy_id not in held:
+                    # symbols, and ids released already
+                    continue
+                if seen is not None and held[proxy_id] > seen:
+                    continue
+                del held[proxy_id]
+                self._ref_counts[proxy_id] -= 1
+                if self._ref_counts[proxy_id]:
+                    continue
+                del self._ref_counts[proxy_id]
+                obj = self._objects.pop(proxy_id)
+                del self._ids_by_identity[id(obj)]
+                self._free_ids.append(proxy_id)
+                # the id will be handed out for another object, values cached for it are no longer valid
+                self._mutated(proxy_id)
+
+    @contextlib.contextmanager
+    def session(self, session: Session, request_id: int = 0):
+        """
+        Runs the operations made by this thread in the block on behalf of a client other than the
+        default one, answering its request `request_id`
+        """
+        previous = getattr(self._current, "session", None), getattr(self._current, "request_id", 0)
+        self._current.session, self._current.request_id = session, request_id
+        try:
+            yield session
+        finally:
+            self._current.session, self._current.request_id = previous
+
+    @property
+    def _session(self) -> Session:
+        return getattr(self._current, "session", None) or self._default_session
+
+    def close_session(self, session: Session) -> None:
+        """Releases everything a client held, once it is gone"""
+        with self.session(session):
+            self.release(list(session.held))
+
+    def add_mutation_listener(self, listener: Callable[[Iterable[Any] | None], None]) -> bool:
+        self._mutation_listeners.append(listener)
+        return True
+
+    def mutations_since(self, epoch: int) -> tuple[int, set[Any] | None]:
+        """
+        Returns the current mutation epoch and the ids of the objects mutated after `epoch`, or None
+        when that is unknown and anything may have changed.
+        """
+        with self._table_lock:
+            if epoch == self._epoch:
+                return epoch, set()
+            if not self._mutations or self._mutations[0][0] > epoch + 1:
+                return self._epoch, None
+            mutated = set()
+            for mutation_epoch, proxy_id in reversed(self._mutations):
+                if mutation_epoch <= epoch:
+                    break
+                if proxy_id is None:
+                    return self._epoch, None
+                mutated.add(proxy_id)
+            return self._epoch, mutated
+
+    def _mutated(self, proxy_id: Any) -> None:
+        """Records a possible change to an object, None standing for one without an id"""
+        with self._table_lock:
+            self._epoch += 1
+            self._mutations.append((self._epoch, proxy_id))
+        for listener in self._mutation_listeners:
+            listener(None if proxy_id is None else (proxy_id,))
+
+    def get_fingerprint(self) -> str:
+        if self._fingerprint is None:
+            root = self._load_module(self._mod_tracker.root_package_name)
+            self._fingerprint = fingerprint_package(root)
+        return self._fingerprint
+
+    def _resolve(self, proxy_id) -> Any:
+        if isinstance(proxy_id, ProxyApi.Symbol):
+            obj = self._module_named(proxy_id.module)
+            for name in filter(None, proxy_id.qualname.split(".")):
+                obj = getattr(obj, name)
+            return obj
+        return self._objects[proxy_id]
+
+    def _sent(self, value: Any, name: str, owner: Any) -> Any:
+        """
+        Hook deciding how the value of the attribute or the result of the method `name` of owner is
+        handed back. In process, the object itself is.
+        """
+        return value
+
+    def _attr_sent(self, api_attr: ProxyApi.AttrWrapper, name: str, owner: Any) -> ProxyApi.AttrWrapper:
+        if api_attr.proxy_id is None:
+            api_attr.attr = self._sent(api_attr.attr, name, owner)
+        return api_attr
+
+    def _dereference(self, value: Any) -> Any:
+        """
+        Replaces the proxies found in the arguments of an operation, and in the builtin containers
+        among them, by the objects they stand for. Containers are copied only when they hold one.
+        """
+        reference = proxy_reference(value)
+        if reference is not None:
+            proxy_id, attr = reference
+            obj = self._resolve(proxy_id)
+            return obj if attr is None else getattr(obj, attr)
+        value_type = type(value)
+        if value_type in (tuple, list, set, frozenset):
+            items = [self._dereference(item) for item in value]
+            if any(new is not old for new, old in zip(items, value)):
+                return value_type(items)
+        elif value_type is dict:
+            items = [(self._dereference(k), self._dereference(v)) for k, v in value.items()]
+            if any(new_k is not k or new_v is not v for (new_k, new_v), (k, v) in zip(items, value.items())):
+                return dict(items)
+        return value
+
+    def _module_named(self, module_name: str) -> ModuleType:
+        if self._mod_tracker.under_root_package(module_name):
+            return self._load_module(module_name)
+        return importlib.import_module(module_name)
+
+    def _ref_id(self, obj: Any) -> Any:
+        """
+        Modules, types and functions reachable by name get a ProxyApi.Symbol, which stays valid across
+        sessions and does not grow the object table. Anything else is added to the table.
+        """
+        if isinstance(obj, ModuleType):
+            symbol = ProxyApi.Symbol(obj.__name__)
+        elif isinstance(obj, (type, FunctionType)) and "<locals>" not in obj.__qualname__:
+            symbol = ProxyApi.Symbol(obj.__module__, obj.__qualname__)
+        else:
+            return self._add_object(obj)
+        try:
+            if self._resolve(symbol) is obj:
+                return symbol
+        except Exception:
+            pass
+        return self._add_object(obj)
+
+    def _table_id(self, obj: Any) -> Any:
+        """The id of the object in the table, None if not in it"""
+        return self._ids_by_identity.get(id(obj))
 
     def _add_object(self, obj: Any) -> Any:
-        self._index += 1
-        self._objects[self._index] = obj
-        return self._index
+        """
+        Returns the id of the object in the table, adding it the first time. The current session
+        then holds the id until it releases it, and the object is dropped once no session does.
+        """
+        with self._table_lock:
+            proxy_id = self._ids_by_identity.get(id(obj))
+            if proxy_id is None:
+                if self._free_ids:
+                    proxy_id = self._free_ids.pop()
+                else:
+                    self._index += 1
+                    proxy_id = self._index
+                self._objects[proxy_id] = obj
+                self._ids_by_identity[id(obj)] = proxy_id
+                self._ref_counts[proxy_id] = 0
+            held = self._session.held
+            if proxy_id not in held:
+                self._ref_counts[proxy_id] += 1
+            held[proxy_id] = max(held.get(proxy_id, 0), getattr(self._current, "request_id", 0))
+            return proxy_id
 
     def _import_module(self, name: str) -> ModuleType:
         """
-        Removes the client module finder and allows the rest of the metapath chain do its job,
-        while keeping record of all the imported modules that are relevant, by inserting itself
-        as the first element in that chain in order to collect that info and forward the resolution
-        to others.
+        Lets the import of the module go past the client module finder, for this thread only, and
+        through the rest of the metapath chain, the finder keeping record of all the modules of the
+        target it imports.
         At the end, when the import machinery returns, uses that record to rename the key under
-        which those modules are found in sys.module and puts the client module finder at the
-        start of the chain.
+        which those modules are found in sys.module.
+        Imports of different modules run concurrently, those of the same module wait for the first.
         """
-        with _IMPORT_LOCK :
-            package_proxy_mod_finder = sys.meta_path.pop(0)
-            assert isinstance(package_proxy_mod_finder, ClientModuleFinder)
-            try:
+        with self._import_locks_lock:
+            lock = self._import_locks[name]
+        with lock:
+            # imported by another thread while waiting for the lock
+            module = sys.modules.get(self._mod_tracker.get_remote_name_for(name))
+            if module is not None:
+                return module
+            with self._mod_tracker.tracking(self._client_finder):
                 return importlib.import_module(name)
-            finally:
-                self._mod_tracker.move_tracked_imports_in_sys_modules()
-                sys.meta_path.insert(0, package_proxy_mod_finder)
@@ -1,14 +1,44 @@
-import inspect
+import atexit
+import collections
 import logging
 import os
+import sys
 
-from package_proxy import PACKAGE_PROXY_API_LOGLEVEL
+from package_proxy import PACKAGE_PROXY_API_LOGLEVEL, PACKAGE_PROXY_TRACE
 
 loglevel = os.environ.get(PACKAGE_PROXY_API_LOGLEVEL, "ERROR")
 level = getattr(logging, loglevel.upper(), logging.ERROR)
 logging.basicConfig(level=level)
 
+
+def trace_sample() -> int:
+    """
+    1 in how many accesses InspectDicts trace, from PKG_PROXY_TRACE: "full" for all of them, a
+    number N for 1 in N. 0 when tracing is off, the default.
+    """
+    trace = os.environ.get(PACKAGE_PROXY_TRACE) or "off"
+    if trace == "off":
+        return 0
+    if trace == "full":
+        return 1
+    try:
+        sample = int(trace)
+    except ValueError:
+        sample = 0
+    if sample < 1:
+        raise ValueError(f"{PACKAGE_PROXY_TRACE} must be 'off', 'full' or a positive number, got {trace!r}")
+    return sample
+
+
 class InspectDict(dict):
+    """
+    Dictionary counting the accesses made to it per calling module and action, e.g. to find out
+    which code looks up sys.modules the most. The counts are logged at INFO level at exit.
+
+    Only 1 in `sample` accesses is traced, the others cost a countdown. The countdown is not
+    synchronised, concurrent accesses only make the sampling less regular. `on_write`, when given,
+    is called for every traced access as well, with the caller's module and line number.
+    """
 
     ignore_contains = [
         "django.utils",
@@ -27,70 +57,56 @@ class InspectDict(dict):
         "warnings"
     ]
 
-    def __init__(self, name, source=None, on_write=None):
+    def __init__(self, name, source=None, on_write=None, sample=1):
         self._target = source if source is not None else {}
         self.logger = logging.getLogger(name)
-        self._on_write = on_write if on_write is not None else \
-            lambda action, key, value, mod=None, lineno=None: \
-                self.logger.debug(f"[{mod}:{lineno}] {action} {key} {value} {type(value)}")
+        self._on_write = on_write
+        self._sample = self._countdown = sample
+        # (calling module, action) -> traced accesses
+        self.counts = collections.Counter()
+        atexit.register(self.log_counts)
 
-    def _notify(self, action, key=None, value=None, mod=None, lineno=None):
-        if callable(self._on_write):
-            try:
-                # forward the captured module and line number to the callback
-                self._on_write(action, key, value, mod=mod, lineno=lineno)
-            except Exception:
-                pass
+    def log_counts(self) -> None:
+        if self.counts and self.logger.isEnabledFor(logging.INFO):
+            lines = [f"{count:>8} {mod} {action}" for (mod, action), count in self.counts.most_common()]
+            self.logger.info(f"accesses traced, 1 in {self._sample}:\n" + "\n".join(lines))
 
     # Mapping Interface Methods
 
     def __getitem__(self, key):
-        if key in self.ignore_contains:
-            return self._target.__getitem__(key)
-        def fn(mod=None, lineno=None):
-            self._notify('__getitem__', key, None, mod, lineno)
-            return self._target.__getitem__(key)
-        return self._trace(fn)
+        if key not in self.ignore_contains and self._sampled():
+            self._trace('__getitem__', key)
+        return self._target.__getitem__(key)
 
     def __setitem__(self, key, value):
-        def fn(mod=None, lineno=None):
-            self._notify('__setitem__', key, value, mod, lineno)
-            self._target.__setitem__(key, value)
-        return self._trace(fn)
+        if self._sampled():
+            self._trace('__setitem__', key, value)
+        self._target.__setitem__(key, value)
 
     def __delitem__(self, key):
-        def fn(mod=None, lineno=None):
-            self._notify('__delitem__', key, None, mod, lineno)
-            self._target.__delitem__(key)
-        return self._trace(fn)
+        if self._sampled():
+            self._trace('__delitem__', key)
+        self._target.__delitem__(key)
 
     def __iter__(self):
-        def fn(mod=None, lineno=None):
-            self._notify('__iter__', None, None, mod, lineno)
-            return self._target.__iter()
-        return self._trace(fn)
+        if self._sampled():
+            self._trace('__iter__')
+        return self._target.__iter__()
 
     def __len__(self):
-        def fn(mod=None, lineno=None):
-            self._notify('__len__', None, None, mod, lineno)
-            return self._target.__len__()
-        return self._trace(fn)
+        if self._sampled():
+            self._trace('__len__')
+        return self._target.__len__()
 
     def __contains__(self, key):
-        if key in self.ignore_contains:
-            return self._target.__contains__(key)
-        def fn(mod=None, lineno=None):
-            self._notify('__contains__', key, None, mod, lineno)
-            return self._target.__contains__(key)
-        return self._trace(fn)
+        if key not in self.ignore_contains and self._sampled():
+            self._trace('__contains__', key)
+        return self._target.__contains__(key)
 
     def get(self, key, default=None):
-        if key in self.ignore_contains:
-            return self._target.get(key, default)
-        def fn(mod=None, lineno=None):
-            self._notify('get', key, default, mod, lineno)
-            return self._target.get(key, default)
-        return self._trace(fn)
+        if key not in self.ignore_contains and self._sampled():
+            self._trace('get', key, default)
+        return self._target.get(key, default)
 
     def items(self):
         return self._target.items()
@@ -102,53 +118,49 @@ class InspectDict(dict):
         return self._target.values()
 
     def setdefault(self, key, default=None):
-        def fn(mod=None, lineno=None):
-            self._notify('setdefault', key, default, mod, lineno)
-            return self._target.setdefault(key, default)
-        return self._trace(fn)
+        if self._sampled():
+            self._trace('setdefault', key, default)
+        return self._target.setdefault(key, default)
 
     def update(self, *args, **kwargs):
-        def fn(mod=None, lineno=None):
-            items = dict(*args, **kwargs)
-            self._notify('update', None, items.items(), mod, lineno)
-            self._target.update(items)
-        return self._trace(fn)
+        items = dict(*args, **kwargs)
+        if self._sampled():
+            self._trace('update', None, items.items())
+        self._target.update(items)
 
     def pop(self, key, *args):
-        def fn(mod=None, lineno=None):
-            self._notify('pop', key, None, mod, lineno)
-            return self._target.pop(key, *args)
-        return self._trace(fn)
+        if self._sampled():
+            self._trace('pop', key)
+        return self._target.pop(key, *args)
 
     def popitem(self):
-        def fn(mod=None, lineno=None):
-            self._notify('popitem', None, None, mod, lineno)
-            return self._target.popitem()
-        return self._trace(fn)
+        if self._sampled():
+            self._trace('popitem')
+        return self._target.popitem()
 
     def clear(self):
-        def fn(mod=None, lineno=None):
-            self._notify('clear', None, None, mod, lineno)
-            self._target.clear()
-        return self._trace(fn)
-
-    def _trace(self, fn):
-        frame = inspect.currentframe()
+        if self._sampled():
+            self._trace('clear')
+        self._target.clear()
+
+    def _sampled(self) -> bool:
+        self._countdown -= 1
+        if self._countdown > 0:
+            return False
+        self._countdown = self._sample
+        return True
+
+    def _trace(self, action, key=None, value=None):
+        # the frame calling the mapping method, avoiding inspect to not re-enter module dicts
+        caller = sys._getframe(2)
         try:
-            # get the frame one level above the current caller (parent of caller)
-            caller = frame.f_back.f_back if frame is not None and frame.f_back is not None else None
-            mod = None
-            lineno = None
-            if caller is not None:
-                # avoid inspect.getframeinfo() to prevent re-entering module dicts
-                try:
-                    mod = caller.f_globals.get('__name__', caller.f_code.co_filename)
-                except Exception:
-                    mod = getattr(caller.f_code, 'co_filename', None)
-                lineno = getattr(caller, 'f_lineno', None)
-            return fn(mod, lineno)
-        finally:
-            # break reference cycles
-            del frame
-            if 'caller' in locals():
-                del caller
\ No newline at end of file
+            mod = caller.f_globals.get('__name__', caller.f_code.co_filename)
+        except Exception:
+            mod = getattr(caller.f_code, 'co_filename', None)
+        self.counts[(mod, action)] += 1
+        if self._on_write is not None:
+            try:
+                self._on_write(action, key, value, mod=mod, lineno=caller.f_lineno)
+            except Exception:
+                pass
+        del caller
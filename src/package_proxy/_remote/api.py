@@ -0,0 +1,761 @@
+from __future__ import annotations
+
+import asyncio
+import atexit
+import contextlib
+import functools
+import importlib
+import io
+import itertools
+import os
+import pickle
+import platform
+import threading
+import time
+import warnings
+import weakref
+from typing import Any, Callable, Iterable
+
+from package_proxy import (PACKAGE_PROXY_ADDRESS, PACKAGE_PROXY_SCHEMA_CACHE, PACKAGE_PROXY_SHARED_MEMORY,
+                           PACKAGE_PROXY_TIMEOUT, PACKAGE_PROXY_TRANSPORT, PACKAGE_PROXY_WRITE_BEHIND)
+from package_proxy.client import TypeProxyBuilder, _ModuleProxy, proxy_reference
+from . import ring, shared_buffers, wire
+from .schema_cache import SchemaCache
+from .shared_buffers import SharedBuffers
+from ..api import AsyncProxyApi, DeadlineExceeded, ProxyApi, deadline as current_deadline, special_methods
+
+
+class RemoteApi(ProxyApi):
+    """
+    ProxyApi talking to a package_proxy server (see package_proxy.server) over a unix or tcp socket,
+    whose address is read from PKG_PROXY_ADDRESS.
+
+    When PKG_PROXY_SCHEMA_CACHE names a directory, module manifests are kept there across runs
+    (see SchemaCache).
+
+    When PKG_PROXY_WRITE_BEHIND is set, set_attr does not wait for the server. Pending writes are
+    coalesced per object, the last value of an attribute winning, and sent in a single batch before
+    any other request or at a barrier(). The error of a failed write is raised by the next
+    barrier(), not by the request that happened to flush it, which is carried out as usual, and the
+    other writes of the batch still apply.
+    Values are pickled at flush time, so mutable values changed after being assigned are sent as
+    they are then.
+
+    The ids the server hands out are released once the proxies holding them are garbage collected,
+    piggybacked on a later request. A daemon thread keeps the lease of the connection alive, see
+    ProxyServer.
+
+    It can be used from any number of threads. Their requests share the connection, each waiting
+    for its own response only, so that a slow call does not hold back the others.
+
+    Requests made within api.timeout(), or with PKG_PROXY_TIMEOUT=<seconds> set, have a deadline.
+    The server skips them if it is over before they start, and the client stops waiting for them
+    then, raising DeadlineExceeded and cancelling them on the server. Requests are also cancelled
+    when the asyncio task awaiting them is. A call already running on the server runs to the end, and
+    its response is decoded all the same, for the ids it hands out to be released.
+
+    When the server runs on the same host, PKG_PROXY_SHARED_MEMORY=<min size> has buffers of at
+    least that many bytes go through shared memory rather than the socket, both ways (see
+    shared_buffers), and PKG_PROXY_TRANSPORT=ring has all frames go through rings in shared memory,
+    sparing the system calls of the socket (see ring). The default transport is "socket".
+    """
+
+    def __init__(self, target_package: str):
+        address = os.environ.get(PACKAGE_PROXY_ADDRESS)
+        if address is None:
+            raise ImportError(f"No proxy server address defined in {PACKAGE_PROXY_ADDRESS}")
+        self._target_package = target_package
+        timeout = os.environ.get(PACKAGE_PROXY_TIMEOUT)
+        self._timeout = float(timeout) if timeout else None
+        shared_min_size = os.environ.get(PACKAGE_PROXY_SHARED_MEMORY)
+        self._shared = SharedBuffers(int(shared_min_size)) if shared_min_size else None
+        sock = wire.connect(address)
+        rings = self._create_rings(sock, os.environ.get(PACKAGE_PROXY_TRANSPORT, "socket"))
+        wire.send_frame(sock, wire.HELLO_ID,
+                        wire.dumps_hello(self._shared.min_size if self._shared is not None else None,
+                                         rings.path if rings is not None else None))
+        self._channel = rings if rings is not None else wire.SocketChannel(sock)
+        # requests are sent one at a time, and several can wait for their response, see _receive
+        self._send_lock = threading.Lock()
+        self._recv_lock = threading.Lock()
+        self._slots: dict[int, _Slot] = {}
+        self._slots_lock = threading.Lock()
+        self._request_ids = itertools.count(1)
+        # reads all responses once asyncio code is waiting for some, see _AsyncRemoteApi
+        self._reader: threading.Thread | None = None
+        self._asynchronous: _AsyncRemoteApi | None = None
+        self._flush_lock = threading.Lock()
+        self._stand_ins: dict[tuple[str, str], type] = {}
+        self._proxy_types: dict[type, type] = {}
+        self._mutation_listeners: list[Callable[[Iterable[Any] | None], None]] = []
+        self._write_behind = bool(os.environ.get(PACKAGE_PROXY_WRITE_BEHIND))
+        self._pending_writes: dict[Any, dict[str, Any]] = {}
+        # errors of the writes flushed since the last barrier()
+        self._write_errors: list[Exception] = []
+        self._pending_lock = threading.Lock()
+        if self._write_behind:
+            atexit.register(self.barrier)
+        # proxies per id, and ids about to get one, see create_object
+        self._holders: dict[Any, int] = {}
+        self._pins: dict[Any, int] = {}
+        self._refs_lock = threading.Lock()
+        # ids of proxies garbage collected, and ids to release with the last request sent then
+        self._released: list[Any] = []
+        self._releasable: dict[Any, int] = {}
+        self._last_sent = 0
+        # every response up to the watermark was decoded, and those in _done after it
+        self._watermark = 0
+        self._done: set[int] = set()
+        self._last_request = time.monotonic()
+
+        cache_dir = os.environ.get(PACKAGE_PROXY_SCHEMA_CACHE)
+        self._schema_cache = SchemaCache(cache_dir, target_package) if cache_dir else None
+
+        # from the start, as the modules and types imported are only valid as long as the connection
+        self._keep_alive = threading.Thread(target=self._renew_lease, name="lease", daemon=True)
+        self._keep_alive.start()
+
+    def get_module(self, fullname: str, manifest: bool = False) -> Any:
+        if not manifest or self._schema_cache is None:
+            return self._request("get_module", fullname, manifest=manifest)
+
+        payload = self._schema_cache.load(fullname)
+        if payload is not None:
+            self._schema_cache.check(self.get_fingerprint)
+            return self._decode(payload, cached=True)
+
+        request_id, payload = self._roundtrip("get_module", fullname, manifest=True)
+        try:
+            proxy_id, module_manifest = self._decode(payload)
+        finally:
+            self._decoded(request_id)
+        if _is_symbolic(proxy_id, module_manifest) and not shared_buffers.mentioned_in(payload):
+            self._schema_cache.store(fullname, payload, self.get_fingerprint)
+        return proxy_id, module_manifest
+
+    def get_attr(self, proxy_id: int, item: str) -> ProxyApi.AttrWrapper:
+        return self._request("get_attr", proxy_id, item)
+
+    def set_attr(self, proxy_id: int, key: str, value: Any) -> Any:
+        if not self._write_behind:
+            return self._request("set_attr", proxy_id, key, value)
+        with self._pending_lock:
+            writes = self._pending_writes.setdefault(proxy_id, {})
+            # the last write of an attribute takes the place of the earlier ones
+            writes.pop(key, None)
+            writes[key] = value
+        # values read before the write are stale already
+        for listener in self._mutation_listeners:
+            listener((proxy_id,))
+
+    def create_object(self, cls_id: int, *args: Any, **kwargs: Any) -> int:
+        request_id, payload = self._roundtrip("create_object", cls_id, *args, **kwargs)
+        try:
+            proxy_id = self._decode(payload)
+            # held for the proxy about to be made for it, see hold
+            self._pin(proxy_id)
+            return proxy_id
+        finally:
+            self._decoded(request_id)
+
+    def call(self, proxy_id: int, func_name: str, *args: Any, **kwargs: Any) -> Any:
+        return self._request("call", proxy_id, func_name, *args, **kwargs)
+
+    def release(self, proxy_ids: Iterable[int]) -> None:
+        return self._request("release", list(proxy_ids))
+
+    def batch(self, ops: list[ProxyApi.Op]) -> list[ProxyApi.Result]:
+        return self._request("batch", ops)
+
+    def get_fingerprint(self) -> str:
+        return self._request("get_fingerprint")
+
+    def server_stats(self) -> dict[str, Any] | None:
+        """The queue depth and worker utilisation of the server process serving this connection"""
+        return self._request("stats")
+
+    def barrier(self) -> None:
+        self._flush()
+        with self._pending_lock:
+            errors, self._write_errors = self._write_errors, []
+        if errors:
+            raise errors[0]
+
+    def _flush(self) -> None:
+        """Sends the pending writes, keeping their errors for barrier()"""
+        if not self._pending_writes and not self._flush_lock.locked():
+            return
+        # held until the writes are done, so that requests made meanwhile, from any thread, wait
+        # for them rather than overtake them
+        with self._flush_lock:
+            with self._pending_lock:
+                pending, self._pending_writes = self._pending_writes, {}
+            if not pending:
+                return
+            ops = [ProxyApi.Op("set_attr", (proxy_id, key, value))
+                   for proxy_id, writes in pending.items() for key, value in writes.items()]
+            request_id, payload = self._send("batch", (ops,), {})
+            try:
+                errors = [result.error for result in self._decode(payload) if result.error is not None]
+            except Exception as e:
+                # the batch as a whole, e.g. turned away by an overloaded server
+                errors = [e]
+            finally:
+                self._decoded(request_id)
+        if errors:
+            with self._pending_lock:
+                self._write_errors.extend(errors)
+
+    def hold(self, proxy: Any, proxy_id: Any) -> None:
+        if isinstance(proxy_id, ProxyApi.Symbol) or proxy_id is None:
+            return
+        try:
+            weakref.finalize(proxy, self._released.append, proxy_id)
+        except TypeError:
+            # not weak referenceable, the id is held until the connection closes
+            return
+        with self._refs_lock:
+            if self._pins.get(proxy_id):
+                # the proxy takes over the hold of create_object
+                self._pins[proxy_id] -= 1
+            else:
+                self._holders[proxy_id] = self._holders.get(proxy_id, 0) + 1
+                # handed out again before its release was sent
+                self._releasable.pop(proxy_id, None)
+
+    def asynchronous(self) -> AsyncProxyApi:
+        if self._asynchronous is None:
+            self._asynchronous = _AsyncRemoteApi(self)
+        return self._asynchronous
+
+    def add_mutation_listener(self, listener: Callable[[Iterable[Any] | None], None]) -> bool:
+        self._mutation_listeners.append(listener)
+        return True
+
+    def close(self) -> None:
+        try:
+            self.barrier()
+        finally:
+            self._channel.close()
+            if self._shared is not None:
+                self._shared.close()
+
+    def _request(self, op: str, *args: Any, **kwargs: Any) -> Any:
+        request_id, payload = self._roundtrip(op, *args, **kwargs)
+        try:
+            return self._decode(payload)
+        finally:
+            self._decoded(request_id)
+
+    def _roundtrip(self, op: str, *args: Any, **kwargs: Any) -> tuple[int, bytes]:
+        # pending writes go first, whatever the request may observe of them
+        self._flush()
+        return self._send(op, args, kwargs)
+
+    def _send(self, op: str, args: tuple, kwargs: dict) -> tuple[int, bytes]:
+        """
+        Sends a request and waits for its response, returning its request id along with it. Once it
+        returns, the caller calls _decoded() when done turning the response into proxies, whether
+        that succeeds or not.
+        """
+        deadline = self._deadline()
+        slot = _Slot()
+        request_id = self._post(op, args, kwargs, slot, deadline)
+        try:
+            if deadline is None:
+                return request_id, self._receive(slot)
+            return request_id, self._await(slot, deadline)
+        except DeadlineExceeded:
+            # given up on, done with once its response is, see _abandon
+            raise
+        except BaseException:
+            self._decoded(request_id)
+            raise
+
+    def _deadline(self) -> float | None:
+        """The deadline of a request made now, see api.timeout and PKG_PROXY_TIMEOUT"""
+        deadline = current_deadline()
+        if self._timeout is None:
+            return deadline
+        default = time.monotonic() + self._timeout
+        return default if deadline is None else min(deadline, default)
+
+    def _post(self, op: str, args: tuple, kwargs: dict, slot: _Slot, deadline: float | None = None) -> int:
+        """Sends a request, whose response is to be put in slot"""
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise DeadlineExceeded(f"deadline of {op!r} passed before it was sent")
+        # pickled before taking the send lock, so that large arguments do not hold back the requests
+        # of other threads, and pickling hooks calling back into the api do not deadlock
+        released, seen = self._take_released()
+        try:
+            payload = wire.dumps_request(op, args, kwargs, released, seen, timeout, proxy_reference,
+                                         self._shared)
+        except BaseException:
+            with self._refs_lock:
+                self._releasable.update(dict.fromkeys(released, 0))
+            raise
+        with self._send_lock:
+            request_id = slot.request_id = next(self._request_ids)
+            slot.op = op
+            with self._slots_lock:
+                self._slots[request_id] = slot
+            self._last_request = time.monotonic()
+            self._last_sent = request_id
+            try:
+                self._channel.send_frame(request_id, payload)
+            except BaseException as e:
+                self._fail(e)
+                self._decoded(request_id)
+                raise
+        return request_id
+
+    def _receive(self, slot: _Slot) -> bytes:
+        """
+        Waits for the response of a request. Responses are read by whichever waiting thread gets
+        _recv_lock first, and handed to the threads they are for. That thread hands the reading over
+        to another waiting thread once it has its own response.
+        """
+        while slot.payload is None and slot.error is None:
+            if not self._recv_lock.acquire(blocking=False):
+                slot.event.wait()
+                slot.event.clear()
+                continue
+            try:
+                while slot.payload is None and slot.error is None and self._dispatch():
+                    pass
+            finally:
+                self._recv_lock.release()
+                with self._slots_lock:
+                    waiting = next(iter(self._slots.values()), None)
+                if waiting is not None:
+                    # to read the next responses
+                    waiting.event.set()
+        if slot.error is not None:
+            raise slot.error
+        return slot.payload
+
+    def _await(self, slot: _Slot, deadline: float) -> bytes:
+        """
+        Waits for the response of a request until deadline, then gives up on it and cancels it. The
+        responses are read by the thread of _read_responses meanwhile.
+        """
+        self._start_reader()
+        while slot.payload is None and slot.error is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 and self._abandon(slot):
+                raise DeadlineExceeded(f"no response to request {slot.request_id} before its deadline")
+            slot.event.wait(max(remaining, 0))
+            slot.event.clear()
+        if slot.error is not None:
+            raise slot.error
+        return slot.payload
+
+    def _abandon(self, slot: _Slot) -> bool:
+        """
+        Stops waiting for the response of a request, and has the server drop it if not started yet.
+        If it runs anyway, its response is still decoded, for the ids it hands out to be released.
+        The request is done with (see _decoded) once that is, or once the server dropped it, and
+        the caller is not to call _decoded for it. False if the response came already.
+        """
+        late = _Slot(self._decode_late)
+        with self._slots_lock:
+            if self._slots.get(slot.request_id) is not slot:
+                return False
+            late.request_id, late.op = slot.request_id, slot.op
+            self._slots[slot.request_id] = late
+        cancel = _Slot(functools.partial(self._cancelled, late))
+        try:
+            # not waited for, see _cancelled
+            self._post("cancel", ([slot.request_id],), {}, cancel)
+        except Exception:
+            # the connection is gone, and the request with it
+            self._forget(late)
+        return True
+
+    def _cancelled(self, late: _Slot, answered: _Slot) -> None:
+        """Called with the response to the cancel of the request of late, see _abandon"""
+        try:
+            if answered.payload is not None and late.request_id in self._decode(answered.payload):
+                # dropped by the server, no response will come
+                self._forget(late)
+        except Exception:
+            pass
+        finally:
+            self._decoded(answered.request_id)
+
+    def _decode_late(self, late: _Slot) -> None:
+        if late.payload is None:
+            # the connection is gone
+            self._decoded(late.request_id)
+            return
+        # away from the thread reading the responses, as decoding may import modules of the target,
+        # and wait for responses of its own
+        threading.Thread(target=self._drop_response, args=(late,), name="late response", daemon=True).start()
+
+    def _drop_response(self, late: _Slot) -> None:
+        try:
+            with contextlib.suppress(Exception):
+                value = self._decode(late.payload)
+                if late.op == "create_object":
+                    # an id with no proxy to hold it, let go of as one would, see hold
+                    with self._refs_lock:
+                        self._holders[value] = self._holders.get(value, 0) + 1
+                        self._releasable.pop(value, None)
+                    self._released.append(value)
+        finally:
+            self._decoded(late.request_id)
+
+    def _forget(self, late: _Slot) -> None:
+        """Done with an abandoned request whose response will not come"""
+        with self._slots_lock:
+            if self._slots.get(late.request_id) is not late:
+                # came or failed meanwhile
+                return
+            del self._slots[late.request_id]
+        self._decoded(late.request_id)
+
+    def _start_reader(self) -> None:
+        if self._reader is None:
+            with self._slots_lock:
+                if self._reader is None:
+                    self._reader = threading.Thread(target=self._read_responses, name="responses", daemon=True)
+                    self._reader.start()
+
+    def _dispatch(self) -> bool:
+        """Reads a response and hands it over to its request, False once the connection is gone"""
+        try:
+            frame = self._channel.recv_frame()
+        except Exception as e:
+            frame, error = None, e
+        else:
+            error = ConnectionError("proxy server closed the connection")
+        if frame is None:
+            self._fail(error)
+            return False
+        response_id, payload = frame
+        with self._slots_lock:
+            slot = self._slots.pop(response_id, None)
+            if slot is None:
+                # to no request of this client
+                return True
+            slot.payload = payload
+        slot.notify()
+        return True
+
+    def _read_responses(self) -> None:
+        with self._recv_lock:
+            while self._dispatch():
+                pass
+
+    def _fail(self, error: BaseException) -> None:
+        """The connection is unusable, every request still waiting fails with error"""
+        with self._slots_lock:
+            slots, self._slots = list(self._slots.values()), {}
+            for slot in slots:
+                slot.error = error
+        for slot in slots:
+            slot.notify()
+
+    def _decoded(self, request_id: int) -> None:
+        """
+        Called once the response to a request was decoded, or given up on. Ids are only released
+        along with the requests sent once every response that may have handed them out was decoded,
+        see _take_released.
+        """
+        with self._refs_lock:
+            self._done.add(request_id)
+            while self._watermark + 1 in self._done:
+                self._watermark += 1
+                self._done.discard(self._watermark)
+
+    def _pin(self, proxy_id: Any) -> None:
+        if isinstance(proxy_id, ProxyApi.Symbol) or proxy_id is None:
+            return
+        with self._refs_lock:
+            self._pins[proxy_id] = self._pins.get(proxy_id, 0) + 1
+            self._holders[proxy_id] = self._holders.get(proxy_id, 0) + 1
+            self._releasable.pop(proxy_id, None)
+
+    @staticmethod
+    def _create_rings(sock: Any, transport: str) -> ring.RingChannel | None:
+        if transport == "socket":
+            return None
+        if transport != "ring":
+            sock.close()
+            raise ImportError(f"unknown transport {transport!r} in {PACKAGE_PROXY_TRANSPORT}")
+        if not ring.SUPPORTED:
+            warnings.warn(f"ring transport not supported on {platform.machine()}, using the socket")
+            return None
+        return ring.RingChannel.create(sock)
+
+    def _take_released(self) -> tuple[tuple, int]:
+        """
+        The ids no longer held by any proxy that can be released with the next request, and the
+        request up to which every response was decoded. An id is released once the responses to the
+        requests sent before it was let go of are decoded, as they may hand it out again, and the
+        server keeps it if a response to a later request did.
+        """
+        with self._refs_lock:
+            while self._released:
+                # finalizers may append concurrently, pop is atomic
+                proxy_id = self._released.pop()
+                self._holders[proxy_id] -= 1
+                if not self._holders[proxy_id]:
+                    del self._holders[proxy_id]
+                    self._releasable[proxy_id] = self._last_sent
+            seen = self._watermark
+            released = tuple(proxy_id for proxy_id, sent in self._releasable.items() if sent <= seen)
+            for proxy_id in released:
+                del self._releasable[proxy_id]
+        return released, seen
+
+    def _renew_lease(self) -> None:
+        # the lease is only learned with the first renewal, made once idle for a second
+        interval = 1.0
+        while True:
+            idle = time.monotonic() - self._last_request
+            if idle >= interval:
+                try:
+                    request_id, payload = self._send("lease", (), {})
+                    try:
+                        lease = self._decode(payload)
+                    finally:
+                        self._decoded(request_id)
+                except Exception as e:
+                    if isinstance(e, OSError) and not isinstance(e, DeadlineExceeded):
+                        # the connection is gone
+                        return
+                    # e.g. DeadlineExceeded, or scheduler.Overloaded from a busy server, tried again
+                    # an interval later
+                    idle = 0
+                else:
+                    if lease is None:
+                        return
+                    interval, idle = lease / 3, 0
+            time.sleep(interval - idle)
+
+    def _decode(self, payload: bytes, cached: bool = False) -> Any:
+        ok, value, mutated = wire.loads_response(payload, self._unpickle)
+        if (mutated is None or mutated) and not cached:
+            for listener in self._mutation_listeners:
+                listener(mutated)
+        if not ok:
+            raise value
+        return value
+
+    def _unpickle(self, data: bytes) -> Any:
+        return _ClientUnpickler(io.BytesIO(data), self).load()
+
+    def _stand_in_for(self, ref: wire.TypeRef) -> type:
+        """
+        Local placeholder for a type the client cannot import. It carries just enough of the original
+        (name, bases, metaclass, abstract and special methods) for the proxy builders to work on it.
+        """
+        key = (ref.module, ref.qualname)
+        stand_in = self._stand_ins.get(key)
+        if stand_in is None:
+            ns = {"__module__": ref.module, "__qualname__": ref.qualname, "__doc__": ref.doc}
+            try:
+                stand_in = ref.metaclass(ref.name, ref.bases, ns)
+            except Exception:
+                stand_in = type(ref.name, (object,), ns)
+            if ref.abstract_methods:
+                type.__setattr__(stand_in, "__abstractmethods__", ref.abstract_methods)
+            # the special methods its proxies forward, see TypeProxyBuilder
+            type.__setattr__(stand_in, "__special_methods__", ref.special_methods)
+            # the first one made wins, when decoding the same type in several threads
+            stand_in = self._stand_ins.setdefault(key, stand_in)
+        type.__setattr__(stand_in, "__proxy_id__", ref.proxy_id)
+        return stand_in
+
+    def _object_for(self, ref: wire.ObjectRef) -> Any:
+        cls = ref.cls
+        if "__proxy_id__" not in cls.__dict__:
+            # an object of a type the client has too, left on the server as it could not be pickled
+            # or as the result policy of the server says so
+            cls = self._stand_in_for(wire.TypeRef(None, cls.__name__, cls.__qualname__, cls.__module__,
+                                                  cls.__doc__, (object,), type, frozenset(),
+                                                  special_methods(cls)))
+        proxy_cls = self._proxy_types.get(cls)
+        if proxy_cls is None:
+            type_attr = ProxyApi.AttrWrapper(cls, cls.__proxy_id__)
+            proxy_cls = TypeProxyBuilder(self, cls.__module__).build_proxy_for_type_attr(type_attr)
+            proxy_cls = self._proxy_types.setdefault(cls, proxy_cls)
+        instance = object.__new__(proxy_cls)
+        object.__setattr__(instance, "_proxy_id", ref.proxy_id)
+        self.hold(instance, ref.proxy_id)
+        return instance
+
+    def _callable_for(self, ref: wire.CallableRef):
+        proxy_api, proxy_id = self, ref.proxy_id
+
+        def _callable(*args, **kwargs):
+            return proxy_api.call(proxy_id, "__call__", *args, **kwargs)
+
+        _callable.__name__ = ref.name
+        _callable.__qualname__ = ref.qualname
+        _callable.__module__ = ref.module
+        _callable.__doc__ = ref.doc
+        _callable.__proxy_id__ = ref.proxy_id
+        if ref.parameters is not None:
+            _callable.__signature__ = wire.signature_from(ref.parameters)
+        if ref.is_abstract:
+            _callable.__isabstractmethod__ = True
+        self.hold(_callable, ref.proxy_id)
+        return _callable
+
+
+class _Slot:
+    """A request waiting for its response, callback is called with the slot once it is there"""
+
+    __slots__ = ("request_id", "op", "event", "payload", "error", "callback")
+
+    def __init__(self, callback: Callable[[_Slot], None] | None = None) -> None:
+        self.request_id = 0
+        self.op = ""
+        self.event = threading.Event()
+        self.payload: bytes | None = None
+        self.error: BaseException | None = None
+        self.callback = callback
+
+    def notify(self) -> None:
+        self.event.set()
+        if self.callback is not None:
+            self.callback(self)
+
+
+class _AsyncRemoteApi(AsyncProxyApi):
+    """
+    Sends requests right away and awaits their responses, so that any number of them overlap on the
+    connection without blocking the event loop. Responses are read by a daemon thread of the
+    RemoteApi, started with the first request, and the awaiting tasks are woken through
+    loop.call_soon_threadsafe.
+
+    Manifests and deferred writes involve the schema cache and barrier(), which block, and are
+    left to the executor, as by AsyncProxyApi.
+    """
+
+    proxy_api: RemoteApi
+
+    async def get_attr(self, proxy_id: int, item: str) -> ProxyApi.AttrWrapper:
+        return await self._request("get_attr", proxy_id, item)
+
+    async def set_attr(self, proxy_id: int, key: str, value: Any) -> Any:
+        if self.proxy_api._write_behind:
+            return await super().set_attr(proxy_id, key, value)
+        return await self._request("set_attr", proxy_id, key, value)
+
+    async def create_object(self, cls_id: int, *args: Any, **kwargs: Any) -> int:
+        request_id, payload = await self._roundtrip("create_object", (cls_id, *args), kwargs)
+        try:
+            proxy_id = self.proxy_api._decode(payload)
+            # held for the proxy about to be made for it, see RemoteApi.hold
+            self.proxy_api._pin(proxy_id)
+            return proxy_id
+        finally:
+            self.proxy_api._decoded(request_id)
+
+    async def call(self, proxy_id: int, func_name: str, *args: Any, **kwargs: Any) -> Any:
+        return await self._request("call", proxy_id, func_name, *args, **kwargs)
+
+    async def release(self, proxy_ids: Iterable[int]) -> None:
+        return await self._request("release", list(proxy_ids))
+
+    async def batch(self, ops: list[ProxyApi.Op]) -> list[ProxyApi.Result]:
+        return await self._request("batch", ops)
+
+    async def _request(self, op: str, *args: Any, **kwargs: Any) -> Any:
+        request_id, payload = await self._roundtrip(op, args, kwargs)
+        try:
+            return self.proxy_api._decode(payload)
+        finally:
+            self.proxy_api._decoded(request_id)
+
+    async def _roundtrip(self, op: str, args: tuple, kwargs: dict) -> tuple[int, bytes]:
+        api = self.proxy_api
+        loop = asyncio.get_running_loop()
+        if api._pending_writes or api._flush_lock.locked():
+            # pending writes go first, as for RemoteApi._roundtrip
+            await loop.run_in_executor(None, api._flush)
+        deadline = api._deadline()
+        answered = loop.create_future()
+        slot = _Slot(functools.partial(_wake, loop, answered, api._decoded))
+        request_id = api._post(op, args, kwargs, slot, deadline)
+        api._start_reader()
+        try:
+            if deadline is None:
+                await answered
+            else:
+                await asyncio.wait_for(asyncio.shield(answered), deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            if api._abandon(slot):
+                raise DeadlineExceeded(f"no response to request {request_id} before its deadline")
+            # answered meanwhile
+        except asyncio.CancelledError:
+            if not api._abandon(slot):
+                if slot.payload is not None:
+                    # for the ids it hands out to be released
+                    with contextlib.suppress(Exception):
+                        api._decode(slot.payload)
+                api._decoded(request_id)
+            raise
+        if slot.error is not None:
+            api._decoded(request_id)
+            raise slot.error
+        return request_id, slot.payload
+
+
+def _wake(loop: asyncio.AbstractEventLoop, answered: asyncio.Future, lost: Callable[[int], None],
+          slot: _Slot) -> None:
+    try:
+        loop.call_soon_threadsafe(_set_answered, answered)
+    except RuntimeError:
+        # the loop is closed, nobody will decode the response
+        lost(slot.request_id)
+
+
+def _set_answered(answered: asyncio.Future) -> None:
+    if not answered.done():
+        answered.set_result(None)
+
+
+def _is_symbolic(proxy_id: Any, module_manifest: ProxyApi.Manifest) -> bool:
+    """Whether a manifest only refers to objects by name, and so can be reused in later sessions"""
+    if not isinstance(proxy_id, ProxyApi.Symbol):
+        return False
+    for entry in module_manifest.entries.values():
+        attr_id = entry.proxy_id
+        if attr_id is None:
+            attr_id = getattr(entry.attr, "__proxy_id__", None)
+            if attr_id is None and isinstance(entry.attr, _ModuleProxy):
+                attr_id = entry.attr._proxy_id
+        if attr_id is not None and not isinstance(attr_id, ProxyApi.Symbol):
+            return False
+    return True
+
+
+class _ClientUnpickler(pickle.Unpickler):
+
+    def __init__(self, file, proxy_api: RemoteApi) -> None:
+        super().__init__(file)
+        self._proxy_api = proxy_api
+
+    def persistent_load(self, pid: Any) -> Any:
+        if isinstance(pid, wire.SharedBuffer):
+            if self._proxy_api._shared is None:
+                raise pickle.UnpicklingError("shared buffer on a connection without shared memory")
+            return shared_buffers.load(pid)
+        if isinstance(pid, wire.TypeRef):
+            return self._proxy_api._stand_in_for(pid)
+        if isinstance(pid, wire.ObjectRef):
+            return self._proxy_api._object_for(pid)
+        if isinstance(pid, wire.CallableRef):
+            return self._proxy_api._callable_for(pid)
+        if isinstance(pid, wire.ModuleRef):
+            if pid.proxy_id is None:
+                return importlib.import_module(pid.name)
+            return _ModuleProxy(pid.name, self._proxy_api, pid.proxy_id)
+        raise pickle.UnpicklingError(f"unsupported persistent id {pid!r}")
@@ -0,0 +1,324 @@
+"""
+Compact binary encoding of the values sent back by the proxy server.
+
+A payload is the codec version followed by a single encoded value. Each value starts with a one
+byte tag telling how the rest is encoded, in this order of preference:
+
+- the codec registered for the exact type of the value in a SerializerRegistry, for the types found
+  in most responses that pickle would spell out the class path of;
+- PLAIN, followed by the value pickled by plain pickle, for builtin scalars and small containers
+  of them, which need none of the hooks of the server and client picklers;
+- PICKLE, followed by the value pickled at the protocol negotiated for the connection. Builtins
+  and containers are left to pickle, whose C implementation decodes them faster than any codec
+  and keeps the objects they share shared;
+- for the builtin containers holding values with a codec, or values that cannot be pickled, their
+  own tag followed by their items, each encoded by the same rules;
+- REF, followed by a pickled reference to the value, which stays on the server, used when the
+  value cannot be pickled.
+
+The layout of a tag never changes once released, new encodings get new tags and a new
+CODEC_VERSION.
+"""
+from __future__ import annotations
+
+import itertools
+import pickle
+import struct
+from typing import Any, Callable
+
+CODEC_VERSION = 2
+
+TUPLE, LIST, DICT, SET, FROZENSET = range(5)
+# first tag available to registered codecs
+FIRST_USER_TAG = 0x40
+PLAIN, PICKLE, REF = 0xFD, 0xFE, 0xFF
+
+_SIZE = struct.Struct("<I")
+# sizes up to this fit the size byte itself, larger ones follow it as _SIZE
+_LONG_SIZE = 0xFF
+# containers up to this size are looked into before being pickled, see Encoder.write
+_SMALL_CONTAINER = 8
+
+Encode = Callable[["Encoder", Any], None]
+Decode = Callable[["Decoder"], Any]
+
+
+class CodecError(ValueError):
+    pass
+
+
+class PreferCodec(Exception):
+    """Raised by pickle_value when meeting a value that has a codec, see SerializerRegistry.dumps"""
+
+
+class SerializerRegistry:
+    """
+    Maps types to the codec encoding their instances, and tags back to the codec decoding them.
+    Codecs are looked up by exact type, instances of subclasses fall back to pickle.
+    """
+
+    def __init__(self) -> None:
+        self._encoders: dict[type, tuple[int, Encode]] = {}
+        self._decoders: list[Decode] = [unknown_tag] * 256
+        # types with a codec that pickle does not handle natively
+        self.codec_types: frozenset[type] = frozenset()
+
+    def register(self, cls: type, tag: int, encode: Encode, decode: Decode) -> None:
+        """
+        encode(encoder, obj) writes obj after its tag, decode(decoder) reads it back. Tags below
+        FIRST_USER_TAG are taken by the builtin containers.
+        """
+        if not FIRST_USER_TAG <= tag < PLAIN:
+            raise ValueError(f"tag {tag} out of range")
+        existing = self._decoders[tag]
+        if existing is not unknown_tag and existing is not decode:
+            raise ValueError(f"tag {tag} is taken already")
+        self._encoders[cls] = (tag, encode)
+        self._decoders[tag] = decode
+        self._update_codec_types()
+
+    def unregister(self, cls: type) -> None:
+        """Sends instances of cls by pickle again"""
+        tag, _ = self._encoders.pop(cls)
+        if tag not in (t for t, _ in self._encoders.values()):
+            self._decoders[tag] = unknown_tag
+        self._update_codec_types()
+
+    def _update_codec_types(self) -> None:
+        self.codec_types = frozenset(self._encoders)
+
+    def dumps(self, obj: Any, pickle_value: Callable[[Any, frozenset], bytes],
+              ref_value: Callable[[Any], bytes], protocol: int = pickle.DEFAULT_PROTOCOL) -> bytes:
+        """
+        pickle_value(obj, codec_types) is used for values without a codec. It raises PreferCodec
+        when meeting an instance of codec_types, if not empty, so that those are not pickled along
+        with the value. ref_value(obj) is used for the values that cannot be pickled. PLAIN values
+        are pickled at `protocol`.
+        """
+        encoder = Encoder(self, pickle_value, ref_value, protocol)
+        encoder.out.append(CODEC_VERSION)
+        encoder.write(obj)
+        return bytes(encoder.out)
+
+    def loads(self, data: bytes, unpickle: Callable[[bytes], Any]) -> Any:
+        """unpickle(data) loads what was written with pickle_value and ref_value"""
+        if not data or data[0] != CODEC_VERSION:
+            raise CodecError(f"unsupported codec version {data[:1]!r}")
+        decoder = Decoder(self, data, unpickle)
+        decoder.pos = 1
+        return decoder.read()
+
+
+class _Cycle(Exception):
+    """Raised when a container is found inside itself, the container is pickled instead"""
+
+    def __init__(self, container_id: int) -> None:
+        super().__init__(container_id)
+        self.container_id = container_id
+
+
+class Encoder:
+
+    def __init__(self, registry: SerializerRegistry, pickle_value: Callable[[Any, frozenset], bytes],
+                 ref_value: Callable[[Any], bytes], protocol: int = pickle.DEFAULT_PROTOCOL) -> None:
+        self.out = bytearray()
+        self._encoders = registry._encoders
+        self._codec_types = registry.codec_types
+        self._pickle_value = pickle_value
+        self._ref_value = ref_value
+        self._protocol = protocol
+        self._containers: set[int] = set()
+
+    def write(self, obj: Any) -> None:
+        obj_type = type(obj)
+        entry = self._encoders.get(obj_type)
+        if entry is not None:
+            tag, encode = entry
+            self.out.append(tag)
+            encode(self, obj)
+            return
+
+        if obj_type in _SCALARS:
+            self._write_plain(obj)
+            return
+        container = _CONTAINERS.get(obj_type)
+        if container is not None and len(obj) <= _SMALL_CONTAINER:
+            # small ones are looked into, to tell the common cases apart without going through
+            # pickle_value: only scalars, or values with a codec of their own
+            scalars = True
+            for item in (itertools.chain.from_iterable(obj.items()) if obj_type is dict else obj):
+                item_type = type(item)
+                if item_type in self._codec_types:
+                    self._write_items(obj, *container)
+                    return
+                if item_type not in _SCALARS:
+                    scalars = False
+            if scalars:
+                self._write_plain(obj)
+                return
+
+        try:
+            data = self._pickle_value(obj, self._codec_types)
+        except Exception:
+            if container is None:
+                self._write_fallback(obj)
+            else:
+                self._write_items(obj, *container)
+        else:
+            self.out.append(PICKLE)
+            self.write_bytes(data)
+
+    def _write_plain(self, obj: Any) -> None:
+        self.out.append(PLAIN)
+        self.write_bytes(pickle.dumps(obj, self._protocol))
+
+    def _write_items(self, obj: Any, tag: int, encode: Encode) -> None:
+        obj_id = id(obj)
+        if obj_id in self._containers:
+            raise _Cycle(obj_id)
+        mark = len(self.out)
+        self._containers.add(obj_id)
+        try:
+            self.out.append(tag)
+            encode(self, obj)
+        except _Cycle as cycle:
+            if cycle.container_id != obj_id:
+                raise
+            del self.out[mark:]
+            self._write_fallback(obj)
+        finally:
+            self._containers.discard(obj_id)
+
+    def write_size(self, size: int) -> None:
+        if size < _LONG_SIZE:
+            self.out.append(size)
+        else:
+            self.out.append(_LONG_SIZE)
+            self.out += _SIZE.pack(size)
+
+    def write_bytes(self, data: bytes) -> None:
+        self.write_size(len(data))
+        self.out += data
+
+    def write_reference(self, obj: Any) -> None:
+        """Called by a codec to have obj left on the server, its own tag is replaced by REF"""
+        self.out[-1] = REF
+        self.write_bytes(self._ref_value(obj))
+
+    def _write_fallback(self, obj: Any) -> None:
+        try:
+            data, tag = self._pickle_value(obj, frozenset()), PICKLE
+        except Exception:
+            data, tag = self._ref_value(obj), REF
+        self.out.append(tag)
+        self.write_bytes(data)
+
+
+class Decoder:
+
+    def __init__(self, registry: SerializerRegistry, data: bytes, unpickle: Callable[[bytes], Any]) -> None:
+        self.data = data
+        self.pos = 0
+        self._decoders = registry._decoders
+        self._unpickle = unpickle
+
+    def read(self) -> Any:
+        pos = self.pos
+        self.pos = pos + 1
+        return self._decoders[self.data[pos]](self)
+
+    def read_size(self) -> int:
+        pos = self.pos
+        size = self.data[pos]
+        if size == _LONG_SIZE:
+            size, = _SIZE.unpack_from(self.data, pos + 1)
+            self.pos = pos + 1 + _SIZE.size
+        else:
+            self.pos = pos + 1
+        return size
+
+    def read_bytes(self) -> bytes:
+        data, pos = self.data, self.pos
+        size = data[pos]
+        pos += 1
+        if size == _LONG_SIZE:
+            size, = _SIZE.unpack_from(data, pos)
+            pos += _SIZE.size
+        self.pos = pos + size
+        return data[pos:pos + size]
+
+    def read_struct(self, fmt: struct.Struct) -> tuple:
+        values = fmt.unpack_from(self.data, self.pos)
+        self.pos += fmt.size
+        return values
+
+    def unpickle(self) -> Any:
+        return self._unpickle(self.read_bytes())
+
+    def unpickle_plain(self) -> Any:
+        return pickle.loads(self.read_bytes())
+
+
+
+
+def unknown_tag(decoder: Decoder) -> Any:
+    raise CodecError(f"unknown tag {decoder.data[decoder.pos - 1]}")
+
+
+def _encode_items(encoder: Encoder, items) -> None:
+    encoder.write_size(len(items))
+    for item in items:
+        encoder.write(item)
+
+
+def _decode_items(decoder: Decoder) -> list:
+    read = decoder.read
+    return [read() for _ in range(decoder.read_size())]
+
+
+def _encode_dict(encoder: Encoder, value: dict) -> None:
+    encoder.write_size(len(value))
+    for key, item in value.items():
+        encoder.write(key)
+        encoder.write(item)
+
+
+def _decode_dict(decoder: Decoder) -> dict:
+    read = decoder.read
+    result = {}
+    for _ in range(decoder.read_size()):
+        key = read()
+        result[key] = read()
+    return result
+
+
+_SCALARS = frozenset({type(None), bool, int, float, complex, str})
+
+# the builtin containers encoded item by item when they cannot be pickled whole, by type
+_CONTAINERS: dict[type, tuple[int, Encode]] = {
+    tuple: (TUPLE, _encode_items),
+    list: (LIST, _encode_items),
+    dict: (DICT, _encode_dict),
+    set: (SET, _encode_items),
+    frozenset: (FROZENSET, _encode_items),
+}
+
+
+def registry_with_containers() -> SerializerRegistry:
+    """A registry decoding the builtin containers, without codecs of its own"""
+    registry = SerializerRegistry()
+    decoders = registry._decoders
+    decoders[TUPLE] = lambda d: tuple(_decode_items(d))
+    decoders[LIST] = _decode_items
+    decoders[DICT] = _decode_dict
+    decoders[SET] = lambda d: set(_decode_items(d))
+    decoders[FROZENSET] = lambda d: frozenset(_decode_items(d))
+    decoders[PLAIN] = Decoder.unpickle_plain
+    decoders[PICKLE] = Decoder.unpickle
+    decoders[REF] = Decoder.unpickle
+    return registry
+
+
+
+# the registry used on the wire, codecs for other types can be registered into it
+registry = registry_with_containers()
@@ -0,0 +1,211 @@
+"""
+Frames through shared memory, for a client and a server on the same host.
+
+The client maps a file of the shared memory directory holding two rings, one per direction, and
+passes its path in the hello (see wire.dumps_hello). The server maps it too and removes it. Each
+ring has a single producer and a single consumer, which only ever advance their own counter: the
+producer writes the bytes of a frame and then publishes the new tail, the consumer reads them and
+then publishes the new head. Neither takes a lock or makes a system call while the other keeps up.
+
+A side finding its ring empty (or full) spins for `spin` seconds (not at all on a single cpu, where
+that would keep the other side from running), then raises its waiting flag and
+sleeps on the socket the connection started with, which only carries one-byte wakeups from then
+on. The other side sends one whenever it moves a counter while the flag is up. Sleeps are bounded
+and grow from _MIN_SLEEP to _MAX_SLEEP, so that a wakeup missed for the lack of memory fences costs
+a little latency, not a hang. The socket closing tells that the other side is gone.
+
+This relies on aligned 8 byte stores being atomic and seen by other cores in the order they were
+made, as on x86-64, see SUPPORTED.
+"""
+from __future__ import annotations
+
+import mmap
+import os
+import platform
+import selectors
+import socket
+import struct
+import tempfile
+import time
+from typing import Callable
+
+from .shared_buffers import SHARED_DIR, in_shared_dir
+from .wire import HEADER
+
+SUPPORTED = platform.machine().lower() in ("x86_64", "amd64")
+# bytes of each ring, frames larger than that go through in chunks
+CAPACITY = 1 << 20
+# spinning only keeps the other side from running on a single cpu
+SPIN = 100e-6 if (os.cpu_count() or 1) > 1 else 0.0
+
+_MIN_SLEEP = 0.001
+_MAX_SLEEP = 0.05
+_COUNTER = struct.Struct("=Q")
+# each counter and flag on a cache line of its own
+_HEAD, _TAIL, _CONSUMER_WAITING, _PRODUCER_WAITING = 0, 64, 128, 192
+_RING_HEADER = 256
+_PREFIX = "pkg-proxy-ring-"
+
+
+class _Ring:
+
+    def __init__(self, memory: mmap.mmap, offset: int, capacity: int) -> None:
+        self.capacity = capacity
+        self.control = memoryview(memory)[offset:offset + _RING_HEADER]
+        self.data = memoryview(memory)[offset + _RING_HEADER:offset + _RING_HEADER + capacity]
+        # the counter owned by this side, the other one is only read from the mapping
+        self.head = self.load(_HEAD)
+        self.tail = self.load(_TAIL)
+
+    def load(self, field: int) -> int:
+        return _COUNTER.unpack_from(self.control, field)[0]
+
+    def store(self, field: int, value: int) -> None:
+        _COUNTER.pack_into(self.control, field, value)
+
+    def release(self) -> None:
+        self.control.release()
+        self.data.release()
+
+
+class RingChannel:
+    """Sends and receives frames as wire.SocketChannel does, through the rings mapped from `path`"""
+
+    def __init__(self, path: str, sock: socket.socket, is_client: bool, spin: float = SPIN) -> None:
+        self.path = path
+        self._sock = sock
+        self._sock.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(sock, selectors.EVENT_READ)
+        self._spin = spin
+        fd = os.open(path, os.O_RDWR)
+        try:
+            self._memory = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        capacity = len(self._memory) // 2 - _RING_HEADER
+        to_server = _Ring(self._memory, 0, capacity)
+        to_client = _Ring(self._memory, _RING_HEADER + capacity, capacity)
+        self._out, self._in = (to_server, to_client) if is_client else (to_client, to_server)
+
+    @classmethod
+    def create(cls, sock: socket.socket, capacity: int = CAPACITY, directory: str = SHARED_DIR) -> RingChannel:
+        """The client side, to be sent in the hello before any frame"""
+        fd, path = tempfile.mkstemp(prefix=_PREFIX, dir=directory)
+        try:
+            os.ftruncate(fd, 2 * (_RING_HEADER + capacity))
+        finally:
+            os.close(fd)
+        return cls(path, sock, is_client=True)
+
+    @classmethod
+    def attach(cls, path: str, sock: socket.socket) -> RingChannel:
+        """The server side, given the path received in the hello"""
+        if not isinstance(path, str) or not in_shared_dir(path, _PREFIX):
+            raise ValueError(f"not the path of rings: {path!r}")
+        channel = cls(path, sock, is_client=False)
+        os.unlink(path)
+        return channel
+
+    def send_frame(self, request_id: int, payload: bytes) -> None:
+        self._write(HEADER.pack(len(payload), request_id) + payload)
+
+    def recv_frame(self) -> tuple[int, bytes] | None:
+        """Returns (request_id, payload) or None if the peer closed the connection"""
+        header = self._read(HEADER.size)
+        if header is None:
+            return None
+        length, request_id = HEADER.unpack(header)
+        payload = self._read(length)
+        if payload is None:
+            raise ConnectionError("connection closed in the middle of a frame")
+        return request_id, payload
+
+    def close(self) -> None:
+        self._selector.close()
+        self._sock.close()
+        self._out.release()
+        self._in.release()
+        self._memory.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            # removed by the server already
+            pass
+
+    def _write(self, data: bytes) -> None:
+        ring = self._out
+        capacity, buf = ring.capacity, ring.data
+        view = memoryview(data)
+        while view:
+            tail = ring.tail
+            free = capacity - (tail - ring.load(_HEAD))
+            if not free:
+                if not self._wait(lambda: ring.load(_HEAD) != tail - capacity, ring, _PRODUCER_WAITING):
+                    raise ConnectionError("proxy peer closed the connection")
+                continue
+            n = min(free, len(view))
+            start = tail % capacity
+            first = min(n, capacity - start)
+            buf[start:start + first] = view[:first]
+            buf[:n - first] = view[first:n]
+            ring.tail = tail + n
+            ring.store(_TAIL, ring.tail)
+            view = view[n:]
+            if ring.load(_CONSUMER_WAITING):
+                self._wake()
+
+    def _read(self, size: int) -> bytes | None:
+        ring = self._in
+        capacity, buf = ring.capacity, ring.data
+        out = bytearray(size)
+        received = 0
+        while received < size:
+            head = ring.head
+            available = ring.load(_TAIL) - head
+            if not available:
+                if not self._wait(lambda: ring.load(_TAIL) != head, ring, _CONSUMER_WAITING):
+                    if received == 0:
+                        return None
+                    raise ConnectionError("connection closed in the middle of a frame")
+                continue
+            n = min(available, size - received)
+            start = head % capacity
+            first = min(n, capacity - start)
+            out[received:received + first] = buf[start:start + first]
+            out[received + first:received + n] = buf[:n - first]
+            received += n
+            ring.head = head + n
+            ring.store(_HEAD, ring.head)
+            if ring.load(_PRODUCER_WAITING):
+                self._wake()
+        return bytes(out)
+
+    def _wait(self, ready: Callable[[], bool], ring: _Ring, flag: int) -> bool:
+        """Waits until ready(), False if the peer closed the connection first"""
+        deadline = time.perf_counter() + self._spin
+        while time.perf_counter() < deadline:
+            if ready():
+                return True
+        ring.store(flag, 1)
+        try:
+            timeout = _MIN_SLEEP
+            while not ready():
+                if not self._selector.select(timeout):
+                    timeout = min(2 * timeout, _MAX_SLEEP)
+                    continue
+                try:
+                    if not self._sock.recv(4096):
+                        return ready()
+                except BlockingIOError:
+                    pass
+            return True
+        finally:
+            ring.store(flag, 0)
+
+    def _wake(self) -> None:
+        try:
+            self._sock.send(b"\0")
+        except BlockingIOError:
+            # the buffer is full of wakeups not read yet
+            pass
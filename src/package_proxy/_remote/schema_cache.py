@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from typing import Callable
+
+from . import wire
+
+logger = logging.getLogger(__name__)
+
+
+class SchemaCache:
+    """
+    On disk cache of module manifests, kept as received from the server, so that short-lived clients
+    can build the proxies of the modules they imported in earlier runs without asking the server.
+    Only manifests referring to everything by ProxyApi.Symbol are kept, as those stay valid across
+    sessions.
+
+    Entries are grouped by the fingerprint of the served package. A client starts with the
+    fingerprint it saw last and checks it against the server lazily, in the background, dropping the
+    cache when the served package changed. Proxies already built from it keep working as long as the
+    names they refer to still exist.
+    """
+
+    _CURRENT = "current"
+    _SUFFIX = ".manifest"
+
+    def __init__(self, cache_dir: str, target_package: str) -> None:
+        self._root = os.path.join(cache_dir, target_package, f"wire-{wire.FORMAT_VERSION}")
+        self._fingerprint = self._read_current()
+        self._lock = threading.Lock()
+        self._checking = False
+
+    def load(self, module_name: str) -> bytes | None:
+        if self._fingerprint is None:
+            return None
+        try:
+            with open(self._path_for(self._fingerprint, module_name), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def store(self, module_name: str, payload: bytes, get_fingerprint: Callable[[], str]) -> None:
+        if self._fingerprint is None:
+            # nothing cached yet, so nothing to build proxies from while checking in the background
+            with self._lock:
+                self._checking = True
+            self._check(get_fingerprint)
+            if self._fingerprint is None:
+                return
+        else:
+            self.check(get_fingerprint)
+        self._write(self._path_for(self._fingerprint, module_name), payload)
+
+    def check(self, get_fingerprint: Callable[[], str]) -> None:
+        """Checks, once and in the background, that the cache matches the package being served"""
+        with self._lock:
+            if self._checking:
+                return
+            self._checking = True
+        threading.Thread(target=self._check, args=(get_fingerprint,),
+                         name="package_proxy-schema-check", daemon=True).start()
+
+    def _check(self, get_fingerprint: Callable[[], str]) -> None:
+        try:
+            fingerprint = get_fingerprint()
+        except Exception as e:
+            logger.warning(f"unable to check the schema cache in {self._root}: {e!r}")
+            return
+        if fingerprint == self._fingerprint:
+            return
+        if self._fingerprint is not None:
+            logger.warning(f"schema cache in {self._root} is stale, dropping it")
+            shutil.rmtree(os.path.join(self._root, self._fingerprint), ignore_errors=True)
+        self._fingerprint = fingerprint
+        self._write(os.path.join(self._root, self._CURRENT), fingerprint.encode())
+
+    def _read_current(self) -> str | None:
+        try:
+            with open(os.path.join(self._root, self._CURRENT)) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def _path_for(self, fingerprint: str, module_name: str) -> str:
+        return os.path.join(self._root, fingerprint, module_name + self._SUFFIX)
+
+    @staticmethod
+    def _write(path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
@@ -0,0 +1,158 @@
+"""
+Transfer of large buffers through shared memory, for clients and servers on the same host.
+
+Pickled at protocol 5, types such as numpy arrays hand their memory out as pickle.PickleBuffer
+objects instead of copying it into the pickle. Those, and bytes, bytearray and array.array values,
+of at least `min_size` bytes are written to a file of their own in a shared memory directory
+(/dev/shm where there is one), and only a SharedBuffer reference to that file goes into the message,
+as a persistent id, see wire.ServerPickler and wire.ClientPickler.
+
+The reader maps the file and removes it at once. A PickleBuffer is handed back as a memoryview of
+the mapping, so a numpy array is rebuilt right on top of it without any copy, the mapping lasting as
+long as the array. The other types are copied out of the mapping. The writer removes the files of
+the messages never read when its connection closes.
+
+Only files of this module, right in the shared memory directory, are read, and a server only reads
+them for the clients that asked for shared memory in their hello.
+"""
+from __future__ import annotations
+
+import array
+import dataclasses
+import mmap
+import os
+import pickle
+import tempfile
+import threading
+from typing import Any
+
+SHARED_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+_PREFIX = "pkg-proxy-buffer-"
+
+
+@dataclasses.dataclass
+class SharedBuffer:
+    """Stands for a buffer of `size` bytes written to `path`, rebuilt as `cls`, or a memoryview if None"""
+    path: str
+    size: int
+    cls: type | None
+    typecode: str | None = None
+
+
+class SharedBuffers:
+    """
+    The buffers written by one side of a connection. Messages may be written by several threads at
+    once, mark and discard are about those of the calling thread.
+    """
+
+    def __init__(self, min_size: int, directory: str = SHARED_DIR) -> None:
+        if min_size < 1:
+            raise ValueError(f"min_size must be positive, got {min_size}")
+        self.min_size = min_size
+        self._directory = directory
+        self._written: list[str] = []
+        self._lock = threading.Lock()
+        # per thread, the number of files it wrote and the (number, path) of those maybe not read yet
+        self._local = threading.local()
+
+    def persistent_id(self, obj: Any) -> SharedBuffer | None:
+        """The reference to send in place of obj, None if obj is to be pickled as usual"""
+        cls = type(obj)
+        if cls is bytes or cls is bytearray:
+            if len(obj) < self.min_size:
+                return None
+            return SharedBuffer(self._write(obj), len(obj), cls)
+        if cls is pickle.PickleBuffer:
+            data = obj.raw()
+            if data.nbytes < self.min_size:
+                return None
+            return SharedBuffer(self._write(data), data.nbytes, None)
+        if cls is array.array:
+            size = len(obj) * obj.itemsize
+            if size < self.min_size:
+                return None
+            return SharedBuffer(self._write(memoryview(obj).cast("B")), size, cls, obj.typecode)
+        return None
+
+    def mark(self) -> int:
+        return getattr(self._local, "count", 0)
+
+    def discard(self, mark: int) -> None:
+        """
+        Removes the files written by this thread since mark, for a message that could not be
+        completed
+        """
+        written = getattr(self._local, "written", [])
+        self._remove([path for number, path in written if number >= mark])
+        self._local.written = [(number, path) for number, path in written if number < mark]
+
+    def close(self) -> None:
+        """Removes the files of the messages never read"""
+        with self._lock:
+            written, self._written = self._written, []
+        self._remove(written)
+
+    def _write(self, data: Any) -> str:
+        fd, path = tempfile.mkstemp(prefix=_PREFIX, dir=self._directory)
+        try:
+            with open(fd, "wb") as f:
+                f.write(data)
+        except BaseException:
+            os.unlink(path)
+            raise
+        with self._lock:
+            # the files of the messages read since the previous write are gone already
+            self._written = [written for written in self._written if os.path.exists(written)]
+            self._written.append(path)
+        number = getattr(self._local, "count", 0)
+        self._local.count = number + 1
+        self._local.written = [(n, p) for n, p in getattr(self._local, "written", []) if os.path.exists(p)]
+        self._local.written.append((number, path))
+        return path
+
+    @staticmethod
+    def _remove(paths: list[str]) -> None:
+        for path in paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def in_shared_dir(path: str, prefix: str) -> bool:
+    """Whether path names a file made with prefix right in SHARED_DIR, as the peer is to send"""
+    directory, name = os.path.split(os.path.abspath(path))
+    return directory == os.path.abspath(SHARED_DIR) and name.startswith(prefix)
+
+
+def load(ref: SharedBuffer) -> Any:
+    """Reads a SharedBuffer back, removing its file"""
+    if not isinstance(ref.path, str) or not in_shared_dir(ref.path, _PREFIX):
+        raise pickle.UnpicklingError(f"not a shared buffer: {ref.path!r}")
+    fd = os.open(ref.path, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+    try:
+        # a private mapping, so that the rebuilt objects are writable
+        memory = mmap.mmap(fd, ref.size, access=mmap.ACCESS_COPY)
+    finally:
+        os.close(fd)
+        try:
+            os.unlink(ref.path)
+        except OSError:
+            # not while mapped on some platforms, the writer removes it when closing
+            pass
+    view = memoryview(memory)
+    if ref.cls is None:
+        return view
+    if ref.cls is array.array:
+        value = array.array(ref.typecode)
+        value.frombytes(view)
+    else:
+        value = ref.cls(view)
+    view.release()
+    memory.close()
+    return value
+
+
+def mentioned_in(payload: bytes) -> bool:
+    """Whether a message may refer to shared buffers, which can only be read once"""
+    return _PREFIX.encode() in payload
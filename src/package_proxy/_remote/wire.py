@@ -0,0 +1,436 @@
+"""
+Wire format shared by the proxy server and RemoteApi.
+
+Every message is a frame: a fixed size header holding the payload length and the request id,
+followed by the payload. A connection starts with a hello frame (HELLO_ID), not answered, telling
+the server the versions the client understands, and whether frames are to go through shared
+memory rather than the socket from then on (see ring). Requests are pickled
+(op, args, kwargs, released, seen, timeout) and responses are (ok, value, mutated) encoded with the
+codec module, at the pickle protocol agreed in the hello, echoing the id of the request they answer.
+Several requests can be in flight on a connection, and their responses come back in any order, or
+not at all for the requests cancelled before they started.
+
+`released` holds the proxy ids the client no longer has proxies for, `seen` the request up to which
+it had decoded every response then (see LocalApi.release), and `timeout` the seconds left before the
+deadline of the request, None for none. `mutated` holds the proxy ids of objects changed since the
+previous response on the connection, None if anything may have changed.
+
+Only objects both interpreters can load travel by value: builtins, the stdlib and package_proxy
+itself. Anything defined by the hosted code (types, functions, modules and instances) is replaced
+by a reference that the client turns back into a proxy.
+
+When the client asks for it in the hello, large buffers go through shared memory in both
+directions, see shared_buffers.
+"""
+from __future__ import annotations
+
+import dataclasses
+import functools
+import inspect
+import io
+import os
+import pickle
+import socket
+import struct
+import sys
+import sysconfig
+import types
+from typing import Any, Callable
+
+from . import codec, shared_buffers
+from .shared_buffers import SharedBuffer, SharedBuffers
+from ..api import ProxyApi, special_methods
+
+HEADER = struct.Struct("!IQ")
+# protocol of the requests, and of the responses when the client does not say which it supports
+PROTOCOL = 4
+# bumped whenever the layout of the messages changes
+FORMAT_VERSION = 8
+HELLO_ID = 0
+
+_BY_VALUE = frozenset({int, float, complex, bool, str, bytes, bytearray, type(None),
+                       tuple, list, dict, set, frozenset})
+_CALLABLES = (types.FunctionType, types.MethodType, types.BuiltinFunctionType,
+              types.BuiltinMethodType)
+_STDLIB_DIRS = tuple({os.path.normcase(sysconfig.get_paths()[k]) for k in ("stdlib", "platstdlib")})
+
+
+class RemoteError(Exception):
+    """Stands in for a server side exception whose type the client cannot load"""
+
+
+@dataclasses.dataclass
+class TypeRef:
+    proxy_id: Any
+    name: str
+    qualname: str
+    module: str
+    doc: str | None
+    bases: tuple
+    metaclass: type
+    abstract_methods: frozenset
+    special_methods: frozenset = frozenset()
+
+
+@dataclasses.dataclass
+class CallableRef:
+    proxy_id: Any
+    name: str
+    qualname: str
+    module: str | None
+    doc: str | None
+    is_abstract: bool
+    # (name, kind, repr of the default or None) for each parameter, None if there is no signature
+    parameters: tuple | None = None
+
+
+@dataclasses.dataclass
+class ModuleRef:
+    proxy_id: Any
+    name: str
+
+
+@dataclasses.dataclass
+class ObjectRef:
+    proxy_id: Any
+    cls: type
+
+
+@dataclasses.dataclass
+class ByReference:
+    """Wraps a value the server sends as a reference, although it could be sent by value"""
+    value: Any
+
+
+@dataclasses.dataclass
+class ProxyRef:
+    """A proxy passed in a request, standing for the object on the server, or its method `attr`"""
+    proxy_id: Any
+    attr: str | None = None
+
+
+@functools.lru_cache(maxsize=None)
+def is_portable_module(module_name: str | None) -> bool:
+    """Whether a module can be expected to load on the client too: builtins, stdlib and package_proxy"""
+    if not module_name:
+        return False
+    if module_name == "package_proxy" or module_name.startswith("package_proxy."):
+        return True
+    if module_name in sys.builtin_module_names:
+        return True
+    module = sys.modules.get(module_name)
+    if module is None:
+        return False
+    spec = getattr(module, "__spec__", None)
+    origin = spec.origin if spec is not None else getattr(module, "__file__", None)
+    if origin in ("built-in", "frozen"):
+        return True
+    if not origin:
+        return False
+    origin = os.path.normcase(origin)
+    return origin.startswith(_STDLIB_DIRS) and "site-packages" not in origin
+
+
+def parse_address(address: str) -> tuple[int, Any]:
+    """'unix:/path/to/socket' or '[tcp:]host:port'"""
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    if address.startswith("tcp:"):
+        address = address[len("tcp:"):]
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+def connect(address: str) -> socket.socket:
+    family, addr = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.connect(addr)
+    except OSError:
+        sock.close()
+        raise
+    if family == socket.AF_INET:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def send_frame(sock: socket.socket, request_id: int, payload: bytes) -> None:
+    sock.sendall(HEADER.pack(len(payload), request_id) + payload)
+
+
+def recv_frame(sock: socket.socket) -> tuple[int, bytes] | None:
+    """Returns (request_id, payload) or None if the peer closed the connection"""
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    length, request_id = HEADER.unpack(header)
+    payload = _recv_exactly(sock, length)
+    if payload is None:
+        raise ConnectionError("connection closed in the middle of a frame")
+    return request_id, payload
+
+
+class SocketChannel:
+    """Sends and receives frames on a socket"""
+
+    def __init__(self, sock: socket.socket) -> None:
+        self._sock = sock
+
+    def send_frame(self, request_id: int, payload: bytes) -> None:
+        send_frame(self._sock, request_id, payload)
+
+    def recv_frame(self) -> tuple[int, bytes] | None:
+        return recv_frame(self._sock)
+
+    def close(self) -> None:
+        self._sock.close()
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes | None:
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            if received == 0:
+                return None
+            raise ConnectionError("connection closed in the middle of a frame")
+        received += n
+    return bytes(buf)
+
+
+class ServerPickler(pickle.Pickler):
+    """
+    Replaces whatever the client cannot load by references registered in the server object table,
+    as well as `by_ref`, an object that could not be pickled. Raises codec.PreferCodec on meeting
+    an instance of `codec_types`. Large buffers are written to `shared` when given.
+    """
+
+    def __init__(self, file, register: Callable[[Any], Any], protocol: int = PROTOCOL,
+                 by_ref: Any = None, codec_types: frozenset = frozenset(),
+                 shared: SharedBuffers | None = None) -> None:
+        super().__init__(file, protocol=protocol)
+        self._register = register
+        self._by_ref = by_ref
+        self._codec_types = codec_types
+        self._shared = shared
+
+    def reducer_override(self, obj: Any) -> Any:
+        if type(obj) in self._codec_types:
+            raise codec.PreferCodec(type(obj))
+        return NotImplemented
+
+    def persistent_id(self, obj: Any) -> Any:
+        if obj is self._by_ref and obj is not None:
+            return ObjectRef(self._register(obj), type(obj))
+
+        if self._shared is not None:
+            shared_buffer = self._shared.persistent_id(obj)
+            if shared_buffer is not None:
+                return shared_buffer
+
+        obj_type = type(obj)
+        if obj_type in _BY_VALUE:
+            return None
+
+        if isinstance(obj, type):
+            if is_portable_module(obj.__module__):
+                return None
+            return TypeRef(self._register(obj), obj.__name__, obj.__qualname__, obj.__module__,
+                           obj.__doc__, obj.__bases__, type(obj),
+                           frozenset(getattr(obj, "__abstractmethods__", ())), special_methods(obj))
+
+        if isinstance(obj, types.ModuleType):
+            if is_portable_module(obj.__name__):
+                return ModuleRef(None, obj.__name__)
+            return ModuleRef(self._register(obj), obj.__name__)
+
+        if isinstance(obj, _CALLABLES):
+            owner = getattr(obj, "__self__", None)
+            if is_portable_module(getattr(obj, "__module__", None)) and (
+                    owner is None or isinstance(owner, types.ModuleType) or
+                    is_portable_module(type(owner).__module__)):
+                return None
+            return CallableRef(self._register(obj), obj.__name__,
+                               getattr(obj, "__qualname__", obj.__name__),
+                               getattr(obj, "__module__", None), obj.__doc__,
+                               bool(getattr(obj, "__isabstractmethod__", False)),
+                               _parameters_of(obj))
+
+        if not is_portable_module(obj_type.__module__):
+            return ObjectRef(self._register(obj), obj_type)
+
+        return None
+
+
+def _parameters_of(func: Callable) -> tuple | None:
+    try:
+        signature = inspect.signature(func)
+    except (TypeError, ValueError):
+        return None
+    return tuple((p.name, int(p.kind), None if p.default is p.empty else repr(p.default))
+                 for p in signature.parameters.values())
+
+
+def signature_from(parameters: tuple) -> inspect.Signature:
+    """Rebuilds a signature sent as CallableRef.parameters, defaults are only shown by their repr"""
+    parameter_kind = type(inspect.Parameter.POSITIONAL_ONLY)
+    return inspect.Signature([
+        inspect.Parameter(name, parameter_kind(kind),
+                          default=inspect.Parameter.empty if default is None else _Repr(default))
+        for name, kind, default in parameters])
+
+
+class _Repr:
+    def __init__(self, text: str) -> None:
+        self._text = text
+
+    def __repr__(self) -> str:
+        return self._text
+
+
+def dumps_hello(shared_min_size: int | None = None, ring: str | None = None) -> bytes:
+    """
+    shared_min_size: the size from which buffers go through shared memory, None to never
+    ring: the path of the rings the next frames go through, None to stay on the socket
+    """
+    return pickle.dumps((FORMAT_VERSION, codec.CODEC_VERSION, pickle.HIGHEST_PROTOCOL, shared_min_size,
+                         ring), protocol=2)
+
+
+def negotiate(hello: bytes) -> tuple[int, SharedBuffers | None, str | None]:
+    """
+    Returns the pickle protocol to answer a client with, given its hello, where to write the large
+    buffers of the responses if it asked for shared memory, and the path of its rings if any
+    """
+    format_version, codec_version, protocol, *rest = pickle.loads(hello)
+    if format_version != FORMAT_VERSION or codec_version < codec.CODEC_VERSION:
+        raise ValueError(f"client speaks wire format {format_version}, codec {codec_version}, expected "
+                         f"{FORMAT_VERSION}, {codec.CODEC_VERSION}")
+    protocol = min(protocol, pickle.HIGHEST_PROTOCOL)
+    shared_min_size, ring = rest
+    # buffers are only handed out by pickle as of protocol 5
+    if shared_min_size is None or protocol < 5:
+        return protocol, None, ring
+    return protocol, SharedBuffers(shared_min_size), ring
+
+
+class ClientPickler(pickle.Pickler):
+    """
+    Sends proxies as a ProxyRef to what they stand for, as told by `reference_of`, and large
+    buffers through `shared` when given
+    """
+
+    def __init__(self, file, reference_of: Callable[[Any], tuple | None],
+                 shared: SharedBuffers | None = None) -> None:
+        super().__init__(file, protocol=PROTOCOL if shared is None else 5)
+        self._reference_of = reference_of
+        self._shared = shared
+
+    def persistent_id(self, obj: Any) -> Any:
+        if self._shared is not None:
+            shared_buffer = self._shared.persistent_id(obj)
+            if shared_buffer is not None:
+                return shared_buffer
+        if type(obj) in _BY_VALUE:
+            return None
+        reference = self._reference_of(obj)
+        return None if reference is None else ProxyRef(*reference)
+
+
+class ServerUnpickler(pickle.Unpickler):
+    """
+    Turns the ProxyRefs of a request back into the objects they stand for, and its SharedBuffers into
+    the buffers they stand for if `shared`, the client having asked for shared memory
+    """
+
+    def __init__(self, file, resolve: Callable[[Any], Any], shared: bool = False) -> None:
+        super().__init__(file)
+        self._resolve = resolve
+        self._shared = shared
+
+    def persistent_load(self, pid: Any) -> Any:
+        if isinstance(pid, SharedBuffer):
+            if not self._shared:
+                raise pickle.UnpicklingError("shared buffer on a connection without shared memory")
+            return shared_buffers.load(pid)
+        if not isinstance(pid, ProxyRef):
+            raise pickle.UnpicklingError(f"unsupported persistent id {pid!r}")
+        obj = self._resolve(pid.proxy_id)
+        return obj if pid.attr is None else getattr(obj, pid.attr)
+
+
+def dumps_request(op: str, args: tuple, kwargs: dict, released: tuple = (), seen: int = 0,
+                  timeout: float | None = None, reference_of: Callable[[Any], tuple | None] = lambda obj: None,
+                  shared: SharedBuffers | None = None) -> bytes:
+    buf = io.BytesIO()
+    mark = shared.mark() if shared is not None else 0
+    try:
+        ClientPickler(buf, reference_of, shared).dump((op, args, kwargs, released, seen, timeout))
+    except BaseException:
+        if shared is not None:
+            shared.discard(mark)
+        raise
+    return buf.getvalue()
+
+
+def loads_request(payload: bytes, resolve: Callable[[Any], Any], shared: bool = False) -> tuple:
+    """Returns (op, args, kwargs, released, seen, timeout)"""
+    return ServerUnpickler(io.BytesIO(payload), resolve, shared).load()
+
+
+def portable_error(error: BaseException) -> BaseException:
+    if is_portable_module(type(error).__module__):
+        return error
+    return RemoteError(f"{type(error).__module__}.{type(error).__qualname__}: {error}")
+
+
+def dumps_response(ok: bool, value: Any, register: Callable[[Any], Any], mutated: Any = (),
+                   protocol: int = PROTOCOL, shared: SharedBuffers | None = None) -> bytes:
+    if not ok:
+        value = portable_error(value)
+    mark = shared.mark() if shared is not None else 0
+    try:
+        return _encode_response((ok, value, mutated), register, protocol, shared)
+    except Exception as e:
+        if shared is not None:
+            shared.discard(mark)
+        error = RemoteError(f"unable to encode response: {e!r}")
+        return _encode_response((False, error, mutated), register, protocol)
+
+
+def loads_response(payload: bytes, unpickle: Callable[[bytes], Any]) -> tuple[bool, Any, Any]:
+    return codec.registry.loads(payload, unpickle)
+
+
+def _encode_response(response: tuple, register: Callable[[Any], Any], protocol: int,
+                     shared: SharedBuffers | None = None) -> bytes:
+    def pickle_value(obj: Any, codec_types: frozenset = frozenset(), by_ref: Any = None) -> bytes:
+        buf = io.BytesIO()
+        mark = shared.mark() if shared is not None else 0
+        try:
+            ServerPickler(buf, register, protocol, by_ref, codec_types, shared).dump(obj)
+        except BaseException:
+            # e.g. codec.PreferCodec, the value is encoded again another way
+            if shared is not None:
+                shared.discard(mark)
+            raise
+        return buf.getvalue()
+
+    return codec.registry.dumps(response, pickle_value, lambda obj: pickle_value(obj, by_ref=obj), protocol)
+
+
+def _register_codecs(registry: codec.SerializerRegistry) -> None:
+    """Codecs for the ProxyApi types found in most responses, saving their pickled class paths"""
+    tag = codec.FIRST_USER_TAG
+    registry.register(ProxyApi.AttrWrapper, tag, lambda e, v: (e.write(v.attr), e.write(v.proxy_id)),
+                      lambda d: ProxyApi.AttrWrapper(d.read(), d.read()))
+    registry.register(ProxyApi.Symbol, tag + 1, lambda e, v: (e.write(v.module), e.write(v.qualname)),
+                      lambda d: ProxyApi.Symbol(d.read(), d.read()))
+    registry.register(ProxyApi.Result, tag + 2, lambda e, v: (e.write(v.value), e.write(v.error)),
+                      lambda d: ProxyApi.Result(d.read(), d.read()))
+    registry.register(ByReference, tag + 3, lambda e, v: e.write_reference(v.value), codec.unknown_tag)
+
+
+_register_codecs(codec.registry)
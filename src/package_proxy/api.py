@@ -1,11 +1,83 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import contextvars
 import dataclasses
-from typing import Protocol, Any
+import functools
+import time
+from typing import Protocol, Any, Callable, Iterable, Iterator
+
+BATCHABLE_OPS = frozenset({"get_module", "get_attr", "set_attr", "create_object", "call", "release"})
+
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised by an operation not carried out before its deadline, see timeout"""
+
+
+@contextlib.contextmanager
+def timeout(seconds: float) -> Iterator[None]:
+    """
+    Gives the operations made in the block, by this thread or asyncio task, until `seconds` from now
+    to complete. Those not done by then raise DeadlineExceeded. Nested blocks can only shorten it.
+
+        with timeout(2.0):
+            obj.method()
+
+    Implementations talking to another process send the time left along with the requests, and
+    give up waiting once it is over. In the server, deadline() tells it to the target code.
+    """
+    current = _deadline.get()
+    deadline_ = time.monotonic() + seconds
+    token = _deadline.set(deadline_ if current is None else min(current, deadline_))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def deadline() -> float | None:
+    """The time.monotonic() by which the operations made now are to be done, None if unbounded"""
+    return _deadline.get()
+
+
+# special methods not forwarded to the objects: those proxies define themselves, and those about the
+# type, pickling, copying, descriptors, finalization and the asynchronous protocols
+_NOT_FORWARDED = frozenset({
+    "__new__", "__init__", "__init_subclass__", "__subclasshook__", "__class_getitem__", "__prepare__",
+    "__mro_entries__", "__instancecheck__", "__subclasscheck__", "__getattribute__", "__getattr__",
+    "__setattr__", "__delattr__", "__dir__", "__sizeof__", "__reduce__", "__reduce_ex__", "__getstate__",
+    "__setstate__", "__getnewargs__", "__getnewargs_ex__", "__copy__", "__deepcopy__", "__del__",
+    "__get__", "__set__", "__delete__", "__set_name__", "__await__", "__aiter__", "__anext__",
+    "__aenter__", "__aexit__",
+})
+
+
+def special_methods(cls: type) -> frozenset[str]:
+    """
+    Names of the special methods of cls, but those of object, that proxies of its objects forward to
+    them: Python looks them up on the type only, never through __getattr__. __repr__ always is.
+    """
+    names = {"__repr__"}
+    for klass in cls.__mro__:
+        if klass is object:
+            continue
+        for name, value in vars(klass).items():
+            if (name.startswith("__") and name.endswith("__") and name not in _NOT_FORWARDED
+                    and callable(value) and not isinstance(value, (classmethod, staticmethod))):
+                names.add(name)
+    return frozenset(names)
+
 
 class ProxyApi(Protocol):
 
-    def get_module(self, fullname: str) -> int:
+    def get_module(self, fullname: str, manifest: bool = False) -> int | tuple[int, Manifest]:
+        """
+        With manifest=True, returns a Manifest of the module along with its proxy id, describing its
+        attributes well enough to build their proxies without further round trips.
+        """
         ...
 
     def get_attr(self, proxy_id: int, item: str) -> AttrWrapper:
@@ -20,7 +92,221 @@ class ProxyApi(Protocol):
     def call(self, proxy_id: int, func_name: str, *args: Any, **kwargs: Any) -> Any:
         ...
 
+    def release(self, proxy_ids: Iterable[int]) -> None:
+        """
+        Gives back ids handed out by the other operations, once the client holds no proxy for them.
+        The object behind an id is dropped when no client holds it and the id may then be reused.
+        Symbols need no releasing.
+        """
+        ...
+
+    def hold(self, proxy: Any, proxy_id: Any) -> None:
+        """
+        Called for every proxy made for an id. Implementations may release the id once all the
+        proxies holding it are garbage collected.
+        """
+
+    def add_mutation_listener(self, listener: Callable[[Iterable[Any] | None], None]) -> bool:
+        """
+        Registers a callable told about the proxy ids of objects that may have changed since they were
+        last read, or None when anything may have. Needed for caching values on the client side.
+        Returns False, registering nothing, for implementations that do not track changes.
+        """
+        return False
+
+    def barrier(self) -> None:
+        """
+        Returns once every operation issued so far has been carried out, raising the error of the
+        first failed one. Only matters for implementations deferring some operations, see RemoteApi.
+        """
+
+    def asynchronous(self) -> AsyncProxyApi:
+        """
+        Awaitable variants of the operations, for asyncio code:
+
+            proxy_id = await proxy_api.asynchronous().create_object(cls_id)
+            msg = await proxy_api.asynchronous().call(proxy_id, "method1")
+        """
+        return AsyncProxyApi(self)
+
+    def get_fingerprint(self) -> str:
+        """Identifies the version of the target package being served, see Symbol"""
+        ...
+
+    def batch(self, ops: list[Op]) -> list[Result]:
+        """
+        Runs independent operations in one go, returning one Result per Op, in the same order.
+        A failing operation does not prevent the others from running. Implementations talking to
+        another process do it in a single round trip, this default just runs them one by one.
+        """
+        results = []
+        for op in ops:
+            try:
+                if op.name not in BATCHABLE_OPS:
+                    raise ValueError(f"unsupported operation {op.name!r}")
+                if any(isinstance(arg, ProxyApi.Promise) for arg in op.args):
+                    raise NotImplementedError("promise pipelining is not supported by this ProxyApi")
+                results.append(ProxyApi.Result(getattr(self, op.name)(*op.args, **op.kwargs)))
+            except Exception as e:
+                results.append(ProxyApi.Result(error=e))
+        return results
+
+    def batched(self) -> Batch:
+        """
+        Context manager queueing operations and sending them as a single batch on exit:
+
+            with proxy_api.batched() as batch:
+                a = batch.get_attr(proxy_id, "a")
+                b = batch.get_attr(proxy_id, "b")
+            a.unwrap(), b.unwrap()
+
+        A Result handed out by the batch can be the target of later operations queued in it. It is
+        then resolved on the server side only and its value is not sent back:
+
+            with proxy_api.batched() as batch:
+                obj = batch.create_object(cls_id)
+                msg = batch.call(obj, "method1")
+            msg.unwrap()
+        """
+        return ProxyApi.Batch(self)
+
     @dataclasses.dataclass
     class AttrWrapper:
         attr: Any
         proxy_id: int | None = None
+
+    @dataclasses.dataclass(frozen=True)
+    class Symbol:
+        """
+        Proxy id addressing a module, or an object in it, by name. Unlike the ids handed out for
+        objects, it stays valid across sessions as long as the fingerprint of the target does not
+        change.
+        """
+        module: str
+        qualname: str = ""
+
+    @dataclasses.dataclass
+    class ManifestEntry:
+        kind: str  # "type", "callable" or "constant"
+        # the type or callable. Constants are left out as their value may change after the import,
+        # except for submodules and the module's own __package__ and __path__
+        attr: Any = None
+        proxy_id: int | None = None
+
+    @dataclasses.dataclass
+    class Manifest:
+        entries: dict[str, ProxyApi.ManifestEntry]
+        all: list[str] | None = None
+
+    @dataclasses.dataclass
+    class Op:
+        name: str
+        args: tuple = ()
+        kwargs: dict = dataclasses.field(default_factory=dict)
+        # only used as the target of later ops in the batch, its outcome is not sent back
+        pipelined: bool = False
+
+    @dataclasses.dataclass(frozen=True)
+    class Promise:
+        """Stands for the outcome of the op at `index` in the same batch, in place of a proxy id"""
+        index: int
+
+    @dataclasses.dataclass
+    class Result:
+        value: Any = None
+        error: BaseException | None = None
+
+        def unwrap(self) -> Any:
+            if self.error is not None:
+                raise self.error
+            return self.value
+
+    class Batch:
+
+        def __init__(self, proxy_api: ProxyApi) -> None:
+            self._proxy_api = proxy_api
+            self._ops: list[ProxyApi.Op] = []
+            self._results: list[ProxyApi.Result] = []
+            self._index_of: dict[int, int] = {}
+
+        def __enter__(self) -> ProxyApi.Batch:
+            return self
+
+        def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+            if exc_type is None:
+                self.flush()
+
+        def get_module(self, fullname: str) -> ProxyApi.Result:
+            return self._queue("get_module", fullname)
+
+        def get_attr(self, proxy_id: int, item: str) -> ProxyApi.Result:
+            return self._queue("get_attr", proxy_id, item)
+
+        def set_attr(self, proxy_id: int, key: str, value: Any) -> ProxyApi.Result:
+            return self._queue("set_attr", proxy_id, key, value)
+
+        def create_object(self, cls_id: int, *args: Any, **kwargs: Any) -> ProxyApi.Result:
+            return self._queue("create_object", cls_id, *args, **kwargs)
+
+        def call(self, proxy_id: int, func_name: str, *args: Any, **kwargs: Any) -> ProxyApi.Result:
+            return self._queue("call", proxy_id, func_name, *args, **kwargs)
+
+        def release(self, proxy_ids: Iterable[int]) -> ProxyApi.Result:
+            return self._queue("release", list(proxy_ids))
+
+        def flush(self) -> None:
+            """Sends the queued operations and fills in the Results handed out for them"""
+            ops, results = self._ops, self._results
+            self._ops, self._results, self._index_of = [], [], {}
+            if not ops:
+                return
+            for result, returned in zip(results, self._proxy_api.batch(ops)):
+                result.value, result.error = returned.value, returned.error
+
+        def _queue(self, name: str, *args: Any, **kwargs: Any) -> ProxyApi.Result:
+            if args and isinstance(args[0], ProxyApi.Result):
+                index = self._index_of[id(args[0])]
+                self._ops[index].pipelined = True
+                args = (ProxyApi.Promise(index),) + args[1:]
+            self._ops.append(ProxyApi.Op(name, args, kwargs))
+            result = ProxyApi.Result(error=RuntimeError("batch not flushed yet"))
+            self._index_of[id(result)] = len(self._results)
+            self._results.append(result)
+            return result
+
+
+class AsyncProxyApi:
+    """
+    Awaitable variants of the operations of a ProxyApi, see ProxyApi.asynchronous. This default runs
+    each operation in the default executor of the running loop, so that it does not block the loop.
+    Implementations talking to another process rather overlap the requests on their connection.
+    """
+
+    def __init__(self, proxy_api: ProxyApi) -> None:
+        self.proxy_api = proxy_api
+
+    async def get_module(self, fullname: str, manifest: bool = False) -> int | tuple[int, ProxyApi.Manifest]:
+        return await self._run(self.proxy_api.get_module, fullname, manifest)
+
+    async def get_attr(self, proxy_id: int, item: str) -> ProxyApi.AttrWrapper:
+        return await self._run(self.proxy_api.get_attr, proxy_id, item)
+
+    async def set_attr(self, proxy_id: int, key: str, value: Any) -> Any:
+        return await self._run(self.proxy_api.set_attr, proxy_id, key, value)
+
+    async def create_object(self, cls_id: int, *args: Any, **kwargs: Any) -> int:
+        return await self._run(self.proxy_api.create_object, cls_id, *args, **kwargs)
+
+    async def call(self, proxy_id: int, func_name: str, *args: Any, **kwargs: Any) -> Any:
+        return await self._run(self.proxy_api.call, proxy_id, func_name, *args, **kwargs)
+
+    async def release(self, proxy_ids: Iterable[int]) -> None:
+        return await self._run(self.proxy_api.release, list(proxy_ids))
+
+    async def batch(self, ops: list[ProxyApi.Op]) -> list[ProxyApi.Result]:
+        return await self._run(self.proxy_api.batch, ops)
+
+    @staticmethod
+    async def _run(operation: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(operation, *args, **kwargs))
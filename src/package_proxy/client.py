@@ -2,30 +2,68 @@ from __future__ import annotations
 
 import abc
 import builtins
+import collections
+import contextlib
+import copy
 import functools
 import importlib.abc
 import importlib.util
 import os
 import sys
+import threading
+import types
+import weakref
+from typing import Any, Iterable
 
-from . import PACKAGE_PROXY_TARGET, PACKAGE_PROXY_API
-from .api import ProxyApi
+from . import (PACKAGE_PROXY_TARGET, PACKAGE_PROXY_API, PACKAGE_PROXY_VALUE_CACHE, PACKAGE_PROXY_CONSTRUCTION,
+               PACKAGE_PROXY_CALLS, PACKAGE_PROXY_IMPORTS)
+from ._bootstrap import ClientFinderStub
+from .api import ProxyApi, special_methods
 
 
 class ClientModuleFinder(importlib.abc.MetaPathFinder):
     def __init__(self, proxy_target):
         self._proxy_target = proxy_target
         self._proxy_api: ProxyApi | None = None
+        # imports of different modules of the target may run in several threads at once
+        self._lock = threading.Lock()
+        self._bypassed = threading.local()
+
+    @contextlib.contextmanager
+    def bypassed(self):
+        """
+        Leaves the imports made by this thread in the block to the next finders in sys.meta_path.
+        Yields the names of the modules of the target this finder was asked for meanwhile, which the
+        next finders were then left to import.
+        """
+        previous = getattr(self._bypassed, "found", None)
+        found = self._bypassed.found = set()
+        try:
+            yield found
+        finally:
+            self._bypassed.found = previous
 
     def find_spec(self, fullname, path, target=None):
         if fullname == self._proxy_target or fullname.startswith(self._proxy_target + "."):
+            found = getattr(self._bypassed, "found", None)
+            if found is not None:
+                found.add(fullname)
+                return None
             if self._proxy_api is None:
-                self._proxy_api = self._get_api_impl(self._proxy_target)
+                with self._lock:
+                    if self._proxy_api is None:
+                        self._proxy_api = self._get_api_impl(self._proxy_target)
             spec = importlib.util.spec_from_loader(fullname,
                                                    ModuleLoader(fullname, self._proxy_api))
             return spec
         return None
 
+    def preload(self) -> None:
+        """Makes the ProxyApi now rather than on the first import of the target, see LocalApi"""
+        with self._lock:
+            if self._proxy_api is None:
+                self._proxy_api = self._get_api_impl(self._proxy_target)
+
     @staticmethod
     def _get_api_impl(proxy_target: str) -> ProxyApi:
         api_class_name = os.environ.get(PACKAGE_PROXY_API)
@@ -51,23 +89,33 @@ class ModuleLoader(importlib.abc.Loader):
         self._proxy_api = api
 
     def create_module(self, spec):
-        proxy_id = self._proxy_api.get_module(self._fullname)
-        proxy_mod = _ModuleProxy(self._fullname, self._proxy_api, proxy_id)
+        if import_mode == "lazy":
+            return _ModuleProxy(self._fullname, self._proxy_api, None)
+        proxy_id, manifest = self._proxy_api.get_module(self._fullname, manifest=True)
+        proxy_mod = _ModuleProxy(self._fullname, self._proxy_api, proxy_id, manifest)
         return proxy_mod
 
     def exec_module(self, module):
-        pass
+        if object.__getattribute__(module, "_proxy_id") is None:
+            # set up by the import machinery, the module can now be resolved
+            with _lazy_lock:
+                _unresolved_modules.setdefault(self._proxy_api, weakref.WeakSet()).add(module)
 
 
 class _ModuleProxy:
+    """
+    Proxy of a module of the target. A proxy_id of None makes it lazy, see resolve_module.
+    """
 
-    def __init__(self, name: str, proxy_api: ProxyApi, proxy_id: int) -> None:
+    def __init__(self, name: str, proxy_api: ProxyApi, proxy_id: int | None,
+                 manifest: ProxyApi.Manifest | None = None) -> None:
         object.__setattr__(self, "__name__", name)
         object.__setattr__(self, "__loader__", ModuleLoader)
         object.__setattr__(self, "__builtins__", builtins.__dict__)
 
         object.__setattr__(self, "_proxy_api", proxy_api)
         object.__setattr__(self, "_proxy_id", proxy_id)
+        object.__setattr__(self, "_manifest", manifest)
 
         object.__setattr__(self, "_type_proxy_builder", TypeProxyBuilder(proxy_api, name))
         object.__setattr__(self, "_callable_proxy_builder", CallableProxyBuilder(proxy_api, proxy_id))
@@ -77,8 +125,25 @@ class _ModuleProxy:
         if item in ['__spec__']:
             return None
 
+        if self._proxy_id is None:
+            if item in ("__package__", "__path__") and self not in _unresolved_modules.get(self._proxy_api, ()):
+                # probed by the import machinery setting up the module, see ModuleLoader.exec_module
+                raise AttributeError(item)
+            resolve_module(self)
+
+        if self._manifest is not None:
+            manifest_entry = self._manifest.entries.get(item)
+            if manifest_entry is not None and manifest_entry.attr is not None:
+                return self._from_manifest(item, manifest_entry)
+            if manifest_entry is None and item == "__path__":
+                raise AttributeError(f"module '{self.__name__}' has no attribute '__path__'")
+
         # Handle __all__ for 'from module import *'
         if item == '__all__':
+            if self._manifest is not None:
+                if self._manifest.all is not None:
+                    return self._manifest.all
+                return [name for name in self._manifest.entries if not name.startswith('_')]
             try:
                 api_attr = self._proxy_api.get_attr(self._proxy_id, item)
                 return api_attr.attr
@@ -88,6 +153,13 @@ class _ModuleProxy:
                 module_dict = api_attr.attr
                 return [name for name in module_dict.keys() if not name.startswith('_')]
 
+        value_cache = value_cache_for(self._proxy_api)
+        if value_cache is not None:
+            hit, value = value_cache.get(self._proxy_id, item)
+            if hit:
+                return value
+            generation = value_cache.generation(self._proxy_id)
+
         api_attr = self._proxy_api.get_attr(self._proxy_id, item)
         attr = api_attr.attr
 
@@ -103,12 +175,77 @@ class _ModuleProxy:
 
         if item in ["__package__", "__path__"]:
             object.__setattr__(self, item, attr)
+        elif value_cache is not None:
+            value_cache.put(self._proxy_id, item, attr, generation)
 
         return attr
 
     def __setattr__(self, key, value):
         object.__setattr__(self, key, value)
 
+    def _from_manifest(self, item: str, manifest_entry: ProxyApi.ManifestEntry):
+        if manifest_entry.kind == "type":
+            api_attr = ProxyApi.AttrWrapper(manifest_entry.attr, manifest_entry.proxy_id)
+            attr = self._type_proxy_builder.build_proxy_for_type_attr(api_attr)
+        elif manifest_entry.kind == "callable":
+            attr = self._callable_proxy_builder.build_for_attr(manifest_entry.attr)
+        else:
+            attr = manifest_entry.attr
+        object.__setattr__(self, item, attr)
+        return attr
+
+
+_lazy_lock = threading.Lock()
+# per ProxyApi, the lazy module proxies not resolved yet
+_unresolved_modules: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def resolve_module(module: _ModuleProxy) -> None:
+    """
+    Gets the proxy id and manifest of a lazy module proxy, made in the "lazy" import mode, which is
+    otherwise done on its first attribute access. The other lazy modules of the same ProxyApi still
+    unresolved are resolved along with it, in a single batch. Errors, such as the module not existing
+    on the server, are only raised for `module`, the others being left to fail on their own access.
+    """
+    proxy_api = object.__getattribute__(module, "_proxy_api")
+    with _lazy_lock:
+        if object.__getattribute__(module, "_proxy_id") is not None:
+            return
+        unresolved = _unresolved_modules.get(proxy_api, weakref.WeakSet())
+        modules = [module] + [other for other in unresolved if other is not module]
+        if len(modules) == 1:
+            # alone, it can come from the schema cache of the ProxyApi, if any
+            results = [ProxyApi.Result(proxy_api.get_module(module.__name__, manifest=True))]
+        else:
+            results = proxy_api.batch([ProxyApi.Op("get_module", (other.__name__,), {"manifest": True})
+                                       for other in modules])
+        for other, result in zip(modules, results):
+            if result.error is not None:
+                continue
+            proxy_id, manifest = result.value
+            object.__setattr__(other, "_manifest", manifest)
+            object.__setattr__(other, "_callable_proxy_builder", CallableProxyBuilder(proxy_api, proxy_id))
+            # the one set by the import machinery, which cannot tell a package from a module
+            other.__dict__.pop("__package__", None)
+            object.__setattr__(other, "_proxy_id", proxy_id)
+            unresolved.discard(other)
+    results[0].unwrap()
+
+
+def _forward_special_methods(proxy_cls: type, names: Iterable[str]) -> None:
+    for name in names:
+        if name in ObjectProxy.__dict__:
+            continue
+
+        def forward(self, *args, _name=name):
+            return self._proxy_api.call(self._proxy_id, _name, *args)
+
+        if name == "__iter__":
+            def forward(self, _forward=forward):
+                return iter(_forward(self))
+
+        type.__setattr__(proxy_cls, name, forward)
+
 
 class TypeProxyBuilder:
 
@@ -168,6 +305,14 @@ class TypeProxyBuilder:
         # else:
         #     proxy_cls = self.ProxyMeta(type_attr, type(type_attr.attr))(*object_proxy_template)
 
+        # objects built on the server only are shells, the special methods are looked up on their type
+        _type = type_attr.attr
+        if "__proxy_id__" in _type.__dict__:
+            names = _type.__dict__.get("__special_methods__", ())
+        else:
+            names = special_methods(_type)
+        _forward_special_methods(proxy_cls, names)
+
         return proxy_cls
 
     @staticmethod
@@ -203,9 +348,16 @@ class CallableProxyBuilder:
 
         proxy_api, parent_id = self._proxy_api, self._parent_id
 
-        @functools.wraps(callable_attr)
-        def _callable(*args, _func=callable_attr.__name__, **kwargs):
-            return proxy_api.call(parent_id, _func, *args, **kwargs)
+        if call_mode == "coroutine":
+            async_api = proxy_api.asynchronous()
+
+            @functools.wraps(callable_attr)
+            async def _callable(*args, _func=callable_attr.__name__, **kwargs):
+                return await async_api.call(parent_id, _func, *args, **kwargs)
+        else:
+            @functools.wraps(callable_attr)
+            def _callable(*args, _func=callable_attr.__name__, **kwargs):
+                return proxy_api.call(parent_id, _func, *args, **kwargs)
 
         # ABCMeta machinery needs this flag in callables to add them to __abstractmethods__
         # in subclasses. This needs to be made in addition to setting the __abstractmethods__
@@ -216,9 +368,147 @@ class CallableProxyBuilder:
         except AttributeError:
             pass
 
+        # sent as the method it proxies when passed back to the ProxyApi, see proxy_reference
+        _callable.__proxy_call__ = (parent_id, callable_attr.__name__)
+        # the callable keeps its parent alive on the other side
+        proxy_api.hold(_callable, parent_id)
         return _callable
 
 
+class ValueCache:
+    """
+    Bounded LRU cache of the plain values read through module and object proxies, so that reading an
+    attribute again does not cost a round trip. The ProxyApi reports the objects that may have
+    changed (see ProxyApi.add_mutation_listener) and their entries are dropped. Changes made by other
+    clients are only learned with the next response from the server.
+
+    Only plain data is cached: immutable values are handed out as they are, containers get copied
+    on every hit so that changing them locally does not alter the cache.
+
+    A value is only stored if its object was not reported changed while it was being read, see
+    generation: the read may have run on the server before the change.
+    """
+
+    _IMMUTABLE = (int, float, complex, bool, str, bytes, type(None))
+
+    def __init__(self, maxsize: int) -> None:
+        self._maxsize = maxsize
+        self._entries: collections.OrderedDict[tuple[Any, str], tuple[Any, bool]] = collections.OrderedDict()
+        self._items_of: dict[Any, set[str]] = {}
+        # bumped by invalidate, for everything and per object. The latter are forgotten all at once,
+        # bumping the former, when there are too many
+        self._epoch = 0
+        self._generations: dict[Any, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, proxy_id: Any, item: str) -> tuple[bool, Any]:
+        with self._lock:
+            entry = self._entries.get((proxy_id, item))
+            if entry is None:
+                return False, None
+            self._entries.move_to_end((proxy_id, item))
+        value, immutable = entry
+        return True, value if immutable else copy.deepcopy(value)
+
+    def generation(self, proxy_id: Any) -> tuple[int, int]:
+        """To be taken before reading a value of the object, and given back to put"""
+        with self._lock:
+            return self._epoch, self._generations.get(proxy_id, 0)
+
+    def put(self, proxy_id: Any, item: str, value: Any, generation: tuple[int, int]) -> None:
+        if not self._is_plain(value):
+            return
+        immutable = isinstance(value, self._IMMUTABLE) or (
+                isinstance(value, (tuple, frozenset)) and self._is_immutable(value))
+        with self._lock:
+            if generation != (self._epoch, self._generations.get(proxy_id, 0)):
+                # invalidated while being read
+                return
+            self._entries[(proxy_id, item)] = (value if immutable else copy.deepcopy(value), immutable)
+            self._entries.move_to_end((proxy_id, item))
+            self._items_of.setdefault(proxy_id, set()).add(item)
+            while len(self._entries) > self._maxsize:
+                (evicted_id, evicted_item), _ = self._entries.popitem(last=False)
+                self._items_of[evicted_id].discard(evicted_item)
+
+    def invalidate(self, proxy_ids: Iterable[Any] | None) -> None:
+        with self._lock:
+            if proxy_ids is None:
+                self._entries.clear()
+                self._items_of.clear()
+                self._epoch += 1
+                self._generations.clear()
+                return
+            for proxy_id in proxy_ids:
+                for item in self._items_of.pop(proxy_id, ()):
+                    self._entries.pop((proxy_id, item), None)
+                self._generations[proxy_id] = self._generations.get(proxy_id, 0) + 1
+            if len(self._generations) > self._maxsize:
+                self._epoch += 1
+                self._generations.clear()
+
+    @classmethod
+    def _is_plain(cls, value: Any) -> bool:
+        if isinstance(value, cls._IMMUTABLE):
+            return True
+        if type(value) in (list, tuple, set, frozenset):
+            return all(cls._is_plain(v) for v in value)
+        if type(value) is dict:
+            return all(cls._is_plain(k) and cls._is_plain(v) for k, v in value.items())
+        return False
+
+    @classmethod
+    def _is_immutable(cls, value: Any) -> bool:
+        if isinstance(value, cls._IMMUTABLE):
+            return True
+        return type(value) in (tuple, frozenset) and all(cls._is_immutable(v) for v in value)
+
+
+_value_caches: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def value_cache_for(proxy_api: ProxyApi) -> ValueCache | None:
+    """The ValueCache of a ProxyApi, None unless enabled with PKG_PROXY_VALUE_CACHE=<max entries>"""
+    try:
+        return _value_caches[proxy_api]
+    except KeyError:
+        pass
+    value_cache = None
+    maxsize = int(os.environ.get(PACKAGE_PROXY_VALUE_CACHE) or 0)
+    if maxsize > 0:
+        value_cache = ValueCache(maxsize)
+        if not proxy_api.add_mutation_listener(value_cache.invalidate):
+            # values could not be told stale
+            value_cache = None
+    _value_caches[proxy_api] = value_cache
+    return value_cache
+
+
+# "remote" builds objects on the server only, the proxy being a shell forwarding everything to
+# it. "local" also builds a local copy of the object, which is what the proxy then returns.
+# Kept for compatibility, it runs every constructor twice and needs the type to be importable
+# on the client side, so it is ignored for types living in another interpreter.
+CONSTRUCTION_MODES = ("remote", "local")
+construction_mode = os.environ.get(PACKAGE_PROXY_CONSTRUCTION) or "remote"
+if construction_mode not in CONSTRUCTION_MODES:
+    raise ImportError(f"{PACKAGE_PROXY_CONSTRUCTION} must be one of {CONSTRUCTION_MODES}")
+
+# "lazy" defers getting a module from the server until its first attribute access, in the spirit
+# of importlib.util.LazyLoader, so that importing modules that end up unused costs nothing. A module
+# that does not exist then only fails on that access. See resolve_module
+IMPORT_MODES = ("eager", "lazy")
+import_mode = os.environ.get(PACKAGE_PROXY_IMPORTS) or "eager"
+if import_mode not in IMPORT_MODES:
+    raise ImportError(f"{PACKAGE_PROXY_IMPORTS} must be one of {IMPORT_MODES}")
+
+# "coroutine" has the proxies of functions and methods made coroutine functions, so that asyncio
+# code awaits their calls, see ProxyApi.asynchronous
+CALL_MODES = ("sync", "coroutine")
+call_mode = os.environ.get(PACKAGE_PROXY_CALLS) or "sync"
+if call_mode not in CALL_MODES:
+    raise ImportError(f"{PACKAGE_PROXY_CALLS} must be one of {CALL_MODES}")
+
+
 class ObjectProxy:
 
     def __new__(cls, *args, **kwargs):
@@ -228,12 +518,31 @@ class ObjectProxy:
         except TypeError:
             # TODO log this as signal of attempt to create types from outside the target package
             pass
+        if proxy_id is not None and (construction_mode == "remote" or "__proxy_id__" in cls._cls.__dict__):
+            # a shell holding just the proxy id, the object was constructed on the server only
+            instance = object.__new__(cls)
+            object.__setattr__(instance, "_proxy_id", proxy_id)
+            cls._proxy_api.hold(instance, proxy_id)
+            return instance
         instance = cls._cls(*args, **kwargs)
         # object.__setattr__(instance, "__mro__", cls._cls.__mro__)
         object.__setattr__(instance, "_proxy_id", proxy_id)
+        if proxy_id is not None:
+            cls._proxy_api.hold(instance, proxy_id)
         return instance
 
+    def __init__(self, *args, **kwargs):
+        # the object was already initialised remotely by create_object
+        pass
+
     def __getattr__(self, item):
+        value_cache = value_cache_for(self._proxy_api)
+        if value_cache is not None:
+            hit, value = value_cache.get(self._proxy_id, item)
+            if hit:
+                return value
+            generation = value_cache.generation(self._proxy_id)
+
         api_attr = self._proxy_api.get_attr(self._proxy_id, item)
         attr = api_attr.attr
         if callable(attr):
@@ -241,6 +550,8 @@ class ObjectProxy:
             object.__setattr__(self, item, _callable)
             return _callable
 
+        if value_cache is not None:
+            value_cache.put(self._proxy_id, item, attr, generation)
         return attr
 
     @property
@@ -252,7 +563,122 @@ class ObjectProxy:
         self._proxy_api.set_attr(self._proxy_id, key, value)
 
 
+class Pipeline:
+    """
+    Records the attribute accesses and calls made on a proxy, without running them, so that the whole
+    chain can be resolved on the server in a single round trip:
+
+        msg = resolve(pipeline(mod).C1_1().method1())
+
+    Only the final value travels back, intermediate objects never leave the server.
+    """
+
+    def __init__(self, proxy_api: ProxyApi, target: int, steps: tuple = ()) -> None:
+        self.__proxy_api = proxy_api
+        self.__target = target
+        self.__steps = steps
+        proxy_api.hold(self, target)
+
+    def __getattr__(self, item):
+        if item.startswith("__"):
+            raise AttributeError(item)
+        return Pipeline(self.__proxy_api, self.__target, self.__steps + (("get_attr", item, (), {}),))
+
+    def __call__(self, *args, **kwargs):
+        steps = self.__steps
+        if steps and steps[-1][0] == "get_attr":
+            # obj.method(...) is a single call on obj
+            steps, func_name = steps[:-1], steps[-1][1]
+        else:
+            func_name = "__call__"
+        return Pipeline(self.__proxy_api, self.__target, steps + (("call", func_name, args, kwargs),))
+
+    def _resolve(self) -> Any:
+        if not self.__steps:
+            raise ValueError("nothing to resolve in an empty pipeline")
+
+        last = len(self.__steps) - 1
+        ops = [ProxyApi.Op(name, (ProxyApi.Promise(i - 1) if i else self.__target, item) + args, kwargs,
+                           pipelined=i < last)
+               for i, (name, item, args, kwargs) in enumerate(self.__steps)]
+        value = self.__proxy_api.batch(ops)[last].unwrap()
+
+        if ops[last].name == "get_attr":
+            if isinstance(value.attr, type):
+                return TypeProxyBuilder(self.__proxy_api, value.attr.__module__).build_proxy_for_type_attr(value)
+            return value.attr
+        return value
+
+
+_PLAIN_TYPES = frozenset({int, float, complex, bool, str, bytes, bytearray, type(None),
+                          tuple, list, dict, set, frozenset})
+
+
+def proxy_reference(obj: Any) -> tuple[Any, str | None] | None:
+    """
+    Tells what a proxy passed back to the ProxyApi stands for: the proxy id of the object, and the
+    name of the method when obj proxies one. None when obj is not a proxy. Local copies made in the
+    "local" construction mode are not proxies, they are sent as they are.
+
+    Called while pickling requests, it makes none of its own: lazy modules not resolved yet are sent
+    by name, which the server resolves itself.
+    """
+    obj_type = type(obj)
+    if obj_type in _PLAIN_TYPES:
+        return None
+    if obj_type is _ModuleProxy:
+        proxy_id = object.__getattribute__(obj, "_proxy_id")
+        if proxy_id is None:
+            proxy_id = ProxyApi.Symbol(object.__getattribute__(obj, "__name__"))
+        return proxy_id, None
+    if isinstance(obj, type):
+        cls_dict = obj.__dict__
+        if "_cls_id" in cls_dict and "_proxy_api" in cls_dict:
+            return cls_dict["_cls_id"], None
+        if cls_dict.get("__proxy_id__") is not None:
+            return cls_dict["__proxy_id__"], None
+        return None
+    if obj_type is types.FunctionType:
+        func_dict = obj.__dict__
+        if "__proxy_call__" in func_dict:
+            return func_dict["__proxy_call__"]
+        if func_dict.get("__proxy_id__") is not None:
+            return func_dict["__proxy_id__"], None
+        return None
+    try:
+        type.__getattribute__(obj_type, "_cls_id")
+        return object.__getattribute__(obj, "_proxy_id"), None
+    except AttributeError:
+        return None
+
+
+def barrier(proxy) -> None:
+    """Waits for the writes deferred by the ProxyApi behind a proxy, see ProxyApi.barrier"""
+    if isinstance(proxy, type):
+        proxy_api = type.__getattribute__(proxy, "_proxy_api")
+    else:
+        proxy_api = object.__getattribute__(proxy, "_proxy_api")
+    proxy_api.barrier()
+
+
+def pipeline(proxy) -> Pipeline:
+    """Starts recording a chain of attribute accesses and calls on a module, type or object proxy"""
+    if isinstance(proxy, type):
+        target = type.__getattribute__(proxy, "_cls_id")
+    elif type(proxy) is _ModuleProxy:
+        resolve_module(proxy)
+        target = object.__getattribute__(proxy, "_proxy_id")
+    else:
+        target = object.__getattribute__(proxy, "_proxy_id")
+    return Pipeline(object.__getattribute__(proxy, "_proxy_api"), target)
+
+
+def resolve(chain: Pipeline) -> Any:
+    """Runs a chain recorded with pipeline() on the server, returning its final value"""
+    return chain._resolve()
+
+
 target_package = os.environ.get(PACKAGE_PROXY_TARGET)
-if not any(isinstance(f, ClientModuleFinder) for f in sys.meta_path):
+if target_package is not None and not any(isinstance(f, ClientModuleFinder) for f in sys.meta_path):
     finder = ClientModuleFinder(proxy_target=target_package)
-    sys.meta_path.insert(0, finder)
+    sys.meta_path[:] = [finder] + [f for f in sys.meta_path if not isinstance(f, ClientFinderStub)]
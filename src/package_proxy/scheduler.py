@@ -0,0 +1,185 @@
+"""
+Runs the requests of a ProxyServer on a fixed pool of worker threads.
+
+Requests are submitted with an affinity key, the object they work on. Requests with the same key run
+one at a time, in the order they were submitted, so that the calls made on an object are not
+reordered, while requests on different objects, or without a key, run in parallel. A request held
+back by its key does not take a worker while it waits.
+
+Requests also come in two lanes, with a queue each. CHEAP requests, reads and writes of attributes
+and the like, go first, and `reserved` workers only ever run those, so that they do not wait for the
+HEAVY ones, calls, even when those keep all the other workers busy.
+
+Once `max_in_flight` requests are queued or running, submitting waits up to `admission_wait`
+seconds for one of them to complete, then raises Overloaded. The server, submitting from the thread
+reading the connection, stops reading it meanwhile, which holds back the client.
+"""
+from __future__ import annotations
+
+import collections
+import dataclasses
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable
+
+CHEAP = "cheap"
+HEAVY = "heavy"
+LANES = (CHEAP, HEAVY)
+
+
+class Overloaded(RuntimeError):
+    """Raised for a request submitted while too many are in flight already"""
+
+
+@dataclasses.dataclass
+class Stats:
+    workers: int
+    # submitted and not started yet, including the requests held back by their key
+    queued: int
+    running: int
+    completed: int
+    # dropped before they started, see Future.cancel
+    cancelled: int
+    rejected: int
+    queued_by_lane: dict[str, int]
+    # per worker, the share of the time spent running requests since the scheduler started
+    utilisation: list[float]
+
+
+@dataclasses.dataclass
+class _Task:
+    fn: Callable[..., Any]
+    args: tuple
+    key: Hashable | None
+    lane: str
+    future: Future
+
+
+class Scheduler:
+
+    def __init__(self, workers: int, name: str = "proxy-request", reserved: int | None = None,
+                 max_in_flight: int = 0, admission_wait: float = 0.0) -> None:
+        if workers < 1:
+            raise ValueError(f"workers must be positive, got {workers}")
+        if reserved is None:
+            reserved = workers // 4
+        if not 0 <= reserved < workers:
+            raise ValueError(f"reserved workers must be fewer than the {workers} workers, got {reserved}")
+        self._heavy_workers = workers - reserved
+        self._max_in_flight = max_in_flight
+        self._admission_wait = admission_wait
+        lock = threading.Lock()
+        # workers wait for tasks, submitters for room
+        self._condition = threading.Condition(lock)
+        self._room = threading.Condition(lock)
+        self._ready: dict[str, collections.deque[_Task]] = {lane: collections.deque() for lane in LANES}
+        # the tasks waiting for the one running, or ready, with the same key
+        self._keys: dict[Hashable, collections.deque[_Task]] = {}
+        self._queued = self._running = self._completed = self._cancelled = self._rejected = 0
+        self._queued_by_lane = dict.fromkeys(LANES, 0)
+        self._running_heavy = 0
+        self._busy = [0.0] * workers
+        self._started = time.monotonic()
+        self._stopped = False
+        for index in range(workers):
+            threading.Thread(target=self._work, args=(index,), name=f"{name}-{index}", daemon=True).start()
+
+    def submit(self, fn: Callable[..., Any], *args: Any, key: Hashable | None = None,
+               lane: str = HEAVY) -> Future:
+        if lane not in LANES:
+            raise ValueError(f"lane must be one of {LANES}, got {lane!r}")
+        task = _Task(fn, args, key, lane, Future())
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("scheduler shut down")
+            self._admit()
+            self._queued += 1
+            self._queued_by_lane[lane] += 1
+            if key is not None:
+                waiting = self._keys.get(key)
+                if waiting is not None:
+                    waiting.append(task)
+                    return task.future
+                self._keys[key] = collections.deque()
+            self._ready[lane].append(task)
+            self._condition.notify()
+        return task.future
+
+    def stats(self) -> Stats:
+        with self._condition:
+            elapsed = max(time.monotonic() - self._started, 1e-9)
+            return Stats(len(self._busy), self._queued, self._running, self._completed, self._cancelled,
+                         self._rejected, dict(self._queued_by_lane), [busy / elapsed for busy in self._busy])
+
+    def shutdown(self) -> None:
+        """Stops the workers once done with their current request, the queued ones are dropped"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+            self._room.notify_all()
+
+    def _admit(self) -> None:
+        """Waits for room for one more task, called with the lock held"""
+        if not self._max_in_flight:
+            return
+        deadline = time.monotonic() + self._admission_wait
+        while self._queued + self._running >= self._max_in_flight:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stopped:
+                self._rejected += 1
+                raise Overloaded(f"server overloaded, {self._queued + self._running} requests in flight "
+                                 f"for a limit of {self._max_in_flight}")
+            self._room.wait(remaining)
+
+    def _next(self) -> _Task | None:
+        """The task to run next, called with the lock held"""
+        if self._ready[CHEAP]:
+            return self._ready[CHEAP].popleft()
+        if self._ready[HEAVY] and self._running_heavy < self._heavy_workers:
+            self._running_heavy += 1
+            return self._ready[HEAVY].popleft()
+        return None
+
+    def _work(self, index: int) -> None:
+        while True:
+            with self._condition:
+                while not self._stopped and (task := self._next()) is None:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                self._queued -= 1
+                self._queued_by_lane[task.lane] -= 1
+                self._running += 1
+            started = time.monotonic()
+            result = error = None
+            run = task.future.set_running_or_notify_cancel()
+            if run:
+                try:
+                    result = task.fn(*task.args)
+                except BaseException as e:
+                    error = e
+            with self._condition:
+                self._busy[index] += time.monotonic() - started
+                self._running -= 1
+                if run:
+                    self._completed += 1
+                else:
+                    self._cancelled += 1
+                if task.lane == HEAVY:
+                    self._running_heavy -= 1
+                if task.key is not None:
+                    waiting = self._keys[task.key]
+                    if waiting:
+                        self._ready[waiting[0].lane].append(waiting.popleft())
+                    else:
+                        del self._keys[task.key]
+                if any(self._ready.values()):
+                    self._condition.notify()
+                self._room.notify()
+            # counted as completed first, as the callbacks of the future may answer the client,
+            # which may then submit its next request at once
+            if run and error is not None:
+                task.future.set_exception(error)
+            elif run:
+                task.future.set_result(result)
@@ -0,0 +1,523 @@
+from __future__ import annotations
+
+import argparse
+import contextlib
+import dataclasses
+import functools
+import importlib
+import ipaddress
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from types import ModuleType
+from typing import Any
+
+from package_proxy import PACKAGE_PROXY_ADDRESS
+from package_proxy._bootstrap import ClientFinderStub
+from package_proxy._local.api import LocalApi, Session
+from package_proxy._remote import wire
+from package_proxy._remote.ring import RingChannel
+from package_proxy._remote.shared_buffers import SharedBuffers
+from package_proxy.api import BATCHABLE_OPS, DeadlineExceeded, ProxyApi, timeout
+from package_proxy.client import ClientModuleFinder
+from package_proxy.scheduler import CHEAP, HEAVY, Overloaded, Scheduler
+
+_OPS = BATCHABLE_OPS | {"batch", "get_fingerprint"}
+# ops run in the order they were received for the object they are on, see Scheduler. Reads are left
+# out, they may run alongside a call on the same object as they would in threads of the client
+_AFFINE_OPS = frozenset({"call", "set_attr"})
+# ops answered from what the server has at hand, as opposed to running target code for long. So is
+# get_module, once the module was imported
+_CHEAP_OPS = frozenset({"get_attr", "set_attr", "release", "get_fingerprint", "lease", "stats"})
+# ops run as soon as they are received, not queued behind the requests they are about nor turned
+# away when the server is overloaded, as they keep connections alive or relieve the server
+_INLINE_OPS = frozenset({"cancel", "lease", "release", "stats"})
+DEFAULT_LEASE = 300.0
+DEFAULT_WORKERS = 16
+DEFAULT_ADMISSION_WAIT = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+class ResultPolicy:
+    """
+    Decides which results are sent by value and which stay on the server, the client getting a
+    proxy to them. Rules are looked up first by the name of the attribute or method, either alone
+    ("method1") or qualified by the class of its owner ("C1_1.method1"), then by the qualified name
+    of the type of the value ("builtins.dict"), along its mro. A rule is "value", "reference", or a
+    size: values with a len() above it are sent by reference.
+
+    This only matters for values the client could load, the others are always sent by reference.
+    Numbers, booleans and None are always sent by value.
+    """
+
+    VALUE = "value"
+    REFERENCE = "reference"
+
+    _ALWAYS_BY_VALUE = frozenset({type(None), bool, int, float, complex})
+
+    def __init__(self, rules: dict[str, str | int] | None = None) -> None:
+        self._rules: dict[str, str | int] = {}
+        for name, rule in (rules or {}).items():
+            self.set_rule(name, rule)
+
+    def set_rule(self, name: str, rule: str | int) -> None:
+        if rule not in (self.VALUE, self.REFERENCE) and not isinstance(rule, int):
+            raise ValueError(f"rule for {name!r} must be {self.VALUE!r}, {self.REFERENCE!r} or a size")
+        self._rules[name] = rule
+
+    @classmethod
+    def parse(cls, specs: list[str]) -> ResultPolicy:
+        """From NAME=RULE strings, as given on the command line"""
+        rules: dict[str, str | int] = {}
+        for spec in specs:
+            name, sep, rule = spec.partition("=")
+            if not sep:
+                raise ValueError(f"expected NAME=RULE, got {spec!r}")
+            rules[name] = int(rule) if rule.isdigit() else rule
+        return cls(rules)
+
+    def by_reference(self, value: Any, name: str | None = None, owner: Any = None) -> bool:
+        if not self._rules or type(value) in self._ALWAYS_BY_VALUE:
+            return False
+        rule = None
+        if name is not None:
+            rule = self._rules.get(name)
+            if rule is None and owner is not None:
+                owner_cls = owner if isinstance(owner, type) else type(owner)
+                rule = self._rules.get(f"{owner_cls.__qualname__}.{name}")
+        if rule is None:
+            for cls in type(value).__mro__:
+                rule = self._rules.get(f"{cls.__module__}.{cls.__qualname__}")
+                if rule is not None:
+                    break
+        if rule is None or rule == self.VALUE:
+            return False
+        if rule == self.REFERENCE:
+            return True
+        try:
+            return len(value) > rule
+        except TypeError:
+            return False
+
+
+class HostedApi(LocalApi):
+    """
+    LocalApi for an interpreter dedicated to hosting the target package. There are no proxy modules
+    to collide with, so the target package is imported as usual and kept under its own name in
+    sys.modules.
+    """
+
+    def __init__(self, target_package: str, result_policy: ResultPolicy | None = None) -> None:
+        super().__init__(target_package)
+        self.result_policy = result_policy or ResultPolicy()
+
+    def _install_mod_tracker(self) -> None:
+        sys.meta_path[:] = [f for f in sys.meta_path if not isinstance(f, (ClientModuleFinder, ClientFinderStub))]
+
+    def _load_module(self, module_name) -> ModuleType:
+        return importlib.import_module(module_name)
+
+    def _dereference(self, value: Any) -> Any:
+        # proxies in the arguments were replaced while loading the request already
+        return value
+
+    def _sent(self, value: Any, name: str, owner: Any) -> Any:
+        if self.result_policy.by_reference(value, name, owner):
+            return wire.ByReference(value)
+        return value
+
+
+@dataclasses.dataclass
+class _Request:
+    request_id: int
+    op: str = ""
+    args: tuple = ()
+    kwargs: dict = dataclasses.field(default_factory=dict)
+    error: Exception | None = None
+    # time.monotonic() past which it is not worth starting
+    deadline: float | None = None
+    # id of the object the request works on, if it is to run after the earlier requests on it, see
+    # ProxyServer.load_request
+    affinity: Any = None
+
+    @property
+    def lane(self) -> str:
+        if self.error is not None:
+            return CHEAP
+        if self.op == "get_module":
+            # a first import runs the code of the module
+            return CHEAP if self.args and self.args[0] in sys.modules else HEAVY
+        return CHEAP if self.op in _CHEAP_OPS else HEAVY
+
+
+class ProxyServer:
+    """
+    Serves a ProxyApi to RemoteApi clients over a unix or tcp socket, or over shared memory rings
+    set up in the hello of the connection. Each connection gets a thread reading frames, and the
+    requests run concurrently on a Scheduler of `workers` threads, shared by all connections.
+    Calls and writes on the same object run in the order they were received, others in parallel.
+    Responses are sent as they are ready, so a slow call does not hold back the requests made after
+    it. The "stats" request returns the queue depth and utilisation of the workers, see
+    scheduler.Stats.
+
+    Calls, object creations, batches and first imports run on the HEAVY lane of the scheduler, the
+    other requests on the CHEAP one, which gets `reserved` workers of its own. Past `max_in_flight` requests,
+    reading the connections pauses for up to `admission_wait` seconds, then the requests are
+    answered with scheduler.Overloaded.
+
+    A request whose deadline is over by the time a worker gets to it fails with DeadlineExceeded
+    without running, and target code can read the deadline of the request it runs for with
+    api.deadline(). The "cancel" request drops the given requests of the connection, if they have
+    not started yet, and so does the connection closing. Like "lease", "release" and "stats", it is
+    answered by the thread reading the connection, never queued nor turned away.
+
+    With `processes` above 1, as many processes accept connections on the same socket, each with
+    workers of its own, for target code keeping the GIL busy. Every process holds its own copy of
+    the target package and of the objects of the connections it serves, so clients of different
+    processes do not see the changes made by each other.
+
+    Every response also tells the client which objects were mutated since its previous response, by
+    any client, so that it can drop the values it cached for them.
+
+    Each connection is a Session of the api, holding the ids handed out on it until the client
+    releases them or disconnects. A connection without requests for longer than `lease` seconds is
+    taken for a crashed client: it is closed and its ids released. Clients keep idle connections
+    alive with the "lease" request, which returns the lease (None for no expiry).
+
+    Requests are unpickled as they come, without authenticating the client: whoever can connect can
+    run any code as the user of the server. Unix sockets are left to the permissions of their
+    directory, and tcp addresses must be loopback ones unless `allow_remote` is set.
+    """
+
+    def __init__(self, api: LocalApi, address: str, lease: float | None = DEFAULT_LEASE,
+                 workers: int = DEFAULT_WORKERS, processes: int = 1, reserved: int | None = None,
+                 max_in_flight: int = 0, admission_wait: float = DEFAULT_ADMISSION_WAIT,
+                 allow_remote: bool = False) -> None:
+        if processes > 1 and not hasattr(os, "fork"):
+            raise ValueError(f"more than one process needs os.fork, not available on {sys.platform}")
+        if not allow_remote and not _is_local(address):
+            raise ValueError(f"{address} is not a loopback address, anyone reaching it could run code "
+                             f"on this host, see allow_remote")
+        self._api = api
+        self._address = address
+        self._lease = lease
+        self._processes = processes
+        self._scheduler_args = dict(workers=workers, reserved=reserved, max_in_flight=max_in_flight,
+                                    admission_wait=admission_wait)
+        self._scheduler: Scheduler | None = None
+        self._lock = threading.Lock()
+        self._connections: dict[Session, socket.socket] = {}
+        # the requests of each connection not answered yet
+        self._requests: dict[Session, dict[int, Future]] = {}
+        self._stopped = threading.Event()
+        self._server = self._create_server(address)
+
+    def serve_forever(self) -> None:
+        logger.info(f"serving on {self._address}")
+        children = []
+        for _ in range(self._processes - 1):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self._serve()
+                finally:
+                    os._exit(0)
+            children.append(pid)
+        if children:
+            # for the finally below to stop them
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            self._serve()
+        finally:
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            self._server.server_close()
+            family, addr = wire.parse_address(self._address)
+            if family == socket.AF_UNIX and os.path.exists(addr):
+                os.unlink(addr)
+
+    def _serve(self) -> None:
+        # threads do not survive fork, each process starts its own
+        self._scheduler = Scheduler(**self._scheduler_args)
+        if self._lease:
+            threading.Thread(target=self._expire_leases, name="lease-expiry", daemon=True).start()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._stopped.set()
+            self._scheduler.shutdown()
+
+    def shutdown(self) -> None:
+        self._server.shutdown()
+
+    def handle_request(self, payload: bytes, session: Session, protocol: int = wire.PROTOCOL,
+                       shared: SharedBuffers | None = None, request_id: int = 0) -> bytes:
+        request = self.load_request(payload, session, request_id, shared)
+        return self.run_request(request, session, protocol, shared)
+
+    def load_request(self, payload: bytes, session: Session, request_id: int = 0,
+                     shared: SharedBuffers | None = None) -> _Request:
+        """
+        Unpickles a request and releases the ids it gives back, in the order requests come in. Its
+        shared buffers are only read if the client asked for shared memory, `shared` then set.
+        """
+        session.last_seen = time.monotonic()
+        request = _Request(request_id)
+        try:
+            with self._api.session(session, request_id):
+                request.op, request.args, request.kwargs, released, seen, time_left = wire.loads_request(
+                    payload, self._api._resolve, shared is not None)
+                if time_left is not None:
+                    request.deadline = session.last_seen + time_left
+                # released first, the response may hand out the same ids again
+                self._api.release(released, seen)
+                request.affinity = self._affinity(request)
+        except Exception as e:
+            request.error = e
+        return request
+
+    def _affinity(self, request: _Request) -> Any:
+        """
+        The id of the object a call or a write is on. Modules, types and functions are not worth
+        ordering the requests of all clients on, a method called on its class is on the receiver.
+        """
+        if request.op not in _AFFINE_OPS or not request.args:
+            return None
+        try:
+            target = self._api._resolve(request.args[0])
+        except Exception:
+            return None
+        if isinstance(target, type) and request.op == "call" and len(request.args) > 2:
+            return self._api._table_id(request.args[2])
+        if isinstance(request.args[0], ProxyApi.Symbol) or isinstance(target, type):
+            return None
+        return request.args[0]
+
+    def run_request(self, request: _Request, session: Session, protocol: int = wire.PROTOCOL,
+                    shared: SharedBuffers | None = None) -> bytes:
+        op, args, kwargs = request.op, request.args, request.kwargs
+        try:
+            if request.error is not None:
+                raise request.error
+            bounded = contextlib.nullcontext()
+            if request.deadline is not None:
+                remaining = request.deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded(f"deadline of {op!r} passed before it started")
+                bounded = timeout(remaining)
+            with self._api.session(session, request.request_id), bounded:
+                if op == "lease":
+                    result = self._lease
+                elif op == "cancel":
+                    result = self._cancel(session, *args)
+                elif op == "stats":
+                    result = dataclasses.asdict(self._scheduler.stats()) if self._scheduler else None
+                elif op in _OPS:
+                    result = getattr(self._api, op)(*args, **kwargs)
+                else:
+                    raise ValueError(f"unsupported operation {op!r}")
+            if op == "batch":
+                for op_result in result:
+                    if op_result.error is not None:
+                        op_result.error = wire.portable_error(op_result.error)
+            ok = True
+        except Exception as e:
+            result, ok = e, False
+        with self._api.session(session, request.request_id):
+            with self._lock:
+                session.epoch, mutated = self._api.mutations_since(session.epoch)
+            return wire.dumps_response(ok, result, self._api._ref_id, mutated, protocol, shared)
+
+    def _cancel(self, session: Session, request_ids: list[int]) -> list[int]:
+        """Cancels the requests of session not started yet, returns those that were"""
+        requests = self._requests.get(session, {})
+        return [request_id for request_id in request_ids
+                if (future := requests.get(request_id)) is not None and future.cancel()]
+
+    def _expire_leases(self) -> None:
+        while not self._stopped.wait(self._lease / 4):
+            deadline = time.monotonic() - self._lease
+            with self._lock:
+                expired = [(s, c) for s, c in self._connections.items() if s.last_seen < deadline]
+            for session, connection in expired:
+                logger.info(f"lease expired, closing connection {connection}")
+                try:
+                    # the connection handler notices and closes the session
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self._close_session(session)
+
+    def _close_session(self, session: Session) -> None:
+        with self._lock:
+            self._connections.pop(session, None)
+            self._requests.pop(session, None)
+            self._api.close_session(session)
+
+    def _create_server(self, address: str) -> socketserver.BaseServer:
+        proxy_server = self
+
+        class _ConnectionHandler(socketserver.BaseRequestHandler):
+            def handle(self) -> None:
+                session = Session()
+                protocol, shared = wire.PROTOCOL, None
+                channel = wire.SocketChannel(self.request)
+                send_lock = threading.Lock()
+                in_flight: dict[int, Future] = {}
+                # once the connection is closed, the requests still running, see finally below
+                closed, still_running = False, 0
+
+                def respond(request_id: int, response: Future) -> None:
+                    in_flight.pop(request_id, None)
+                    if response.cancelled():
+                        return
+                    with send_lock:
+                        if closed:
+                            return
+                        channel.send_frame(request_id, response.result())
+
+                def close() -> None:
+                    proxy_server._close_session(session)
+                    if shared is not None:
+                        shared.close()
+                    channel.close()
+
+                def done(response: Future) -> None:
+                    nonlocal still_running
+                    with send_lock:
+                        still_running -= 1
+                        last = not still_running
+                    if last:
+                        close()
+
+                with proxy_server._lock:
+                    session.epoch = proxy_server._api.mutations_since(0)[0]
+                    proxy_server._connections[session] = self.request
+                    proxy_server._requests[session] = in_flight
+                try:
+                    while True:
+                        frame = channel.recv_frame()
+                        if frame is None:
+                            return
+                        request_id, payload = frame
+                        if request_id == wire.HELLO_ID:
+                            protocol, shared, rings = wire.negotiate(payload)
+                            if rings is not None:
+                                channel = RingChannel.attach(rings, self.request)
+                            continue
+                        request = proxy_server.load_request(payload, session, request_id, shared)
+                        future = None
+                        if request.op not in _INLINE_OPS:
+                            try:
+                                future = proxy_server._scheduler.submit(
+                                    proxy_server.run_request, request, session, protocol, shared,
+                                    key=request.affinity, lane=request.lane)
+                            except Overloaded as e:
+                                request.error = e
+                        if future is None:
+                            future = Future()
+                            future.set_result(proxy_server.run_request(request, session, protocol, shared))
+                        in_flight[request_id] = future
+                        # sent from the worker, once the response is ready
+                        future.add_done_callback(functools.partial(respond, request_id))
+                except OSError:
+                    if session in proxy_server._connections:
+                        raise
+                finally:
+                    # what the client will not read is not worth running. Nothing may be handed out
+                    # on the session once closed though, so it is closed by the last of the requests
+                    # already running to complete, not waited for here: they may take long, or never
+                    # complete once the scheduler is shut down
+                    with proxy_server._lock:
+                        proxy_server._connections.pop(session, None)
+                    with send_lock:
+                        closed = True
+                        running = [future for future in list(in_flight.values())
+                                   if not future.cancel() and not future.done()]
+                        still_running = len(running)
+                    if not running:
+                        close()
+                    for future in running:
+                        future.add_done_callback(done)
+
+        family, addr = wire.parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(addr):
+                os.unlink(addr)
+            return _UnixServer(addr, _ConnectionHandler)
+        return _TcpServer(addr, _ConnectionHandler)
+
+
+def _is_local(address: str) -> bool:
+    family, addr = wire.parse_address(address)
+    if family == socket.AF_UNIX:
+        return True
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(addr[0])).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class _TcpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m package_proxy",
+                                     description="Hosts a package and serves it to package_proxy clients. "
+                                                 "Requests are unpickled without authentication: anyone "
+                                                 "who can connect can run any code as the user of the server.")
+    parser.add_argument("--target", required=True, help="root package to serve")
+    parser.add_argument("--address", default=os.environ.get(PACKAGE_PROXY_ADDRESS),
+                        help=f"unix:/path or [tcp:]host:port, host being a loopback address unless "
+                             f"--allow-remote is given (default: ${PACKAGE_PROXY_ADDRESS})")
+    parser.add_argument("--allow-remote", action="store_true",
+                        help="listen on tcp addresses other hosts can reach, letting them run code "
+                             "here: only on networks where every host is trusted")
+    parser.add_argument("--lease", type=float, default=DEFAULT_LEASE,
+                        help="seconds an idle client keeps its objects, 0 for ever (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="requests run concurrently, of all connections (default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="processes accepting connections, each with its own workers and copy of "
+                             "the target (default: %(default)s)")
+    parser.add_argument("--reserved-workers", type=int, default=None,
+                        help="workers kept for attribute reads, writes and the like, not calls "
+                             "(default: a quarter of --workers)")
+    parser.add_argument("--max-in-flight", type=int, default=0,
+                        help="requests queued or running past which new ones wait, 0 for no limit "
+                             "(default: %(default)s)")
+    parser.add_argument("--admission-wait", type=float, default=DEFAULT_ADMISSION_WAIT,
+                        help="seconds a request waits past --max-in-flight before being rejected "
+                             "(default: %(default)s)")
+    parser.add_argument("--result-policy", action="append", default=[], metavar="NAME=RULE",
+                        help="send the values of an attribute, method or type by 'value', by "
+                             "'reference' or by reference above a size, see ResultPolicy")
+    args = parser.parse_args(argv)
+    if args.address is None:
+        parser.error(f"--address or {PACKAGE_PROXY_ADDRESS} is required")
+
+    try:
+        result_policy = ResultPolicy.parse(args.result_policy)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        server = ProxyServer(HostedApi(args.target, result_policy), args.address, args.lease or None,
+                             args.workers, args.processes, args.reserved_workers, args.max_in_flight,
+                             args.admission_wait, args.allow_remote)
+    except ValueError as e:
+        parser.error(str(e))
+    server.serve_forever()
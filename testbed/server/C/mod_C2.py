@@ -0,0 +1,52 @@
+import threading
+import time
+
+
+class C2_1:
+
+    def __init__(self, *items):
+        self._items = list(items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __eq__(self, other) -> bool:
+        return list(self) == list(other)
+
+    def __repr__(self) -> str:
+        return f"C2_1{tuple(self._items)}"
+
+
+class C2_2:
+    """value is read in two steps, letting another thread change it in between"""
+
+    def __init__(self):
+        self._value = 1
+        self.reading = threading.Event()
+        self.changed = threading.Event()
+
+    @property
+    def value(self) -> int:
+        value = self._value
+        self.reading.set()
+        self.changed.wait(5)
+        return value
+
+
+class C2_3:
+    """Takes its time, counting the waits carried out"""
+
+    def __init__(self, seconds: float = 0.0):
+        time.sleep(seconds)
+        self.waits = 0
+
+    def wait(self, seconds: float) -> int:
+        time.sleep(seconds)
+        self.waits += 1
+        return self.waits
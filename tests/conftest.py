@@ -5,9 +5,11 @@ import logging
 import os
 import shutil
 import site
+import socket
 import subprocess
 import sys
 import textwrap
+import time
 from pathlib import Path
 
 import pytest
@@ -23,6 +25,7 @@ class PythonInterpreterInitializedWithPath:
         self._python_path: list[str] = [os.path.join(_PROJECT_ROOT, f) for f in folder]
         self._package_proxy_target: str | None = None
         self._package_proxy_api_impl: str | None = None
+        self._env: dict[str, str] = {}
 
     def __enter__(self):
         return self
@@ -36,9 +39,10 @@ class PythonInterpreterInitializedWithPath:
         env_dict["PYTHONPATH"] = os.pathsep.join(self._python_path)
         # env_dict = {"PYTHONPATH": os.pathsep.join(self._python_path)}
         if self._package_proxy_target is not None:
-            env_dict["PACKAGE_PROXY_TARGET"] = self._package_proxy_target
+            env_dict["PKG_PROXY_TARGET"] = self._package_proxy_target
         if self._package_proxy_api_impl is not None:
-            env_dict["PACKAGE_PROXY_API_IMPL"] = self._package_proxy_api_impl
+            env_dict["PKG_PROXY_API"] = self._package_proxy_api_impl
+        env_dict.update(self._env)
 
         return subprocess.Popen(
             ["python3", "-c", code],
@@ -77,9 +81,7 @@ class PythonInterpreterInitializedWithPath:
         # Only fail if stderr contains a real Python error
         try:
             assert (not stderr
-                    or stderr.startswith("Connected to: <socket")  # ignore debugger noise
-                    or stderr.startswith(
-                        "package_proxy successfully imported"))  # ignore boostrap messages
+                    or stderr.startswith("Connected to: <socket"))  # ignore debugger noise
         except AssertionError as e:
             logging.error(stderr)
             raise
@@ -106,6 +108,9 @@ class PythonInterpreterInitializedWithPath:
     def setenv_PACKAGE_PROXY_API_IMPL(self, api_impl_cls: str) -> None:
         self._package_proxy_api_impl = api_impl_cls
 
+    def setenv(self, name: str, value: str) -> None:
+        self._env[name] = value
+
     def _debug_imports(self, code: str) -> None:
         logging.info(f"\n[proxy_target = {self._package_proxy_target}]\n{code}")
         stdout, stderr = self._launch(code).communicate()
@@ -130,3 +135,55 @@ def with_proxy_bootstrap():
         # delete the file
         if pth_file.exists():
             pth_file.unlink()
+
+
+class ProxyServerProcess:
+    """Runs `python -m package_proxy` on a unix socket, serving a target package found in the given folders"""
+
+    def __init__(self, target: str, address: str, *folder, args: tuple = ()):
+        self._target = target
+        self._args = args
+        self.address = address
+        self._python_path: list[str] = [os.path.join(_PROJECT_ROOT, f) for f in folder]
+        self._process: subprocess.Popen | None = None
+
+    def __enter__(self):
+        env_dict = os.environ.copy()
+        env_dict.pop("PKG_PROXY_TARGET", None)
+        env_dict["PYTHONPATH"] = os.pathsep.join(self._python_path)
+        self._process = subprocess.Popen(
+            ["python3", "-m", "package_proxy", "--target", self._target, "--address", self.address,
+             *self._args],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            stdin=subprocess.DEVNULL,
+            text=True,
+            env=env_dict,
+            close_fds=True,
+        )
+        self._wait_until_listening()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._process.terminate()
+        self._process.communicate(timeout=10)
+        return None
+
+    def _wait_until_listening(self, timeout: float = 10.0) -> None:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(self.address[len("unix:"):])
+                return
+            except OSError:
+                if self._process.poll() is not None or time.monotonic() > deadline:
+                    _, stderr = self._process.communicate()
+                    raise RuntimeError(f"proxy server did not start:\n{stderr}")
+                time.sleep(0.05)
+
+
+@pytest.fixture
+def proxy_server(tmp_path):
+    with ProxyServerProcess("C", f"unix:{tmp_path / 'proxy.sock'}", "testbed/server", "src") as server:
+        yield server
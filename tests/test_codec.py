@@ -0,0 +1,30 @@
+from tests.conftest import PythonInterpreterInitializedWithPath
+
+
+class TestCodec:
+
+    def test_roundtrip(self):
+
+        with PythonInterpreterInitializedWithPath("src") as python:
+
+            python.ok("import pickle; from package_proxy._remote.codec import registry; "
+                      "dumps = lambda o, codec_types=(): pickle.dumps(o); "
+                      "v = (None, True, False, 1, -2**40, 2**100, 1.5, 2j); "
+                      "w = ('é\\ud800', b'x', bytearray(b'y'), [1, (2,)], {'a': {3}}, frozenset({4}), list(range(20))); "
+                      "assert registry.loads(registry.dumps(w, dumps, None), pickle.loads) == w; "
+                      "assert registry.loads(registry.dumps(v, dumps, None), pickle.loads) == v")
+            python.ok("import pickle; from package_proxy._remote.codec import registry; "
+                      "x = [1]; v = [x, x, {'x': x}]; "
+                      "w = registry.loads(registry.dumps(v, lambda o, codec_types=(): pickle.dumps(o), None), pickle.loads); "
+                      "assert w == v and w[0] is w[1] is w[2]['x']")
+            python.ok("import pickle, fractions; from package_proxy._remote.codec import registry, PICKLE; "
+                      "v = [fractions.Fraction(1, 3)]; v.append(v); "
+                      "w = registry.loads(registry.dumps(v, lambda o, codec_types=(): pickle.dumps(o), None), pickle.loads); "
+                      "assert w[0] == v[0] and w[1] is w")
+            python.ok("import pickle, threading; from package_proxy._remote.codec import registry; "
+                      "lock = threading.Lock(); refs = []; "
+                      "data = registry.dumps({'lock': lock}, lambda o, codec_types=(): pickle.dumps(o), lambda o: refs.append(o) or b'ref'); "
+                      "assert refs == [lock]; "
+                      "assert registry.loads(data, lambda d: d.decode()) == {'lock': 'ref'}")
+            python.nok("import pickle; from package_proxy._remote.codec import registry; "
+                       "registry.loads(b'\\x00' + registry.dumps(1, None, None)[1:], pickle.loads)")
@@ -23,19 +23,93 @@ class TestImport:
 
             python.ok("import C, C.mod_C1, B.mod_B1, B.BB, B.BB.mod_BB1")
 
-    def test_import_proxy(self, with_proxy_bootstrap):
+    def test_import_proxy(self, with_proxy_bootstrap, proxy_server):
 
         with PythonInterpreterInitializedWithPath("testbed/client", "src", "tests") as python:
 
             python.ok("import A")
             python.nok("import C")
+            python.ok("import sys; assert 'package_proxy' not in sys.modules")
 
             python.setenv_PACKAGE_PROXY_TARGET("C")
-            python.setenv_PACKAGE_PROXY_API_IMPL("_api.LocalApi")
+            python.setenv_PACKAGE_PROXY_API_IMPL("package_proxy._remote.api.RemoteApi")
+            python.setenv("PKG_PROXY_ADDRESS", proxy_server.address)
 
             python.ok("import A")
+            python.ok("import sys; assert 'package_proxy' in sys.modules and 'package_proxy.client' not in sys.modules")
             python.ok("import C")
             python.ok("import C.mod_C1")
 
+    def test_construction(self):
 
+        with PythonInterpreterInitializedWithPath("testbed/client", "testbed/server", "src") as python:
 
+            python.setenv("PKG_PROXY_TARGET", "C")
+            python.setenv("PKG_PROXY_API", "package_proxy._local.api.LocalApi")
+
+            python.ok("import package_proxy; from C.mod_C1 import C1_1; c = C1_1(); "
+                      "assert type(c).__name__ == 'ObjectProxy<C1_1>' and c._msg == 'method 2 here!'")
+
+            python.ok("import package_proxy; from C.mod_C1 import C1_1; a, b = C1_1(), C1_1(); "
+                      "a._other = (b,); assert type(a._other[0]).__name__ == 'C1_1'")
+
+            special_methods = ("import package_proxy; from C.mod_C2 import C2_1; c = C2_1(1, 2); "
+                               "assert len(c) == 2 and c[1] == 2 and list(c) == [1, 2] and 2 in c; "
+                               "assert repr(c) == 'C2_1(1, 2)' and c == [1, 2] and c != [2]")
+            python.ok(special_methods)
+
+            python.setenv("PKG_PROXY_CONSTRUCTION", "local")
+
+            python.ok("import package_proxy; from C.mod_C1 import C1_1; c = C1_1(); "
+                      "assert type(c).__name__ == 'C1_1' and c._proxy_id is not None")
+            python.ok(special_methods)
+
+    def test_value_cache(self):
+
+        with PythonInterpreterInitializedWithPath("testbed/client", "testbed/server", "src") as python:
+
+            python.setenv("PKG_PROXY_TARGET", "C")
+            python.setenv("PKG_PROXY_API", "package_proxy._local.api.LocalApi")
+            python.setenv("PKG_PROXY_VALUE_CACHE", "64")
+
+            # a value read before a write, that only returns after it, is not cached
+            python.ok("import package_proxy, threading; from C.mod_C2 import C2_2; c = C2_2(); "
+                      "exec('def write():\\n c.reading.wait(5)\\n c._value = 2\\n c.changed.set()'); "
+                      "writer = threading.Thread(target=write); writer.start(); "
+                      "assert c.value == 1; writer.join(); assert c.value == 2")
+
+    def test_concurrent_imports(self):
+
+        with PythonInterpreterInitializedWithPath("testbed/client", "testbed/server", "src") as python:
+
+            python.setenv("PKG_PROXY_TARGET", "C")
+            python.setenv("PKG_PROXY_API", "package_proxy._local.api.LocalApi")
+
+            python.ok("import package_proxy, importlib, sys, threading; errors = []; "
+                      "from package_proxy.client import ClientModuleFinder, _ModuleProxy; "
+                      "exec('def work(name):\\n try: importlib.import_module(name)\\n"
+                      " except BaseException as e: errors.append(e)'); "
+                      "names = ['C.mod_C1', 'C.mod_C2', 'C.CA', 'C.CB.mod_CB1'] * 4; "
+                      "threads = [threading.Thread(target=work, args=(n,)) for n in names]; "
+                      "[t.start() for t in threads]; [t.join() for t in threads]; assert not errors, errors; "
+                      "assert isinstance(sys.meta_path[0], ClientModuleFinder); "
+                      "assert all('__remote__' + n in sys.modules for n in names); "
+                      "assert not [n for n, m in list(sys.modules.items()) "
+                      "if n.startswith('__remote__') and isinstance(m, _ModuleProxy)]; "
+                      "from C.mod_C1 import C1_1; assert C1_1()._msg == 'method 2 here!'")
+
+    def test_tracing(self):
+
+        with PythonInterpreterInitializedWithPath("testbed/client", "testbed/server", "src") as python:
+
+            python.setenv("PKG_PROXY_TARGET", "C")
+            python.setenv("PKG_PROXY_API", "package_proxy._local.api.LocalApi")
+
+            python.ok("import package_proxy, sys, C.mod_C1; assert type(sys.modules) is dict")
+
+            python.setenv("PKG_PROXY_TRACE", "full")
+            python.ok("import package_proxy, sys, C.mod_C1; counts = sys.modules.counts; "
+                      "assert counts[('importlib._bootstrap', '__setitem__')] > 0, counts")
+
+            python.setenv("PKG_PROXY_TRACE", "1000000")
+            python.ok("import package_proxy, sys, C.mod_C1; assert not sys.modules.counts")
@@ -0,0 +1,44 @@
+from tests.conftest import PythonInterpreterInitializedWithPath
+
+
+class TestScheduler:
+
+    def test_affinity(self):
+
+        with PythonInterpreterInitializedWithPath("src") as python:
+
+            python.ok("import time; from package_proxy.scheduler import Scheduler; s = Scheduler(4); order = []; "
+                      "work = lambda i: time.sleep(0.01) or order.append(i); "
+                      "fs = [s.submit(work, i, key='a') for i in range(10)] + [s.submit(work, 'b', key='b')]; "
+                      "[f.result() for f in fs]; assert [i for i in order if i != 'b'] == list(range(10)), order; "
+                      "assert order.index('b') < 9, order; "
+                      "stats = s.stats(); assert (stats.queued, stats.running, stats.completed) == (0, 0, 11), stats")
+            python.ok("import threading; from package_proxy.scheduler import Scheduler; s = Scheduler(2); "
+                      "e = threading.Event(); f = s.submit(e.wait); g = s.submit(lambda: 1 / 0); "
+                      "exec('try: g.result(5)\\nexcept ZeroDivisionError: pass\\nelse: raise AssertionError()'); "
+                      "e.set(); assert f.result(5)")
+            python.nok("from package_proxy.scheduler import Scheduler; Scheduler(0)")
+
+    def test_lanes(self):
+
+        with PythonInterpreterInitializedWithPath("src") as python:
+
+            python.ok("import threading; from package_proxy.scheduler import Scheduler, CHEAP; "
+                      "s = Scheduler(3, reserved=1); e = threading.Event(); "
+                      "heavy = [s.submit(e.wait, 5) for _ in range(3)]; "
+                      "assert s.submit(lambda: 1, lane=CHEAP).result(2) == 1; "
+                      "exec('for _ in range(100):\\n stats = s.stats()\\n if stats.running == 2: break\\n e.wait(0.01)'); "
+                      "assert stats.running == 2 and stats.queued_by_lane['heavy'] == 1, stats; "
+                      "e.set(); assert all(f.result(5) for f in heavy)")
+            python.ok("import threading; from package_proxy.scheduler import Scheduler, Overloaded; "
+                      "s = Scheduler(2, max_in_flight=2, admission_wait=0.05); e = threading.Event(); "
+                      "fs = [s.submit(e.wait, 5) for _ in range(2)]; "
+                      "exec('try: s.submit(e.wait)\\nexcept Overloaded: pass\\nelse: raise AssertionError()'); "
+                      "assert s.stats().rejected == 1; "
+                      "threading.Timer(0.1, e.set).start(); s2 = Scheduler(1, max_in_flight=1, admission_wait=5); "
+                      "f = s2.submit(e.wait, 5); assert s2.submit(lambda: 2).result(5) == 2")
+            python.nok("from package_proxy.scheduler import Scheduler; Scheduler(2, reserved=2)")
+            # importing runs the module, unless it was imported already
+            python.ok("from package_proxy.server import _Request; from package_proxy.scheduler import CHEAP, HEAVY; "
+                      "assert _Request(1, 'get_module', ('sys',)).lane == CHEAP; "
+                      "assert _Request(1, 'get_module', ('wave',)).lane == HEAVY")
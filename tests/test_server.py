@@ -0,0 +1,369 @@
+from tests.conftest import PythonInterpreterInitializedWithPath, ProxyServerProcess
+
+
+class TestServer:
+
+    @staticmethod
+    def _client(proxy_server) -> PythonInterpreterInitializedWithPath:
+        python = PythonInterpreterInitializedWithPath("testbed/client", "src")
+        python.setenv("PKG_PROXY_TARGET", "C")
+        python.setenv("PKG_PROXY_API", "package_proxy._remote.api.RemoteApi")
+        python.setenv("PKG_PROXY_ADDRESS", proxy_server.address)
+        return python
+
+    def test_import_remote(self, proxy_server):
+
+        with self._client(proxy_server) as python:
+
+            python.ok("import package_proxy; import C, C.mod_C1, C.CB.mod_CB1")
+            python.ok("import package_proxy; from C.mod_C1 import C1_1, C1_2")
+            python.ok("import package_proxy; from C.mod_C1 import *; C1_1")
+
+            python.nok("import package_proxy; from C.mod_C1 import aNonExistingSymbol")
+            python.nok("import package_proxy; import B")
+
+    def test_objects_remote(self, proxy_server):
+
+        with self._client(proxy_server) as python:
+
+            python.ok("import package_proxy; from C.mod_C1 import C1_1; "
+                      "assert C1_1().method1() == 'method 2 here!'")
+            python.ok("import package_proxy; from C.mod_C1 import C1_1; "
+                      "c = C1_1(); c._msg = 'updated'; assert c.method1() == 'updated'")
+            python.ok("import package_proxy; from C.mod_C1 import C1_1; "
+                      "assert type(C1_1()._ext).__name__ == 'ObjectProxy<BB1_C1>'")
+            python.ok("import package_proxy; from C.mod_C1 import C1_2; "
+                      "assert C1_2.__abstractmethods__ == {'abstractmethod'}")
+            python.ok("import package_proxy; from C.mod_C2 import C2_1; c = C2_1(1, 2); "
+                      "assert len(c) == 2 and c[1] == 2 and list(c) == [1, 2] and 2 in c; "
+                      "assert repr(c) == 'C2_1(1, 2)' and c == [1, 2] and c != [2]")
+            python.nok("import package_proxy; from C.mod_C1 import C1_1; C1_1().nope")
+
+    def test_batch_remote(self, proxy_server):
+
+        with self._client(proxy_server) as python:
+
+            python.ok("import package_proxy, C.mod_C1 as m; api, pid = m._proxy_api, m._proxy_id; "
+                      "r = api.batch([api.Op('get_attr', (pid, 'C1_1')), api.Op('get_attr', (pid, 'nope'))]); "
+                      "assert r[0].value.attr.__name__ == 'C1_1' and isinstance(r[1].error, AttributeError)")
+            python.ok("import package_proxy, C.mod_C1 as m; b = m._proxy_api.batched(); "
+                      "c1_1 = b.get_attr(m._proxy_id, 'C1_1'); c1_2 = b.get_attr(m._proxy_id, 'C1_2'); b.flush(); "
+                      "assert (c1_1.unwrap().attr.__name__, c1_2.unwrap().attr.__name__) == ('C1_1', 'C1_2')")
+
+    def test_pipeline_remote(self, proxy_server):
+
+        with self._client(proxy_server) as python:
+
+            python.ok("import package_proxy, C.mod_C1 as m; from package_proxy.client import pipeline, resolve; "
+                      "assert resolve(pipeline(m).C1_1().method1()) == 'method 2 here!'")
+            python.ok("import package_proxy, C.mod_C1 as m; from package_proxy.client import pipeline, resolve; "
+                      "assert resolve(pipeline(m.C1_1)._msg) == 'method 2 here!'; "
+                      "assert type(resolve(pipeline(m.C1_1())._ext)).__name__ == 'ObjectProxy<BB1_C1>'")
+            python.nok("import package_proxy, C.mod_C1 as m; from package_proxy.client import pipeline, resolve; "
+                       "resolve(pipeline(m).C1_1().nope())")
+            python.ok("import package_proxy, C.mod_C1 as m; api = m._proxy_api; b = api.batched(); "
+                      "c1 = b.create_object(m.C1_1._cls_id); msg = b.call(c1, 'method1'); b.flush(); "
+                      "assert c1.value is None and msg.unwrap() == 'method 2 here!'")
+
+    def test_manifest_remote(self, proxy_server):
+
+        with self._client(proxy_server) as python:
+
+            python.ok("import package_proxy, C.mod_C1 as m; api = m._proxy_api; sent = []; request = api._request; "
+                      "api._request = lambda *a, **kw: sent.append(a) or request(*a, **kw); "
+                      "from C.mod_C1 import *; C1_1, C1_2; assert not sent, sent")
+            python.ok("import package_proxy, C.mod_C1 as m; assert m.__package__ == 'C'; "
+                      "assert not hasattr(m, '__path__') and hasattr(m.abc, 'ABC')")
+
+    def test_lazy_imports_remote(self, proxy_server):
+
+        with self._client(proxy_server) as python:
+            python.setenv("PKG_PROXY_IMPORTS", "lazy")
+
+            python.ok("import package_proxy; from package_proxy._remote.api import RemoteApi; sent = []; "
+                      "request = RemoteApi._request; "
+                      "RemoteApi._request = lambda self, *a, **kw: sent.append(a[0]) or request(self, *a, **kw); "
+                      "import C, C.mod_C1, C.CB, C.CB.mod_CB1; assert sent == ['get_module', 'batch'], sent; "
+                      "assert C.mod_C1.C1_1().method1() == 'method 2 here!' and C.mod_C1.__package__ == 'C'; "
+                      "assert 'get_module' not in sent[1:] and C.CB.mod_CB1._proxy_id is None, sent")
+            python.ok("import package_proxy; from C.mod_C1 import C1_1, C1_2")
+            # a lazy module passed along before it is resolved
+            python.ok("import package_proxy, C.mod_C1; c = C.mod_C1.C1_1(); import C.mod_C2; "
+                      "c._mod = C.mod_C2; assert c._mod.__name__ == 'C.mod_C2'")
+            python.ok("import package_proxy; import C.nope")
+            python.nok("import package_proxy; import C.nope; C.nope.x")
+            python.nok("import package_proxy; from C.mod_C1 import aNonExistingSymbol")
+
+    def test_schema_cache_remote(self, proxy_server, tmp_path):
+
+        with self._client(proxy_server) as python:
+
+            python.setenv("PKG_PROXY_SCHEMA_CACHE", str(tmp_path / "schema"))
+
+            python.ok("import package_proxy, C.mod_C1")
+            python.ok("import package_proxy; from package_proxy._remote.api import RemoteApi; sent = []; "
+                      "roundtrip = RemoteApi._roundtrip; "
+                      "RemoteApi._roundtrip = lambda self, *a, **kw: sent.append(a) or roundtrip(self, *a, **kw); "
+                      "from C.mod_C1 import C1_1; assert all(s[0] == 'get_fingerprint' for s in sent), sent; "
+                      "assert C1_1().method1() == 'method 2 here!'")
+
+    def test_value_cache_remote(self, proxy_server):
+
+        with self._client(proxy_server) as python:
+
+            python.setenv("PKG_PROXY_VALUE_CACHE", "64")
+
+            python.ok("import package_proxy; from package_proxy._remote.api import RemoteApi; sent = []; "
+                      "roundtrip = RemoteApi._roundtrip; "
+                      "RemoteApi._roundtrip = lambda self, *a, **kw: sent.append(a[0]) or roundtrip(self, *a, **kw); "
+                      "from C.mod_C1 import C1_1; c = C1_1(); sent.clear(); "
+                      "assert c._msg == c._msg == 'method 2 here!'; assert sent == ['get_attr'], sent; "
+                      "c._msg = 'updated'; assert c._msg == 'updated'; assert c.method1() == 'updated'")
+            # calls may change any object, not just the one they are made on
+            python.ok("import package_proxy; from package_proxy._remote.api import RemoteApi; sent = []; "
+                      "roundtrip = RemoteApi._roundtrip; "
+                      "RemoteApi._roundtrip = lambda self, *a, **kw: sent.append(a[0]) or roundtrip(self, *a, **kw); "
+                      "from C.mod_C1 import C1_1; a, b = C1_1(), C1_1(); assert b._msg == 'method 2 here!'; "
+                      "sent.clear(); a._proxy_api.call(a._proxy_id, '__sizeof__'); assert b._msg == 'method 2 here!'; "
+                      "assert sent == ['call', 'get_attr'], sent")
+
+    def test_write_behind_remote(self, proxy_server):
+
+        with self._client(proxy_server) as python:
+
+            python.setenv("PKG_PROXY_WRITE_BEHIND", "1")
+
+            python.ok("import package_proxy; from package_proxy._remote.api import RemoteApi; sent = []; "
+                      "roundtrip = RemoteApi._send; "
+                      "RemoteApi._send = lambda self, *a, **kw: sent.append(a) or roundtrip(self, *a, **kw); "
+                      "from C.mod_C1 import C1_1; c = C1_1(); sent.clear(); "
+                      "c._msg = 'a'; c._x = 1; c._msg = 'b'; assert not sent; "
+                      "assert c.method1() == 'b'; assert len(sent) == 3, sent")
+            python.ok("import package_proxy; from package_proxy.client import barrier; "
+                      "from C.mod_C1 import C1_1; c = C1_1(); c.__class__ = 1; "
+                      "exec('try: barrier(c)\\nexcept TypeError: pass\\nelse: raise AssertionError()'); "
+                      "assert c.method1() == 'method 2 here!'; barrier(c)")
+            # a request flushing a failed write is answered, the error is left to the next barrier
+            python.ok("import package_proxy; from package_proxy.client import barrier; "
+                      "from C.mod_C1 import C1_1; c = C1_1(); c.__class__ = 1; c._msg = 'b'; "
+                      "assert c.method1() == 'b'; "
+                      "exec('try: barrier(c)\\nexcept TypeError: pass\\nelse: raise AssertionError()'); "
+                      "barrier(c)")
+
+    def test_object_table(self):
+
+        with PythonInterpreterInitializedWithPath("testbed/server", "src") as python:
+
+            python.ok("from package_proxy.server import HostedApi; api = HostedApi('C'); "
+                      "c1_1 = api.get_attr(api.get_module('C.mod_C1'), 'C1_1').proxy_id; "
+                      "a = api.create_object(c1_1); ext = api.get_attr(a, '_ext').attr; "
+                      "assert api._add_object(ext) == api._add_object(ext) != a; "
+                      "api.release([a]); b = api.create_object(c1_1); assert b == a; "
+                      "api.release([b] + [api._add_object(ext)] * 3); assert len(api._objects) == 0")
+
+    def test_affinity(self, tmp_path):
+
+        with PythonInterpreterInitializedWithPath("testbed/server", "src") as python:
+
+            python.ok("from package_proxy.server import HostedApi, ProxyServer, _Request; api = HostedApi('C'); "
+                      f"server = ProxyServer(api, 'unix:{tmp_path / 'proxy.sock'}'); m = api.get_module('C.mod_C1'); "
+                      "c1_1 = api.get_attr(m, 'C1_1').proxy_id; a = api.create_object(c1_1); "
+                      "affinity = lambda op, *args: server._affinity(_Request(0, op, args)); "
+                      "assert affinity('call', a, 'method1') == affinity('set_attr', a, '_msg', '') == a; "
+                      "assert affinity('call', c1_1, 'method1', api._resolve(a)) == a; "
+                      "assert affinity('call', c1_1, 'method1', 1) is None and affinity('call', m, 'C1_1') is None; "
+                      "assert affinity('get_attr', a, '_msg') is None")
+
+    def test_addresses(self):
+
+        with PythonInterpreterInitializedWithPath("testbed/server", "src") as python:
+
+            python.ok("import package_proxy, sys; assert 'package_proxy.server' not in sys.modules")
+            python.ok("from package_proxy.server import HostedApi, ProxyServer; "
+                      "ProxyServer(HostedApi('C'), 'tcp:127.0.0.1:0'); ProxyServer(HostedApi('C'), 'localhost:0')")
+            python.nok("from package_proxy.server import HostedApi, ProxyServer; "
+                       "ProxyServer(HostedApi('C'), 'tcp:0.0.0.0:0')")
+            python.ok("from package_proxy.server import HostedApi, ProxyServer; "
+                      "ProxyServer(HostedApi('C'), 'tcp:0.0.0.0:0', allow_remote=True)")
+
+    def test_release_remote(self, proxy_server):
+
+        with self._client(proxy_server) as python:
+
+            python.ok("import package_proxy, gc; from package_proxy._remote import wire; released = []; "
+                      "dumps = wire.dumps_request; "
+                      "wire.dumps_request = lambda op, a, kw, r=(), *rest: released.extend(r) or dumps(op, a, kw, r, *rest); "
+                      "from C.mod_C1 import C1_1; c = C1_1(); proxy_id = c._proxy_id; del c; gc.collect(); "
+                      "assert C1_1().method1() == 'method 2 here!'; assert released == [proxy_id], released")
+
+    def test_lease_remote(self, tmp_path):
+
+        address = f"unix:{tmp_path / 'proxy.sock'}"
+        with ProxyServerProcess("C", address, "testbed/server", "src", args=("--lease", "0.2")) as server:
+            with self._client(server) as python:
+
+                python.ok("import package_proxy, time; from package_proxy._remote.api import RemoteApi; "
+                          "RemoteApi._renew_lease = lambda self: None; "
+                          "from C.mod_C1 import C1_1; c = C1_1(); time.sleep(0.5); "
+                          "exec('try: c.method1()\\nexcept (ConnectionError, OSError): pass\\n"
+                          "else: raise AssertionError()')")
+
+        with ProxyServerProcess("C", address, "testbed/server", "src", args=("--lease", "2")) as server:
+            with self._client(server) as python:
+
+                # nothing held yet but the modules and types imported
+                python.ok("import package_proxy, time; from C.mod_C1 import C1_1; time.sleep(3.5); "
+                          "assert C1_1().method1() == 'method 2 here!'")
+                # a renewal failing is tried again
+                python.ok("import package_proxy, time; from package_proxy._remote.api import RemoteApi; "
+                          "from package_proxy.api import DeadlineExceeded; send, failed = RemoteApi._send, []; "
+                          "exec('def _send(self, op, *a):\\n result = send(self, op, *a)\\n"
+                          " if op == \"lease\" and not failed:\\n"
+                          "  failed.append(op); self._decoded(result[0]); raise DeadlineExceeded()\\n"
+                          " return result'); RemoteApi._send = _send; "
+                          "from C.mod_C1 import C1_1; time.sleep(3.5); assert failed; "
+                          "assert C1_1().method1() == 'method 2 here!'")
+
+    def test_proxy_arguments_remote(self, proxy_server):
+
+        with self._client(proxy_server) as python:
+
+            python.ok("import package_proxy; from C.mod_C1 import C1_1; a, b = C1_1(), C1_1(); "
+                      "a._other = [b]; assert a._other[0]._proxy_id == b._proxy_id; "
+                      "a._ext = b._ext; assert a.method1() == 'method 2 here!'; "
+                      "assert C1_1.method1(a) == 'method 2 here!'")
+            # arguments are pickled before sending, their pickling may make requests of its own
+            python.ok("import package_proxy; from C.mod_C1 import C1_1; a, b = C1_1(), C1_1(); "
+                      "exec('class Value:\\n def __reduce__(self):\\n  return str, (b._msg,)'); "
+                      "a._value = Value(); assert a._value == 'method 2 here!'")
+
+    def test_result_policy_remote(self, tmp_path):
+
+        address = f"unix:{tmp_path / 'proxy.sock'}"
+        with ProxyServerProcess("C", address, "testbed/server", "src",
+                                args=("--result-policy", "builtins.list=2", "--result-policy", "_msg=reference")) as server:
+            with self._client(server) as python:
+
+                python.ok("import package_proxy; from C.mod_C1 import C1_1; c = C1_1(); "
+                          "c._small, c._large = [1, 2], [1, 2, 3]; assert c._small == [1, 2]; "
+                          "large = c._large; assert type(large).__name__ == 'ObjectProxy<list>'; "
+                          "assert len(large) == 3 and large[2] == 3 and 2 in large and list(large) == [1, 2, 3]; "
+                          "large[0] = 0; assert c._large[0] == 0")
+                python.ok("import package_proxy; from C.mod_C1 import C1_1; "
+                          "assert type(C1_1()._msg).__name__ == 'ObjectProxy<str>'")
+
+    def test_shared_memory_remote(self, proxy_server):
+
+        with self._client(proxy_server) as python:
+            python.setenv("PKG_PROXY_SHARED_MEMORY", "1024")
+
+            python.ok("import package_proxy, array; from package_proxy._remote import shared_buffers; "
+                      "loads = []; load = shared_buffers.load; "
+                      "shared_buffers.load = lambda ref: loads.append(ref) or load(ref); "
+                      "from C.mod_C1 import C1_1; c = C1_1(); "
+                      "c._data = b'x' * 100000; assert c._data == b'x' * 100000 and len(loads) == 1; "
+                      "value = [bytearray(2000), array.array('d', range(1000)), b'small']; "
+                      "c._data = value; assert c._data == value and len(loads) == 3; "
+                      "import os; assert not os.path.exists(loads[0].path)")
+            # only the files of shared_buffers and ring, right in the shared memory directory
+            python.ok("import os, tempfile; from package_proxy._remote import ring, shared_buffers; "
+                      "fd, path = tempfile.mkstemp(prefix='pkg-proxy-buffer-', dir=tempfile.mkdtemp()); os.close(fd); "
+                      "exec('try: shared_buffers.load(shared_buffers.SharedBuffer(path, 1, bytes))\\n"
+                      "except Exception: pass\\nelse: raise AssertionError()'); "
+                      "exec('try: ring.RingChannel.attach(path, None)\\nexcept ValueError: pass\\n"
+                      "else: raise AssertionError()'); assert os.path.exists(path)")
+
+        with self._client(proxy_server) as python:
+
+            # read by the server only if asked for in the hello
+            python.ok("import package_proxy, os; from package_proxy._remote.shared_buffers import SharedBuffers; "
+                      "from C.mod_C1 import C1_1; c = C1_1(); api = C1_1._proxy_api; api._shared = SharedBuffers(1024); "
+                      "exec('try: c._data = b\"x\" * 2000\\nexcept Exception: pass\\nelse: raise AssertionError()'); "
+                      "assert api._shared._written and all(os.path.exists(p) for p in api._shared._written); "
+                      "api._shared.close()")
+
+    def test_ring_transport_remote(self, proxy_server):
+
+        with self._client(proxy_server) as python:
+            python.setenv("PKG_PROXY_TRANSPORT", "ring")
+
+            python.ok("import package_proxy; from C.mod_C1 import C1_1; c = C1_1(); "
+                      "c._data = b'x' * 3000000; assert c._data == b'x' * 3000000; "
+                      "assert c.method1() == 'method 2 here!'; "
+                      "from package_proxy._remote.ring import RingChannel; "
+                      "assert isinstance(C1_1._proxy_api._channel, RingChannel)")
+            python.setenv("PKG_PROXY_TRANSPORT", "pigeon")
+            python.nok("import package_proxy; import C")
+
+    def test_threads_remote(self, proxy_server):
+
+        with self._client(proxy_server) as python:
+
+            python.ok("import package_proxy, gc, threading; from C.mod_C1 import C1_1; errors = []; "
+                      "exec('def work(i):\\n try:\\n  for j in range(50):\\n   c = C1_1(); c._n = (i, j)\\n"
+                      "   assert c._n == (i, j) and c.method1() == \\'method 2 here!\\'\\n   del c; gc.collect()\\n"
+                      " except BaseException as e:\\n  errors.append(e)'); "
+                      "threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]; "
+                      "[t.start() for t in threads]; [t.join() for t in threads]; assert not errors, errors; "
+                      "assert C1_1().method1() == 'method 2 here!'")
+
+    def test_asyncio_remote(self, proxy_server):
+
+        with self._client(proxy_server) as python:
+            python.setenv("PKG_PROXY_CALLS", "coroutine")
+
+            python.ok("import package_proxy, asyncio; from C.mod_C1 import C1_1; a, b = C1_1(), C1_1(); a._msg = 'hi'; "
+                      "exec('async def main():\\n return await asyncio.gather(a.method1(), b.method1())'); "
+                      "assert asyncio.run(main()) == ['hi', 'method 2 here!']")
+            python.ok("import package_proxy, asyncio; from C.mod_C1 import C1_1; c = C1_1(); "
+                      "exec('async def main():\\n return await asyncio.gather(*[c.method1() for _ in range(200)])'); "
+                      "assert asyncio.run(main()) == ['method 2 here!'] * 200; "
+                      "import inspect; assert inspect.iscoroutinefunction(C1_1.method1)")
+
+    def test_workers_remote(self, tmp_path):
+
+        address = f"unix:{tmp_path / 'proxy.sock'}"
+        with ProxyServerProcess("C", address, "testbed/server", "src",
+                                args=("--workers", "4", "--processes", "2", "--reserved-workers", "1",
+                                      "--max-in-flight", "64")) as server:
+            with self._client(server) as python:
+
+                python.ok("import package_proxy, threading; from C.mod_C1 import C1_1; c = C1_1(); "
+                          "threads = [threading.Thread(target=setattr, args=(c, '_msg', str(i))) for i in range(20)]; "
+                          "[t.start() for t in threads]; [t.join() for t in threads]; "
+                          "assert c.method1() in [str(i) for i in range(20)]; "
+                          "stats = C1_1._proxy_api.server_stats(); assert stats['workers'] == 4, stats; "
+                          "assert stats['completed'] >= 21 and len(stats['utilisation']) == 4, stats")
+
+    def test_deadlines_remote(self, proxy_server):
+
+        with self._client(proxy_server) as python:
+            python.setenv("PKG_PROXY_TIMEOUT", "30")
+
+            python.ok("import package_proxy; from package_proxy.api import timeout, DeadlineExceeded; "
+                      "from C.mod_C1 import C1_1; c = C1_1(); "
+                      "exec('try:\\n with timeout(0): c.method1()\\nexcept DeadlineExceeded: pass\\n"
+                      "else: raise AssertionError()'); "
+                      "assert c.method1() == 'method 2 here!'")
+            # a call waiting for the one before it on the same object is given up on, and never runs
+            python.ok("import package_proxy, threading, time; from package_proxy.api import timeout, DeadlineExceeded; "
+                      "from C.mod_C2 import C2_3; c = C2_3(); first = threading.Thread(target=c.wait, args=(0.5,)); "
+                      "first.start(); time.sleep(0.1); "
+                      "exec('try:\\n with timeout(0.1): c.wait(0)\\nexcept DeadlineExceeded: pass\\n"
+                      "else: raise AssertionError()'); "
+                      "first.join(); time.sleep(0.2); assert c.waits == 1, c.waits")
+            # the ids handed out by a request given up on, and cancelled too late, are released
+            python.ok("import package_proxy, time; from package_proxy.api import timeout, DeadlineExceeded; "
+                      "from package_proxy._remote import wire; from C.mod_C2 import C2_3; c = C2_3(); "
+                      "released = []; dumps = wire.dumps_request; "
+                      "wire.dumps_request = lambda op, a, kw, r=(), *rest: released.extend(r) or dumps(op, a, kw, r, *rest); "
+                      "exec('try:\\n with timeout(0.1): C2_3(0.3)\\nexcept DeadlineExceeded: pass\\n"
+                      "else: raise AssertionError()'); "
+                      "time.sleep(0.5); c.waits; c.waits; assert released, released")
+            python.setenv("PKG_PROXY_CALLS", "coroutine")
+            # the calls of cancelled tasks not started yet do not run
+            python.ok("import package_proxy, asyncio; from C.mod_C2 import C2_3; c = C2_3(); "
+                      "exec('async def main():\\n tasks = [asyncio.ensure_future(c.wait(0.05)) for _ in range(20)]\\n"
+                      " await asyncio.sleep(0.1)\\n [t.cancel() for t in tasks]\\n"
+                      " await asyncio.gather(*tasks, return_exceptions=True)'); "
+                      "asyncio.run(main()); assert c.waits < 20, c.waits")